@@ -73,7 +73,8 @@ class Model:
                  use_temp_file: bool = False, eager: bool = False,
                  metadata_override: Path | None = None, model_name: str | None = None,
                  split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False,
-                 small_first_shard: bool = False, hparams: dict[str, Any] | None = None):
+                 small_first_shard: bool = False, hparams: dict[str, Any] | None = None,
+                 write_threads: int = 1, write_buffer_size: int = 2 * 1024 * 1024 * 1024):
         if type(self) is Model:
             raise TypeError(f"{type(self).__name__!r} should not be directly instantiated")
 
@@ -83,6 +84,8 @@ class Model:
         self.is_big_endian = is_big_endian
         self.endianess = gguf.GGUFEndian.BIG if is_big_endian else gguf.GGUFEndian.LITTLE
         self.use_temp_file = use_temp_file
+        self.write_threads = write_threads
+        self.write_buffer_size = write_buffer_size
         self.lazy = not eager
         self.part_names = Model.get_model_part_names(self.dir_model, "model", ".safetensors")
         self.is_safetensors = len(self.part_names) > 0
@@ -270,6 +273,34 @@ class Model:
 
         return False
 
+    def q4_k_m_type(self, new_name: str, bid: int | None, n_per_row: int) -> gguf.GGMLQuantizationType:
+        # Tensor type mix of LLAMA_FTYPE_MOSTLY_Q4_K_M in llama_tensor_get_type in llama.cpp
+        def use_more_bits(i_layer: int, n_layers: int) -> bool:
+            return i_layer < n_layers // 8 or i_layer >= 7 * n_layers // 8 or (i_layer - n_layers // 8) % 3 == 2
+
+        qtype = gguf.GGMLQuantizationType.Q4_K
+        if self.match_model_tensor_name(new_name, gguf.MODEL_TENSOR.OUTPUT, None):
+            qtype = gguf.GGMLQuantizationType.Q6_K
+        elif self.match_model_tensor_name(new_name, gguf.MODEL_TENSOR.ATTN_QKV, bid):
+            qtype = gguf.GGMLQuantizationType.Q5_K
+        elif bid is not None and use_more_bits(bid, self.block_count) and any(
+            self.match_model_tensor_name(new_name, key, bid)
+            for key in (
+                gguf.MODEL_TENSOR.ATTN_V,
+                gguf.MODEL_TENSOR.FFN_DOWN,
+            )
+        ):
+            qtype = gguf.GGMLQuantizationType.Q6_K
+
+        # k-quants need whole super-blocks per row, fall back like llama.cpp does
+        if n_per_row % gguf.QK_K != 0:
+            qtype = {
+                gguf.GGMLQuantizationType.Q4_K: gguf.GGMLQuantizationType.Q5_0,
+                gguf.GGMLQuantizationType.Q5_K: gguf.GGMLQuantizationType.Q5_1,
+                gguf.GGMLQuantizationType.Q6_K: gguf.GGMLQuantizationType.Q8_0,
+            }[qtype]
+        return qtype
+
     # some models need extra generated tensors (like rope_freqs)
     def generate_extra_tensors(self) -> Iterable[tuple[str, Tensor]]:
         return ()
@@ -358,6 +389,8 @@ class Model:
                         data_qtype = gguf.GGMLQuantizationType.BF16
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_Q8_0:
                         data_qtype = gguf.GGMLQuantizationType.Q8_0
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q4_K_M:
+                        data_qtype = self.q4_k_m_type(new_name, bid, data.shape[-1])
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ1_0:
                         data_qtype = gguf.GGMLQuantizationType.TQ1_0
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ2_0:
@@ -439,7 +472,7 @@ class Model:
         self.prepare_metadata(vocab_only=False)
         self.gguf_writer.write_header_to_file(path=self.fname_out)
         self.gguf_writer.write_kv_data_to_file()
-        self.gguf_writer.write_tensors_to_file(progress=True)
+        self.gguf_writer.write_tensors_to_file(progress=True, n_threads=self.write_threads, max_pending_bytes=self.write_buffer_size)
         self.gguf_writer.close()
 
     def write_vocab(self):
@@ -4545,8 +4578,8 @@ def parse_args() -> argparse.Namespace:
         help="path to write to; default: based on input. {ftype} will be replaced by the outtype.",
     )
     parser.add_argument(
-        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "tq1_0", "tq2_0", "auto"], default="f16",
-        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, tq1_0 or tq2_0 for ternary, and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
+        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "q4_k_m", "tq1_0", "tq2_0", "auto"], default="f16",
+        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, q4_k_m for the Q4_K_M mix of Q4_K and Q6_K, tq1_0 or tq2_0 for ternary, and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
     )
     parser.add_argument(
         "--bigendian", action="store_true",
@@ -4588,6 +4621,14 @@ def parse_args() -> argparse.Namespace:
         "--no-tensor-first-split", action="store_true",
         help="do not add tensors to the first split (disabled by default)"
     )
+    parser.add_argument(
+        "--threads", type=int, default=min(8, os.cpu_count() or 1),
+        help="number of threads computing and quantizing tensors ahead of the writer (default: number of CPUs, at most 8)",
+    )
+    parser.add_argument(
+        "--write-buffer", type=str, default="2G",
+        help="max memory used by the tensors computed ahead of the writer, counting an estimate of their intermediates N(M|G)",
+    )
     parser.add_argument(
         "--metadata", type=Path,
         help="Specify the path for an authorship metadata override file"
@@ -4633,6 +4674,7 @@ def main() -> None:
         "f16": gguf.LlamaFileType.MOSTLY_F16,
         "bf16": gguf.LlamaFileType.MOSTLY_BF16,
         "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
+        "q4_k_m": gguf.LlamaFileType.MOSTLY_Q4_K_M,
         "tq1_0": gguf.LlamaFileType.MOSTLY_TQ1_0,
         "tq2_0": gguf.LlamaFileType.MOSTLY_TQ2_0,
         "auto": gguf.LlamaFileType.GUESSED,
@@ -4668,7 +4710,8 @@ def main() -> None:
                                      metadata_override=args.metadata, model_name=args.model_name,
                                      split_max_tensors=args.split_max_tensors,
                                      split_max_size=split_str_to_n_bytes(args.split_max_size), dry_run=args.dry_run,
-                                     small_first_shard=args.no_tensor_first_split)
+                                     small_first_shard=args.no_tensor_first_split,
+                                     write_threads=args.threads, write_buffer_size=split_str_to_n_bytes(args.write_buffer))
 
         if args.vocab_only:
             logger.info("Exporting model vocab...")
@@ -252,6 +252,10 @@ extern "C"
         return generation_finished;
     }
 
+    void set_stream_callback(stream_callback_t callback) {
+        stream_callback = callback;
+    }
+
     float get_last_eval_time() {
         return last_eval_time;
     }
@@ -261,6 +265,12 @@ extern "C"
     int get_last_token_count() {
         return last_token_count;
     }
+    int get_last_reused_tokens() {
+        return last_reused_tokens;
+    }
+    int get_last_reprocessed_tokens() {
+        return last_reprocessed_tokens;
+    }
     int get_last_seed()
     {
         return last_seed;
@@ -301,6 +311,30 @@ extern "C"
         return output;
     }
 
+    static std::vector<int> context_toks; //copy of the cached context, valid until the next call
+    token_count_outputs get_context_tokens()
+    {
+        token_count_outputs output;
+        context_toks = gpttype_get_context_tokens();
+        output.count = context_toks.size();
+        output.ids = context_toks.data();
+        return output;
+    }
+
+    size_t get_state_size()
+    {
+        return gpttype_get_state_size();
+    }
+    size_t save_state(uint8_t * dst, size_t size)
+    {
+        return gpttype_save_state(dst, size);
+    }
+    bool load_state(const uint8_t * src, size_t size, const token_count_outputs tokens)
+    {
+        std::vector<int> toks(tokens.ids, tokens.ids + tokens.count);
+        return gpttype_load_state(src, size, toks);
+    }
+
     static std::string detokenized_str = ""; //just share a static object for detokenizing
     const char * detokenize(const token_count_outputs input)
     {
@@ -339,5 +373,60 @@ extern "C"
         return output;
     }
 
+    static std::vector<int> logprob_col_selected_ids;
+    static std::vector<float> logprob_col_selected_logprobs;
+    static std::vector<int> logprob_col_option_counts;
+    static std::vector<int> logprob_col_top_ids;
+    static std::vector<float> logprob_col_top_logprobs;
+    logprob_columns_outputs get_logprob_columns(int start, int end)
+    {
+        //same data as last_logprobs, but flattened into arrays for a token range so it can be copied in bulk
+        logprob_columns_outputs output;
+        std::vector<TopPicksData> picks = gpttype_get_top_picks_range(start, end);
+        int count = picks.size();
+        logprob_col_selected_ids.assign(count, 0);
+        logprob_col_selected_logprobs.assign(count, 0.0f);
+        logprob_col_option_counts.assign(count, 0);
+        logprob_col_top_ids.assign(count * logprobs_max, -1);
+        logprob_col_top_logprobs.assign(count * logprobs_max, 0.0f);
+        for(int i=0;i<count;++i)
+        {
+            logprob_col_selected_ids[i] = picks[i].selected_tokenid;
+            logprob_col_selected_logprobs[i] = picks[i].selected_logprob;
+            int options = (picks[i].tokenid.size() < logprobs_max ? picks[i].tokenid.size() : logprobs_max);
+            logprob_col_option_counts[i] = options;
+            for(int j=0;j<options;++j)
+            {
+                logprob_col_top_ids[i * logprobs_max + j] = picks[i].tokenid[j];
+                logprob_col_top_logprobs[i * logprobs_max + j] = picks[i].logprobs[j];
+            }
+        }
+        output.count = count;
+        output.stride = logprobs_max;
+        output.selected_ids = logprob_col_selected_ids.data();
+        output.selected_logprobs = logprob_col_selected_logprobs.data();
+        output.option_counts = logprob_col_option_counts.data();
+        output.top_ids = logprob_col_top_ids.data();
+        output.top_logprobs = logprob_col_top_logprobs.data();
+        return output;
+    }
+
+    static std::string last_token_piece = "";
+    const char * get_token_piece(int id)
+    {
+        last_token_piece = gpttype_get_token_piece(id);
+        return last_token_piece.c_str();
+    }
+
+    int compile_grammar(const char * grammar)
+    {
+        //parses and caches a grammar ahead of use, returns its rule count or 0 if it is invalid
+        return gpttype_compile_grammar(grammar);
+    }
+    void forget_grammar(const char * grammar)
+    {
+        gpttype_forget_grammar(grammar);
+    }
+
 
 }
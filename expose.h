@@ -24,6 +24,13 @@ enum stop_reason
     EOS_TOKEN_HIT=1,
     CUSTOM_STOPPER=2,
 };
+enum stream_event
+{
+    STREAM_STARTED=0,
+    STREAM_NEW_TOKENS=1,
+    STREAM_FINISHED=2,
+};
+typedef void (*stream_callback_t)(int event, int token_count);
 struct logit_bias {
     int32_t token_id;
     float bias;
@@ -139,6 +146,15 @@ struct last_logprobs_outputs {
     int count = 0;
     logprob_item * logprob_items = nullptr;
 };
+struct logprob_columns_outputs {
+    int count = 0;
+    int stride = logprobs_max;
+    const int * selected_ids = nullptr;
+    const float * selected_logprobs = nullptr;
+    const int * option_counts = nullptr;
+    const int * top_ids = nullptr; //count * stride entries
+    const float * top_logprobs = nullptr; //count * stride entries
+};
 struct sd_load_model_inputs
 {
     const char * model_filename = nullptr;
@@ -192,6 +208,8 @@ struct whisper_generation_inputs
     const char * audio_data = nullptr;
     const bool suppress_non_speech = false;
     const bool quiet = false;
+    const unsigned char * audio_bytes = nullptr; //raw wav bytes, used instead of audio_data if set
+    const int audio_bytes_len = 0;
 };
 struct whisper_generation_outputs
 {
@@ -206,9 +224,12 @@ extern std::string mmproj_filename;
 extern std::string draftmodel_filename;
 extern std::vector<std::string> generated_tokens;
 extern bool generation_finished;
+extern stream_callback_t stream_callback;
 extern float last_eval_time;
 extern float last_process_time;
 extern int last_token_count;
+extern int last_reused_tokens;
+extern int last_reprocessed_tokens;
 extern int last_seed;
 extern int total_gens;
 extern int total_img_gens;
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Necessary to load the local gguf package
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from gguf import GGUFReader, GGUFWriter  # noqa: E402
+
+logger = logging.getLogger("reader-benchmark")
+
+
+def write_synthetic_model(path: str, n_vocab: int) -> None:
+    # metadata shaped like a llama 3 style model with a large vocabulary, and one tiny tensor
+    writer = GGUFWriter(path, "llama")
+    writer.add_tokenizer_model("gpt2")
+    writer.add_token_list([f"token_{i}_{'x' * (i % 12)}" for i in range(n_vocab)])
+    writer.add_token_types([1] * n_vocab)
+    writer.add_token_merges([f"t{i} o{i}" for i in range(n_vocab * 2)])
+    writer.add_chat_template("{% for message in messages %}{{ message['content'] }}{% endfor %}")
+    writer.add_tensor("token_embd.weight", np.zeros((4, 4), dtype=np.float32))
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+
+def timed(label: str, func, repeat: int) -> None:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<40} {best * 1000:10.1f} ms")  # noqa: NP100
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time opening a GGUF file and reading its metadata")
+    parser.add_argument("model", nargs="?", help="GGUF file to read, a synthetic file is written if omitted")
+    parser.add_argument("--vocab", type=int, default=128256, help="vocabulary size of the synthetic file")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best is reported")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.model
+        if path is None:
+            path = os.path.join(tmpdir, "synthetic.gguf")
+            logger.info(f"Writing a synthetic model with a {args.vocab} token vocabulary")
+            write_synthetic_model(path, args.vocab)
+
+        def chat_template() -> None:
+            field = GGUFReader(path, header_only=True).get_field("tokenizer.chat_template")
+            if field is not None:
+                field.contents()
+
+        timed("open", lambda: GGUFReader(path), args.repeat)
+        timed("open, header_only", lambda: GGUFReader(path, header_only=True), args.repeat)
+        timed("chat template, header_only", chat_template, args.repeat)
+        reader = GGUFReader(path)
+        tokens = reader.get_field("tokenizer.ggml.tokens")
+        if tokens is not None:
+            timed("decode tokenizer.ggml.tokens", lambda: tokens.contents(), args.repeat)
+            timed("tokenizer.ggml.tokens per item parts", lambda: GGUFReader(path).fields["tokenizer.ggml.tokens"].parts, 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from __future__ import annotations
 
 import logging
 import os
+import struct
 from collections import OrderedDict
 from typing import Any, Literal, NamedTuple, TypeVar, Union
 
@@ -35,23 +36,106 @@ logger = logging.getLogger(__name__)
 READER_SUPPORTED_VERSIONS = [2, GGUF_VERSION]
 
 
-class ReaderField(NamedTuple):
+class _LazyArray(NamedTuple):
+    # Where the items of an array field are, recorded on open so the
+    # per-item parts are only built if they are asked for.
+    reader: GGUFReader
+    item_type: GGUFValueType
+    n_items: int
+    # Offset of the first item.
+    start: int
+    # Offset of each item's length prefix, for arrays of strings.
+    str_offsets: npt.NDArray[np.int64] | None
+
+
+class ReaderField:
     # Offset to start of this field.
     offset: int
 
     # Name of the field (not necessarily from file data).
     name: str
 
+    types: list[GGUFValueType]
+
+    def __init__(
+        self, offset: int, name: str, parts: list[npt.NDArray[Any]] | None = None, data: list[int] | None = None,
+        types: list[GGUFValueType] | None = None, lazy: _LazyArray | None = None,
+    ):
+        self.offset = offset
+        self.name = name
+        self._parts = parts if parts is not None else []
+        self._data = data if data is not None else [-1]
+        self.types = types if types is not None else []
+        self._lazy = lazy
+
+    def __repr__(self) -> str:
+        return f'ReaderField(offset={self.offset}, name={self.name!r}, types={self.types})'
+
     # Data parts. Some types have multiple components, such as strings
     # that consist of a length followed by the string data.
-    parts: list[npt.NDArray[Any]] = []
+    # For arrays of scalars or strings these are built on first access.
+    @property
+    def parts(self) -> list[npt.NDArray[Any]]:
+        if self._lazy is not None:
+            self._expand()
+        return self._parts
 
     # Indexes into parts that we can call the actual data. For example
     # an array of strings will be populated with indexes to the actual
     # string data.
-    data: list[int] = [-1]
-
-    types: list[GGUFValueType] = []
+    @property
+    def data(self) -> list[int]:
+        if self._lazy is not None:
+            self._expand()
+        return self._data
+
+    def _expand(self) -> None:
+        lazy = self._lazy
+        assert lazy is not None
+        reader = lazy.reader
+        idxs_offs = len(self._parts)
+        if lazy.str_offsets is not None:
+            for offs in lazy.str_offsets.tolist():
+                self._parts += reader._get_str(offs)
+            self._data = list(range(idxs_offs + 1, idxs_offs + 2 * lazy.n_items, 2))
+        else:
+            items = reader._get(lazy.start, reader.gguf_scalar_to_np[lazy.item_type], lazy.n_items)
+            self._parts += (items[i:i + 1] for i in range(lazy.n_items))
+            self._data = list(range(idxs_offs, idxs_offs + lazy.n_items))
+        self._lazy = None
+
+    def contents(self, index_or_slice: int | slice = slice(None)) -> Any:
+        """Returns the field's value as Python objects: a scalar, a str, or a list for arrays.
+        Arrays can be indexed or sliced without decoding the rest of the items."""
+        if not self.types:
+            return None
+        main_type = self.types[0]
+        if main_type != GGUFValueType.ARRAY:
+            if main_type == GGUFValueType.STRING:
+                return str(bytes(self._parts[-1]), encoding = 'utf-8')
+            return self._parts[-1].tolist()[0]
+        lazy = self._lazy
+        if lazy is None:
+            if len(self.types) > 1 and self.types[-1] == GGUFValueType.STRING:
+                values: list[Any] = [str(bytes(self._parts[idx]), encoding = 'utf-8') for idx in self._data]
+            else:
+                values = [pv for idx in self._data for pv in self._parts[idx].tolist()]
+            return values[index_or_slice]
+        if lazy.str_offsets is None:
+            return lazy.reader._get(lazy.start, lazy.reader.gguf_scalar_to_np[lazy.item_type], lazy.n_items)[index_or_slice].tolist()
+        offsets = lazy.str_offsets[index_or_slice]
+        if isinstance(index_or_slice, int):
+            return lazy.reader._decode_strings(offsets.reshape(1))[0]
+        return lazy.reader._decode_strings(offsets)
+
+    def array(self) -> npt.NDArray[Any]:
+        """Returns an array of scalars as a single NumPy view of the file data."""
+        lazy = self._lazy
+        if lazy is not None and lazy.str_offsets is None:
+            return lazy.reader._get(lazy.start, lazy.reader.gguf_scalar_to_np[lazy.item_type], lazy.n_items)
+        if len(self.types) > 1 and self.types[-1] in GGUFReader.gguf_scalar_to_np:
+            return np.concatenate([self._parts[idx] for idx in self._data]) if self._data else np.empty(0, GGUFReader.gguf_scalar_to_np[self.types[-1]])
+        raise ValueError(f'Field {self.name} is not an array of scalars')
 
 
 class ReaderTensor(NamedTuple):
@@ -86,8 +170,30 @@ class GGUFReader:
         GGUFValueType.BOOL:    np.bool_,
     }
 
-    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r', 'r+', 'c'] = 'r'):
-        self.data = np.memmap(path, mode = mode)
+    # Bytes read at a time in header_only mode.
+    header_read_size: int = 1 << 20
+
+    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r', 'r+', 'c'] = 'r', header_only: bool = False):
+        # With header_only, only the metadata and tensor infos are read, through a regular
+        # file read as far as the header goes instead of mapping the whole file. Tensor
+        # data is then not available: each tensor's data is an empty array, and its
+        # data_offset and n_bytes locate it in the file.
+        self.header_only = header_only
+        if header_only:
+            if mode != 'r':
+                raise ValueError('header_only reading requires mode r')
+            self._file = open(path, 'rb')
+            self._buf = self._file.read(self.header_read_size)
+            self.data = np.frombuffer(self._buf, dtype = np.uint8)
+        else:
+            self.data = np.memmap(path, mode = mode)
+        try:
+            self._read_header()
+        finally:
+            if header_only:
+                self._file.close()
+
+    def _read_header(self) -> None:
         offs = 0
 
         # Check for GGUF magic
@@ -101,7 +207,7 @@ class GGUFReader:
             # If we get 0 here that means it's (probably) a GGUF file created for
             # the opposite byte order of the machine this script is running on.
             self.byte_order = 'S'
-            temp_version = temp_version.newbyteorder(self.byte_order)
+            temp_version = temp_version.view(temp_version.dtype.newbyteorder(self.byte_order))
         version = temp_version[0]
         if version not in READER_SUPPORTED_VERSIONS:
             raise ValueError(f'Sorry, file appears to be version {version} which we cannot handle')
@@ -139,12 +245,27 @@ class GGUFReader:
     def get_tensor(self, idx: int) -> ReaderTensor:
         return self.tensors[idx]
 
+    def _ensure(self, end_offs: int) -> None:
+        # In header_only mode, reads the file up to at least end_offs.
+        if not self.header_only or end_offs <= len(self._buf):
+            return
+        want = max(end_offs - len(self._buf), len(self._buf), self.header_read_size)
+        self._file.seek(len(self._buf))
+        more = self._file.read(want)
+        if len(self._buf) + len(more) < end_offs:
+            raise ValueError(f'GGUF file is truncated, header needs {end_offs} bytes')
+        # a new buffer every time, arrays already handed out keep viewing the old one
+        self._buf = self._buf + more
+        self.data = np.frombuffer(self._buf, dtype = np.uint8)
+
     def _get(
         self, offset: int, dtype: npt.DTypeLike, count: int = 1, override_order: None | Literal['I', 'S', '<'] = None,
     ) -> npt.NDArray[Any]:
         count = int(count)
         itemsize = int(np.empty([], dtype = dtype).itemsize)
         end_offs = offset + itemsize * count
+        if self.header_only:
+            self._ensure(end_offs)
         arr = self.data[offset:end_offs].view(dtype=dtype)[:count]
         if override_order is None:
             return arr
@@ -202,6 +323,40 @@ class GGUFReader:
         # We can't deal with this one.
         raise ValueError('Unknown/unhandled field type {gtype}')
 
+    def _u64_order(self) -> Literal['<', '>']:
+        little = np.little_endian != (self.byte_order == 'S')
+        return '<' if little else '>'
+
+    def _scan_strings(self, offs: int, count: int) -> tuple[int, npt.NDArray[np.int64]]:
+        # Walks the length prefixes of an array of strings, returning the offset past
+        # the array and the offset of each string. Only the lengths are read here.
+        unpack_from = struct.Struct(self._u64_order() + 'Q').unpack_from
+        offsets: list[int] = []
+        append = offsets.append
+        buf = self.data.data
+        buf_len = len(buf)
+        for _ in range(count):
+            if offs + 8 > buf_len:
+                self._ensure(offs + 8)
+                buf = self.data.data
+                buf_len = len(buf)
+            append(offs)
+            offs += 8 + unpack_from(buf, offs)[0]
+        self._ensure(offs)
+        return offs, np.array(offsets, dtype = np.int64)
+
+    def _decode_strings(self, offsets: npt.NDArray[np.int64]) -> list[str]:
+        # Decodes the strings at the given length prefix offsets, reading all lengths at once.
+        if len(offsets) == 0:
+            return []
+        prefix_bytes = self.data[offsets[:, None] + np.arange(8, dtype = np.int64)]
+        lengths = np.ascontiguousarray(prefix_bytes).view(np.dtype(np.uint64).newbyteorder(self._u64_order())).reshape(-1).astype(np.int64)
+        starts = offsets + 8
+        ends = starts + lengths
+        base = int(starts.min())
+        blob = self.data[base:int(ends.max())].tobytes()
+        return [blob[a:b].decode('utf-8') for a, b in zip((starts - base).tolist(), (ends - base).tolist())]
+
     def _get_tensor_info_field(self, orig_offs: int) -> ReaderField:
         offs = orig_offs
 
@@ -241,6 +396,11 @@ class GGUFReader:
             offs += int(raw_kv_type.nbytes)
             parts: list[npt.NDArray[Any]] = [kv_klen, kv_kdata, raw_kv_type]
             idxs_offs = len(parts)
+            if raw_kv_type[0] == GGUFValueType.ARRAY:
+                lazy_size = self._get_lazy_array(orig_offs, str(bytes(kv_kdata), encoding = 'utf-8'), offs, parts)
+                if lazy_size >= 0:
+                    offs += lazy_size
+                    continue
             field_size, field_parts, field_idxs, field_types = self._get_field_parts(offs, raw_kv_type[0])
             parts += field_parts
             self._push_field(ReaderField(
@@ -253,6 +413,30 @@ class GGUFReader:
             offs += field_size
         return offs
 
+    def _get_lazy_array(self, orig_offs: int, name: str, offs: int, parts: list[npt.NDArray[Any]]) -> int:
+        # Records an array of scalars or strings without building its per-item parts.
+        # Returns the size of the array data, or -1 for nested arrays, which are parsed eagerly.
+        raw_itype = self._get(offs, np.uint32)
+        alen = self._get(offs + 4, np.uint64)
+        itype = GGUFValueType(raw_itype[0])
+        count = int(alen[0])
+        start = offs + 12
+        types = [GGUFValueType.ARRAY] + ([itype] if count > 0 else [])
+        str_offsets = None
+        if itype == GGUFValueType.STRING:
+            end, str_offsets = self._scan_strings(start, count)
+        else:
+            nptype = self.gguf_scalar_to_np.get(itype)
+            if nptype is None:
+                return -1
+            end = start + count * int(np.dtype(nptype).itemsize)
+            self._ensure(end)
+        self._push_field(ReaderField(
+            orig_offs, name, parts + [raw_itype, alen], [], types,
+            lazy = _LazyArray(self, itype, count, start, str_offsets),
+        ), skip_sum = True)
+        return end - offs
+
     def _build_tensor_info(self, offs: int, count: int) -> tuple[int, list[ReaderField]]:
         tensor_fields = []
         for _ in range(count):
@@ -310,7 +494,7 @@ class GGUFReader:
                 n_elements = n_elems,
                 n_bytes = n_bytes,
                 data_offset = data_offs,
-                data = self._get(data_offs, item_type, item_count).reshape(np_dims),
+                data = np.empty(0, dtype = item_type) if self.header_only else self._get(data_offs, item_type, item_count).reshape(np_dims),
                 field = field,
             ))
         self.tensors = tensors
@@ -5,6 +5,9 @@ import os
 import shutil
 import struct
 import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum, auto
 from math import prod
@@ -28,6 +31,7 @@ from .constants import (
     TokenType,
 )
 
+from .lazy import LazyBase
 from .quants import quant_shape_from_byte_shape
 
 logger = logging.getLogger(__name__)
@@ -419,7 +423,14 @@ class GGUFWriter:
 
         self.state = WriterState.WEIGHTS
 
-    def write_tensors_to_file(self, *, progress: bool = False) -> None:
+    def write_tensors_to_file(
+        self, *, progress: bool = False, n_threads: int = 1, max_pending_bytes: int = 2 * 1024 * 1024 * 1024,
+        use_pwrite: bool = True,
+    ) -> None:
+        # With n_threads > 1, a pool of worker threads materializes (and quantizes) upcoming lazy tensors
+        # while earlier ones are being written. max_pending_bytes bounds the memory of the tensors that are
+        # being computed (estimated with their intermediates, see _working_bytes) or computed but not yet
+        # written. With use_pwrite, the writes are positioned, so shards are written concurrently.
         self.write_ti_data_to_file()
 
         assert self.fout is not None
@@ -427,7 +438,17 @@ class GGUFWriter:
         for fout in self.fout:
             self.write_padding(fout, fout.tell())
 
-        if self.temp_file is None:
+        if self.temp_file is None and n_threads > 1:
+            bar = None
+
+            if progress:
+                from tqdm import tqdm
+
+                total_bytes = sum(ti.nbytes for t in self.tensors for ti in t.values())
+                bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
+
+            self._write_tensors_pipelined(n_threads, max_pending_bytes, use_pwrite and hasattr(os, "pwrite"), bar)
+        elif self.temp_file is None:
             shard_bar = None
             bar = None
 
@@ -466,6 +487,130 @@ class GGUFWriter:
 
         self.state = WriterState.WEIGHTS
 
+    @staticmethod
+    def _working_bytes(ti: TensorInfo) -> int:
+        # Computing a lazy tensor holds its source data, a float32 upcast of it and the temporaries of
+        # the conversion or quantization at the same time, roughly three float32 copies besides the output.
+        if isinstance(ti.tensor, LazyBase):
+            return ti.nbytes + 3 * 4 * prod(ti.shape)
+        return ti.nbytes
+
+    @staticmethod
+    def _materialize(tensor: np.ndarray[Any, Any]) -> memoryview:
+        if isinstance(tensor, LazyBase):
+            tensor = LazyBase.to_eager(tensor)
+        return np.ascontiguousarray(tensor).data.cast("B")
+
+    def _write_tensors_pipelined(self, n_threads: int, max_pending_bytes: int, use_pwrite: bool, bar: Any) -> None:
+        assert self.fout is not None
+
+        # the offset of every tensor is known up front from the tensor info
+        jobs: list[tuple[int, int, TensorInfo]] = []
+        ends: list[int] = []
+        for i, (fout, tensors) in enumerate(zip(self.fout, self.tensors)):
+            fout.flush()
+            offset = fout.tell()
+            for ti in tensors.values():
+                assert ti.tensor is not None  # can only iterate once over the tensors
+                jobs.append((i, offset, ti))
+                offset += GGUFWriter.ggml_pad(ti.nbytes, self.data_alignment)
+            ends.append(offset)
+
+        cond = threading.Condition()
+        pending = 0
+        errors: list[BaseException] = []
+
+        def release(nbytes: int) -> None:
+            nonlocal pending
+            with cond:
+                pending -= nbytes
+                cond.notify_all()
+
+        def write_at(fd: int, data: memoryview, offset: int) -> None:
+            while len(data) > 0:
+                n = os.pwrite(fd, data[:1 << 30], offset)
+                data = data[n:]
+                offset += n
+
+        def pwrite_tensor(shard: int, offset: int, data: memoryview, nbytes: int) -> None:
+            assert self.fout is not None
+            try:
+                fd = self.fout[shard].fileno()
+                write_at(fd, data, offset)
+                pad = GGUFWriter.ggml_pad(nbytes, self.data_alignment) - nbytes
+                if pad != 0:
+                    write_at(fd, memoryview(bytes(pad)), offset + nbytes)
+                if bar is not None:
+                    bar.update(nbytes)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                release(nbytes)
+
+        def materialize(tensor: np.ndarray[Any, Any], intermediate_bytes: int) -> memoryview:
+            # once computed, only the output stays charged until it is written
+            try:
+                return GGUFWriter._materialize(tensor)
+            finally:
+                release(intermediate_bytes)
+
+        materialized: deque[Future[memoryview]] = deque()
+        writes: list[Future[None]] = []
+        workers = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="gguf-materialize")
+        # one writer thread per shard, so the writes to each file stay in order
+        io = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"gguf-write-{i}") for i in range(len(self.fout))] if use_pwrite else None
+        submitted = 0
+        try:
+            for shard, offset, ti in jobs:
+                # keep the pool busy with upcoming tensors, as far as the memory budget allows
+                while submitted < len(jobs):
+                    next_ti = jobs[submitted][2]
+                    cost = GGUFWriter._working_bytes(next_ti)
+                    with cond:
+                        if materialized:
+                            if pending + cost > max_pending_bytes:
+                                break
+                        else:
+                            cond.wait_for(lambda: pending == 0 or pending + cost <= max_pending_bytes)
+                        pending += cost
+                    tensor = next_ti.tensor
+                    assert tensor is not None
+                    materialized.append(workers.submit(materialize, tensor, cost - next_ti.nbytes))
+                    next_ti.tensor = None
+                    submitted += 1
+
+                data = materialized.popleft().result()
+                assert len(data) == ti.nbytes
+                if errors:
+                    raise errors[0]
+
+                if io is not None:
+                    writes.append(io[shard].submit(pwrite_tensor, shard, offset, data, ti.nbytes))
+                else:
+                    fout = self.fout[shard]
+                    fout.seek(offset)
+                    fout.write(data)
+                    self.write_padding(fout, ti.nbytes)
+                    if bar is not None:
+                        bar.update(ti.nbytes)
+                    release(ti.nbytes)
+                del data
+
+            for w in writes:
+                w.result()
+            if errors:
+                raise errors[0]
+        finally:
+            for f in materialized:
+                f.cancel()
+            workers.shutdown(wait=True)
+            if io is not None:
+                for pool in io:
+                    pool.shutdown(wait=True)
+
+        for fout, end in zip(self.fout, ends):
+            fout.seek(end)
+
     def flush(self) -> None:
         assert self.fout is not None
         for fout in self.fout:
@@ -2,6 +2,7 @@ from __future__ import annotations
 from abc import ABC, ABCMeta, abstractmethod
 
 import logging
+import threading
 from typing import Any, Callable
 
 import numpy as np
@@ -76,6 +77,7 @@ class LazyBase(ABC, metaclass=LazyMeta):
     _args: tuple
     _kwargs: dict[str, Any]
     _func: Callable[[Any], Any] | None
+    _lock: threading.Lock
 
     def __init__(self, *, meta: Any, data: Any | None = None, args: tuple = (), kwargs: dict[str, Any] | None = None, func: Callable[[Any], Any] | None = None):
         super().__init__()
@@ -84,6 +86,8 @@ class LazyBase(ABC, metaclass=LazyMeta):
         self._args = args
         self._kwargs = kwargs if kwargs is not None else {}
         self._func = func
+        # tensors can be made eager from several threads, and may share parents
+        self._lock = threading.Lock()
         assert self._func is not None or self._data is not None
 
     def __init_subclass__(cls) -> None:
@@ -153,17 +157,22 @@ class LazyBase(ABC, metaclass=LazyMeta):
             if _t._data is not None:
                 return _t._data
 
-            # NOTE: there's a recursion limit in Python (usually 1000)
+            with _t._lock:
+                # another thread may have computed it while this one waited
+                if _t._data is not None:
+                    return _t._data
 
-            assert _t._func is not None
-            _t._args = cls._recurse_apply(_t._args, simple_to_eager)
-            _t._data = _t._func(*_t._args, **_t._kwargs)
-            # sanity check
-            assert _t._data is not None
-            assert _t._data.dtype == _t._meta.dtype
-            assert _t._data.shape == _t._meta.shape
+                # NOTE: there's a recursion limit in Python (usually 1000)
 
-            return _t._data
+                assert _t._func is not None
+                _t._args = cls._recurse_apply(_t._args, simple_to_eager)
+                _t._data = _t._func(*_t._args, **_t._kwargs)
+                # sanity check
+                assert _t._data is not None
+                assert _t._data.dtype == _t._meta.dtype
+                assert _t._data.shape == _t._meta.shape
+
+                return _t._data
 
         # recurse into lists and/or tuples, keeping their structure
         return cls._recurse_apply(t, simple_to_eager)
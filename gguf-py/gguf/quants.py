@@ -47,6 +47,100 @@ def np_roundf(n: np.ndarray) -> np.ndarray:
     return np.sign(n) * b
 
 
+# sum over the last axis in the same order as a plain C loop, so float32 rounding matches the reference.
+# (np.sum uses pairwise summation, which differs in the last bits)
+def _sum_in_order(a: np.ndarray) -> np.ndarray:
+    a = np.moveaxis(a, -1, 0)
+    total = a[0].copy()
+    for v in a[1:]:
+        total += v
+    return total
+
+
+# same as nearest_int in ggml-quants.c (round half to even)
+def _nearest_int(a: np.ndarray) -> np.ndarray:
+    return np.rint(a).astype(np.int32)
+
+
+GROUP_MAX_EPS = 1e-15
+
+
+# Port of make_qkx2_quants from ggml-quants.c, over groups in the last axis.
+# Returns the scales, the (negated) mins and the quants of each group.
+def _make_qkx2_quants(x: np.ndarray, weights: np.ndarray, nmax: int, rmin: float, rdelta: float, nstep: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    f32 = np.float32
+    min = np.minimum(x.min(axis=-1), f32(0))
+    max = x.max(axis=-1)
+    sum_w = _sum_in_order(weights)
+    sum_x = _sum_in_order(weights * x)
+    flat = max == min
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iscale = f32(nmax) / (max - min)
+        scale = f32(1) / iscale
+        L = np.clip(_nearest_int(iscale[..., None] * (x - min[..., None])), 0, nmax).astype(np.float32)
+        diff = (scale[..., None] * L + min[..., None]) - x
+        best_mad = _sum_in_order(weights * (diff * diff))
+
+        # the reference updates min as it goes, which feeds into the next candidates,
+        # so the steps are done in order, each one over all groups at once
+        for step in range(nstep + 1):
+            iscale = (f32(rmin) + f32(rdelta) * f32(step) + f32(nmax)) / (max - min)
+            Laux = np.clip(_nearest_int(iscale[..., None] * (x - min[..., None])), 0, nmax).astype(np.float32)
+            wl = weights * Laux
+            sum_l = _sum_in_order(wl)
+            sum_l2 = _sum_in_order(wl * Laux)
+            sum_xl = _sum_in_order(wl * x)
+            D = sum_w * sum_l2 - sum_l * sum_l
+            this_scale = (sum_w * sum_xl - sum_x * sum_l) / D
+            this_min = (sum_l2 * sum_x - sum_l * sum_xl) / D
+            positive_min = this_min > 0
+            this_scale = np.where(positive_min, sum_xl / sum_l2, this_scale)
+            this_min = np.where(positive_min, f32(0), this_min)
+            diff = (this_scale[..., None] * Laux + this_min[..., None]) - x
+            mad = _sum_in_order(weights * (diff * diff))
+            better = (D > 0) & (mad < best_mad)
+            L = np.where(better[..., None], Laux, L)
+            best_mad = np.where(better, mad, best_mad)
+            scale = np.where(better, this_scale, scale)
+            min = np.where(better, this_min, min)
+
+    L = np.where(flat[..., None], f32(0), L)
+    scale = np.where(flat, f32(0), scale)
+    return scale, -min, L
+
+
+# Port of make_qx_quants from ggml-quants.c with rmse_type 1 and no importance weights.
+# The quants are returned with the nmax offset already added.
+def _make_qx_quants(x: np.ndarray, nmax: int) -> tuple[np.ndarray, np.ndarray]:
+    f32 = np.float32
+    imax = abs(x).argmax(axis=-1)[..., None]
+    max = np.take_along_axis(x, imax, axis=-1)[..., 0]
+    zero = abs(max) < f32(GROUP_MAX_EPS)
+    max = np.where(zero, f32(1), max)
+    w = x * x
+    wx = w * x
+
+    def quants(iscale: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        ls = np.clip(_nearest_int(iscale[..., None] * x), -nmax, nmax - 1).astype(np.float32)
+        return ls, _sum_in_order(wx * ls), _sum_in_order((w * ls) * ls)
+
+    L, sumlx, suml2 = quants(f32(-nmax) / max)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(suml2 != 0, sumlx / suml2, f32(0))
+        best = scale * sumlx
+        for i in (*range(-9, 0), *range(1, 10)):
+            ls, sumlx, suml2 = quants(-(f32(nmax) + f32(0.1) * f32(i)) / max)
+            update = (suml2 > 0) & (sumlx * sumlx > best * suml2)
+            L = np.where(update[..., None], ls, L)
+            scale = np.where(update, sumlx / suml2, scale)
+            best = np.where(update, scale * sumlx, best)
+
+    L = np.where(zero[..., None], f32(0), L + f32(nmax))
+    scale = np.where(zero, f32(0), scale)
+    return scale, L
+
+
 class QuantError(Exception): ...
 
 
@@ -502,6 +596,56 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
 
         return (sc.reshape((n_blocks, 8)), min.reshape((n_blocks, 8)))
 
+    @staticmethod
+    def quantize_scale_min(blocks: np.ndarray, nmax: int, rmin: float, nstep: int) -> tuple[np.ndarray, np.ndarray]:
+        # Shared by Q4_K and Q5_K, same as quantize_row_q4_K_ref in ggml-quants.c.
+        # Returns the packed d, dmin and scales, and the quants of each value.
+        n_blocks = blocks.shape[0]
+        x = blocks.reshape((n_blocks, QK_K // 32, 32))
+
+        av_x = np.sqrt(_sum_in_order(x * x) / np.float32(32))
+        weights = av_x[..., None] + abs(x)
+        scales, mins, L = _make_qkx2_quants(x, weights, nmax, rmin, 0.1, nstep)
+
+        max_scale = np.maximum(scales.max(axis=-1, keepdims=True), np.float32(0))
+        max_min = np.maximum(mins.max(axis=-1, keepdims=True), np.float32(0))
+        with np.errstate(divide="ignore"):
+            inv_scale = np.where(max_scale > 0, np.float32(63) / max_scale, np.float32(0))
+            inv_min = np.where(max_min > 0, np.float32(63) / max_min, np.float32(0))
+        ls = np.minimum(_nearest_int(inv_scale * scales).astype(np.uint8), np.uint8(63))
+        lm = np.minimum(_nearest_int(inv_min * mins).astype(np.uint8), np.uint8(63))
+
+        d = (max_scale / np.float32(63)).astype(np.float16)
+        dmin = (max_min / np.float32(63)).astype(np.float16)
+
+        # pack the 6-bit scales and mins, the inverse of get_scale_min
+        packed = np.concatenate([
+            ls[:, :4] | ((ls[:, 4:] >> 4) << 6),
+            lm[:, :4] | ((lm[:, 4:] >> 4) << 6),
+            (ls[:, 4:] & 0x0F) | ((lm[:, 4:] & 0x0F) << 4),
+        ], axis=-1)
+
+        # requantize with the rounded scales
+        sc, m = Q4_K.get_scale_min(packed)
+        dl = (d.astype(np.float32) * sc.astype(np.float32))[..., None]
+        dm = (dmin.astype(np.float32) * m.astype(np.float32))[..., None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = np.clip(_nearest_int((x + dm) / dl), 0, nmax).astype(np.float32)
+        L = np.where(dl != 0, q, L).astype(np.uint8)
+
+        return np.concatenate([d.view(np.uint8), dmin.view(np.uint8), packed], axis=-1), L.reshape((n_blocks, QK_K))
+
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        scales, L = Q4_K.quantize_scale_min(blocks, 15, -1.0, 20)
+
+        L = L.reshape((n_blocks, QK_K // 64, 2, 32))
+        qs = L[:, :, 0, :] | (L[:, :, 1, :] << np.uint8(4))
+
+        return np.concatenate([scales, qs.reshape((n_blocks, QK_K // 2))], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -525,6 +669,19 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
 
 
 class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        scales, L = Q4_K.quantize_scale_min(blocks, 31, -0.5, 15)
+
+        # bit i of qh[j] is the high bit of value 32 * i + j
+        qh = np.packbits((L >> np.uint8(4)).reshape((n_blocks, 8, 32)), axis=1, bitorder="little").reshape((n_blocks, QK_K // 8))
+        L = (L & np.uint8(0x0F)).reshape((n_blocks, QK_K // 64, 2, 32))
+        qs = L[:, :, 0, :] | (L[:, :, 1, :] << np.uint8(4))
+
+        return np.concatenate([scales, qh, qs.reshape((n_blocks, QK_K // 2))], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -552,6 +709,42 @@ class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
 
 
 class Q6_K(__Quant, qtype=GGMLQuantizationType.Q6_K):
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+        x = blocks.reshape((n_blocks, QK_K // 16, 16))
+
+        scales, L = _make_qx_quants(x, 32)
+
+        imax = abs(scales).argmax(axis=-1)[..., None]
+        max_scale = np.take_along_axis(scales, imax, axis=-1)
+        zero = abs(max_scale) < np.float32(GROUP_MAX_EPS)
+        max_scale = np.where(zero, np.float32(1), max_scale)
+
+        iscale = np.float32(-128) / max_scale
+        d = np.where(zero, np.float32(0), np.float32(1) / iscale).astype(np.float16)
+        sc = np.minimum(_nearest_int(iscale * scales), 127).astype(np.int8)
+        sc = np.where(zero, np.int8(0), sc)
+
+        # requantize with the rounded scales
+        dl = (d.astype(np.float32) * sc.astype(np.float32))[..., None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = np.clip(_nearest_int(x / dl), -32, 31).astype(np.float32) + np.float32(32)
+        L = np.where(dl != 0, q, L)
+        L = np.where(zero[..., None], np.float32(0), L).astype(np.uint8)
+
+        L = L.reshape((n_blocks, 2, 4, 32))
+        ql = (L[:, :, :2] & np.uint8(0x0F)) | ((L[:, :, 2:] & np.uint8(0x0F)) << np.uint8(4))
+        qh = L >> np.uint8(4)
+        qh = qh[:, :, 0] | (qh[:, :, 1] << np.uint8(2)) | (qh[:, :, 2] << np.uint8(4)) | (qh[:, :, 3] << np.uint8(6))
+
+        return np.concatenate([
+            ql.reshape((n_blocks, QK_K // 2)),
+            qh.reshape((n_blocks, QK_K // 4)),
+            sc.view(np.uint8),
+            d.view(np.uint8),
+        ], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
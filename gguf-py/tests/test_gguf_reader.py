@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import unittest
+from pathlib import Path
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+class TestGGUFReader(unittest.TestCase):
+    tmpdir: tempfile.TemporaryDirectory[str]
+    path: str
+    tokens: list[str]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmpdir.name, "test.gguf")
+        cls.tokens = [f"tok{i}é" for i in range(1000)] + ["", " "]
+        writer = gguf.GGUFWriter(cls.path, "llama")
+        writer.add_uint32("test.u32", 7)
+        writer.add_string("test.str", "héllo")
+        writer.add_bool("test.bool", True)
+        writer.add_token_list(cls.tokens)
+        writer.add_token_scores([float(i) for i in range(len(cls.tokens))])
+        writer.add_array("test.nested", [[1, 2], [3]])
+        writer.add_tensor("t0", np.arange(12, dtype=np.float32).reshape(3, 4))
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file()
+        writer.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def test_contents(self):
+        reader = gguf.GGUFReader(self.path)
+        self.assertEqual(reader.fields["test.u32"].contents(), 7)
+        self.assertEqual(reader.fields["test.str"].contents(), "héllo")
+        self.assertIs(reader.fields["test.bool"].contents(), True)
+        tokens = reader.fields["tokenizer.ggml.tokens"]
+        self.assertEqual(tokens.contents(), self.tokens)
+        self.assertEqual(tokens.contents(3), self.tokens[3])
+        self.assertEqual(tokens.contents(slice(-2, None)), ["", " "])
+        scores = reader.fields["tokenizer.ggml.scores"]
+        self.assertEqual(scores.contents(slice(0, 3)), [0.0, 1.0, 2.0])
+        self.assertEqual(scores.array().dtype, np.float32)
+        self.assertEqual(len(scores.array()), len(self.tokens))
+
+    def test_lazy_parts_match_layout(self):
+        reader = gguf.GGUFReader(self.path)
+        tokens = reader.fields["tokenizer.ggml.tokens"]
+        self.assertEqual(tokens.types, [gguf.GGUFValueType.ARRAY, gguf.GGUFValueType.STRING])
+        # key length, key, type, item type, item count, then a length and the data of each string
+        self.assertEqual(len(tokens.parts), 5 + 2 * len(self.tokens))
+        self.assertEqual(tokens.data, list(range(6, 5 + 2 * len(self.tokens), 2)))
+        self.assertEqual([str(bytes(tokens.parts[idx]), encoding="utf-8") for idx in tokens.data], self.tokens)
+        scores = reader.fields["tokenizer.ggml.scores"]
+        self.assertEqual([pv for idx in scores.data for pv in scores.parts[idx].tolist()], [float(i) for i in range(len(self.tokens))])
+        nested = reader.fields["test.nested"]
+        self.assertEqual(nested.types, [gguf.GGUFValueType.ARRAY, gguf.GGUFValueType.ARRAY, gguf.GGUFValueType.INT32])
+        self.assertEqual(nested.contents(), [1, 2, 3])
+
+    def test_header_only(self):
+        full = gguf.GGUFReader(self.path)
+        header = gguf.GGUFReader(self.path, header_only=True)
+        self.assertEqual(list(header.fields), list(full.fields))
+        self.assertEqual(header.fields["tokenizer.ggml.tokens"].contents(), self.tokens)
+        self.assertEqual(header.data_offset, full.data_offset)
+        self.assertEqual([t.name for t in header.tensors], ["t0"])
+        self.assertEqual(header.tensors[0].n_bytes, 48)
+        self.assertEqual(len(header.tensors[0].data), 0)
+        self.assertEqual(full.tensors[0].data.tolist(), np.arange(12, dtype=np.float32).reshape(3, 4).tolist())
+
+    def test_header_only_small_reads(self):
+        class SmallReads(gguf.GGUFReader):
+            header_read_size = 64
+        header = SmallReads(self.path, header_only=True)
+        self.assertEqual(header.fields["tokenizer.ggml.tokens"].contents(), self.tokens)
+        self.assertEqual(header.fields["test.str"].contents(), "héllo")
+
+
+if __name__ == '__main__':
+    unittest.main()
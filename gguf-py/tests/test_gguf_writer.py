@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import unittest
+from pathlib import Path
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, cast
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+def lazy_tensor(shape: tuple[int, ...], func: Callable[..., Any], *args: Any) -> np.ndarray[Any, Any]:
+    # lazy tensors stand in for ndarrays wherever the writer takes tensor data
+    meta = gguf.LazyNumpyTensor.meta_with_dtype_and_shape(np.float32, shape)
+    return cast(np.ndarray, gguf.LazyNumpyTensor(meta=meta, args=args, func=func))
+
+
+class TestGGUFWriterPipelined(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_model(self, name: str, split_max_tensors: int = 0, **kwargs) -> list[bytes]:
+        rng = np.random.default_rng(0)
+        path = Path(self.tmpdir.name) / f"{name}.gguf"
+        writer = gguf.GGUFWriter(path, "llama", split_max_tensors=split_max_tensors)
+        writer.add_block_count(4)
+        for i in range(12):
+            data = rng.standard_normal((8, 5 + i * 16), dtype=np.float32)
+            if i % 3 == 0:
+                # deferred computation and quantization, like convert_hf_to_gguf does
+                lazy = gguf.LazyNumpyTensor.from_eager(rng.standard_normal((4, 256), dtype=np.float32))
+                qdata = gguf.quantize(lazy * 2, gguf.GGMLQuantizationType.Q8_0)
+                writer.add_tensor(f"q{i}", qdata, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            else:
+                writer.add_tensor(f"t{i}", data if i % 2 else data.astype(np.float16))
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file(**kwargs)
+        writer.close()
+        return [p.read_bytes() for p in sorted(Path(self.tmpdir.name).glob(f"{name}*.gguf"))]
+
+    def test_matches_serial(self):
+        serial = self.write_model("serial")
+        self.assertEqual(self.write_model("pwrite", n_threads=4), serial)
+        self.assertEqual(self.write_model("seq", n_threads=4, use_pwrite=False), serial)
+
+    def test_matches_serial_sharded(self):
+        serial = self.write_model("serial", split_max_tensors=5)
+        self.assertEqual(len(serial), 3)
+        self.assertEqual(self.write_model("pwrite", split_max_tensors=5, n_threads=3), serial)
+        self.assertEqual(self.write_model("seq", split_max_tensors=5, n_threads=3, use_pwrite=False), serial)
+
+    def test_small_memory_budget(self):
+        # a budget smaller than any tensor still makes progress one tensor at a time
+        serial = self.write_model("serial")
+        self.assertEqual(self.write_model("small", n_threads=4, max_pending_bytes=1), serial)
+
+    def test_budget_counts_intermediates(self):
+        # the outputs of two tensors fit in the budget, but not their intermediates, so they are computed one at a time
+        path = Path(self.tmpdir.name) / "budget.gguf"
+        writer = gguf.GGUFWriter(path, "llama")
+        lock = threading.Lock()
+        running = 0
+        max_running = 0
+
+        def compute(x):
+            nonlocal running, max_running
+            with lock:
+                running += 1
+                max_running = max(max_running, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+            return x * 2
+
+        for i in range(4):
+            writer.add_tensor(f"t{i}", lazy_tensor((64, 64), compute, np.ones((64, 64), dtype=np.float32)))
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file(n_threads=4, max_pending_bytes=3 * 64 * 64 * 4)
+        writer.close()
+        self.assertEqual(max_running, 1)
+
+    def test_shared_parent_computed_once(self):
+        path = Path(self.tmpdir.name) / "shared.gguf"
+        writer = gguf.GGUFWriter(path, "llama")
+        calls = 0
+
+        def compute(x):
+            nonlocal calls
+            calls += 1
+            time.sleep(0.05)
+            return x + 1
+
+        parent = lazy_tensor((8, 8), compute, np.zeros((8, 8), dtype=np.float32))
+        for i in range(4):
+            writer.add_tensor(f"t{i}", parent * (i + 1))
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file(n_threads=4)
+        writer.close()
+        self.assertEqual(calls, 1)
+        reader = gguf.GGUFReader(path)
+        for i, t in enumerate(reader.tensors):
+            np.testing.assert_array_equal(t.data, np.full((8, 8), i + 1, dtype=np.float32))
+
+    def test_error_propagates(self):
+        path = Path(self.tmpdir.name) / "bad.gguf"
+        writer = gguf.GGUFWriter(path, "llama")
+
+        def fail(x):
+            raise RuntimeError("boom")
+
+        writer.add_tensor("bad", lazy_tensor((4, 4), fail, np.zeros((4, 4), dtype=np.float32)))
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        with self.assertRaises(RuntimeError):
+            writer.write_tensors_to_file(n_threads=2)
+        writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,8 @@ import sys
 from pathlib import Path
 import ctypes
 import logging
+import time
+import unittest
 import numpy as np
 
 # Necessary to load the local gguf package
@@ -226,6 +228,66 @@ def do_test(libggml_path: Path, quick: bool = False):
                 logger.info(f"Dequantization from random f16 data as {qtype.name} matches exactly ✅")
 
 
+class TestQuantize(unittest.TestCase):
+    # relative RMSE of a quantize/dequantize round-trip on normally distributed data
+    max_rel_rmse: dict[GGMLQuantizationType, float] = {
+        GGMLQuantizationType.Q4_0: 0.12,
+        GGMLQuantizationType.Q8_0: 0.008,
+        GGMLQuantizationType.Q4_K: 0.10,
+        GGMLQuantizationType.Q5_K: 0.05,
+        GGMLQuantizationType.Q6_K: 0.025,
+    }
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def test_round_trip(self):
+        data = self.rng.standard_normal((32, 1024), dtype=np.float32)
+        for qtype, max_err in self.max_rel_rmse.items():
+            with self.subTest(qtype=qtype.name):
+                q = gguf.quantize(data, qtype)
+                self.assertEqual(q.dtype, np.uint8)
+                self.assertEqual(q.shape, gguf.quant_shape_to_byte_shape(data.shape, qtype))
+                dq = gguf.dequantize(q, qtype)
+                self.assertEqual(dq.shape, data.shape)
+                err = np.sqrt(np.mean((dq - data) ** 2) / np.mean(data ** 2))
+                self.assertLess(err, max_err)
+
+    def test_degenerate_blocks(self):
+        # all-zero, constant and single-outlier rows must not produce NaNs
+        data = np.zeros((4, 256), dtype=np.float32)
+        data[1] = 3.0
+        data[2] = -0.5
+        data[3, 17] = 100.0
+        for qtype in self.max_rel_rmse:
+            with self.subTest(qtype=qtype.name):
+                dq = gguf.dequantize(gguf.quantize(data, qtype), qtype)
+                self.assertTrue(np.all(np.isfinite(dq)))
+                np.testing.assert_array_equal(dq[0], 0)
+                np.testing.assert_allclose(dq[1:3], data[1:3], rtol=0.1)
+                self.assertAlmostEqual(float(dq[3, 17]), 100.0, delta=1.0)
+
+    def test_throughput(self):
+        # loose lower bound, only meant to catch an accidental fallback to per-block Python loops
+        data = self.rng.standard_normal((64, 4096), dtype=np.float32)
+        for qtype in (GGMLQuantizationType.Q4_K, GGMLQuantizationType.Q5_K, GGMLQuantizationType.Q6_K):
+            with self.subTest(qtype=qtype.name):
+                start = time.perf_counter()
+                gguf.quantize(data, qtype)
+                elapsed = time.perf_counter() - start
+                self.assertGreater(data.nbytes / elapsed, 1024 * 1024)
+
+    @unittest.skipUnless(os.environ.get("LIBGGML"), "set LIBGGML to the path of libggml.so to compare against C")
+    def test_matches_c(self):
+        ggml_quants = GGMLQuants(Path(os.environ["LIBGGML"]))
+        data = self.rng.standard_normal((16, 1024), dtype=np.float32)
+        data[0] = 0
+        data[1, :256] = 1.5
+        for qtype in self.max_rel_rmse:
+            with self.subTest(qtype=qtype.name):
+                self.assertTrue(compare_tensors(gguf.quantize(data, qtype), ggml_quants.quantize(data, qtype), qtype))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test Python (de)quantization against the reference C implementation")
     parser.add_argument("--libggml", type=Path, default=Path(__file__).parent.parent.parent / "build" / "ggml" / "src" / "libggml.so", help="The path to libggml.so")
@@ -16,6 +16,7 @@
 #include "llama.h"
 #include <vector>
 #include <map>
+#include <list>
 #include <cstdint>
 #include <string>
 #include <cctype>
@@ -58,10 +59,21 @@ bool generation_finished;
 float last_process_time = 0;
 float last_eval_time = 0;
 int last_token_count = 0;
+int last_reused_tokens = 0; //prompt tokens kept from the previous context by fast forwarding
+int last_reprocessed_tokens = 0; //prompt tokens that had to be evaluated again
 int last_seed = -1;
 int total_gens = 0;
 stop_reason last_stop_reason = stop_reason::INVALID;
 std::vector<std::string> generated_tokens;
+stream_callback_t stream_callback = nullptr; //optional, lets the python side await new tokens instead of polling
+
+static void notify_stream(stream_event evt)
+{
+    if(stream_callback!=nullptr)
+    {
+        stream_callback((int)evt, (int)generated_tokens.size());
+    }
+}
 
 llama_grammar *  grammar = nullptr; //currently used grammar
 llama_grammar_parser parsed_grammar;
@@ -122,6 +134,7 @@ static std::vector<TopPicksData> top_picks_history;
 static int remaining_tokens = 0;
 static bool early_abort = false;
 static std::mutex concat_output_mtx;
+static std::mutex top_picks_mtx; //top picks are read by the stream thread while generating
 static std::string concat_output = "";
 static std::string concat_output_reader_copy_poll = ""; //for streaming
 static std::string concat_output_reader_copy_res = ""; //for gen response
@@ -461,6 +474,7 @@ void ContextRewind(std::vector<int> &embd, std::vector<int> &current_context_tok
         last_n_tokens.resize(last_n_tokens.size() - amount_rewind);
     }
 
+    top_picks_mtx.lock();
     if(amount_rewind >= top_picks_history.size())
     {
         top_picks_history.clear();
@@ -469,6 +483,7 @@ void ContextRewind(std::vector<int> &embd, std::vector<int> &current_context_tok
     {
         top_picks_history.resize(top_picks_history.size() - amount_rewind);
     }
+    top_picks_mtx.unlock();
 
     if (amount_rewind >= current_context_tokens.size())
     {
@@ -895,7 +910,9 @@ llama_token sample_token(llama_token_data_array * candidates, std::mt19937 & rng
         newpick.tokenid.push_back(candidates->data[i].id);
     }
 
+    top_picks_mtx.lock();
     top_picks_history.push_back(newpick);
+    top_picks_mtx.unlock();
 
     llama_token result = candidates->data[idx].id;
     return result;
@@ -1760,6 +1777,78 @@ static void grammar_accept_token(FileFormat file_format, int32_t n_vocab, struct
     GGML_ASSERT(!grammar->stacks.empty());
 }
 
+//grammars are parsed and initialized once, then kept by content so repeated requests with the
+//same grammar only need a copy of the initial state. invalid grammars are cached as nullptr.
+static std::mutex grammar_cache_mtx;
+static std::list<std::string> grammar_cache_order; //most recently used first
+static std::unordered_map<std::string, std::pair<llama_grammar *, std::list<std::string>::iterator>> grammar_cache;
+static const size_t grammar_cache_max = 32;
+
+//the cached entry can be evicted or forgotten by another thread as soon as the lock is released,
+//so everything that reads it (rule count, cloning the initial state) happens while the lock is held.
+//returns false for invalid grammars. if clone is not null, it receives a copy owned by the caller.
+static bool compile_grammar_cached(const std::string & gammarstr, bool * was_cached, size_t * n_rules, llama_grammar ** clone)
+{
+    std::lock_guard<std::mutex> lock(grammar_cache_mtx);
+    llama_grammar * compiled = nullptr;
+    auto found = grammar_cache.find(gammarstr);
+    if (found != grammar_cache.end()) {
+        grammar_cache_order.splice(grammar_cache_order.begin(), grammar_cache_order, found->second.second);
+        *was_cached = true;
+        compiled = found->second.first;
+    } else {
+        *was_cached = false;
+        parsed_grammar = llama_grammar_parser();
+        parsed_grammar.parse(gammarstr.c_str());
+        // will be empty (default) if there are parse errors
+        if (!parsed_grammar.rules.empty()) {
+            if(debugmode==1)
+            {
+                parsed_grammar.print(stderr);
+            }
+            std::vector<const llama_grammar_element *> grammar_rules(parsed_grammar.c_rules());
+            compiled = llama_grammar_init_impl(nullptr,grammar_rules.data(), grammar_rules.size(), parsed_grammar.symbol_ids.at("root"));
+        }
+        grammar_cache_order.push_front(gammarstr);
+        grammar_cache[gammarstr] = std::make_pair(compiled, grammar_cache_order.begin());
+        while (grammar_cache.size() > grammar_cache_max) {
+            auto evicted = grammar_cache.find(grammar_cache_order.back());
+            llama_grammar_free_impl(evicted->second.first);
+            grammar_cache.erase(evicted);
+            grammar_cache_order.pop_back();
+        }
+    }
+    if (compiled == nullptr) {
+        return false;
+    }
+    *n_rules = compiled->rules.size();
+    if (clone != nullptr) {
+        *clone = llama_grammar_clone_impl(*compiled);
+    }
+    return true;
+}
+
+int gpttype_compile_grammar(const std::string & gammarstr)
+{
+    bool was_cached = false;
+    size_t n_rules = 0;
+    if (!compile_grammar_cached(gammarstr, &was_cached, &n_rules, nullptr)) {
+        return 0;
+    }
+    return n_rules;
+}
+
+void gpttype_forget_grammar(const std::string & gammarstr)
+{
+    std::lock_guard<std::mutex> lock(grammar_cache_mtx);
+    auto found = grammar_cache.find(gammarstr);
+    if (found != grammar_cache.end()) {
+        llama_grammar_free_impl(found->second.first);
+        grammar_cache_order.erase(found->second.second);
+        grammar_cache.erase(found);
+    }
+}
+
 static void load_grammar(const std::string & gammarstr)
 {
     if(grammar!=nullptr) //on demand free when next grammar is loaded
@@ -1769,19 +1858,16 @@ static void load_grammar(const std::string & gammarstr)
     }
 
     if (!gammarstr.empty()) {
-        parsed_grammar = llama_grammar_parser();
-        parsed_grammar.parse(gammarstr.c_str());
-        // will be empty (default) if there are parse errors
-        if (parsed_grammar.rules.empty()) {
+        bool was_cached = false;
+        size_t n_rules = 0;
+        if (!compile_grammar_cached(gammarstr, &was_cached, &n_rules, &grammar)) {
             printf("\nIgnored invalid grammar sampler.");
             return;
         }
-        if(debugmode==1)
+        if(debugmode==1 && was_cached)
         {
-            parsed_grammar.print(stderr);
+            printf("\nReusing compiled grammar (%zu rules).", n_rules);
         }
-        std::vector<const llama_grammar_element *> grammar_rules(parsed_grammar.c_rules());
-        grammar = llama_grammar_init_impl(nullptr,grammar_rules.data(), grammar_rules.size(), parsed_grammar.symbol_ids.at("root"));
     }
 }
 
@@ -2779,6 +2865,48 @@ std::vector<int> gpttype_get_token_arr(const std::string & input, bool addbos)
     return toks;
 }
 
+//context state snapshots, only for plain attention models without a draft model (whose kv would go stale)
+static bool kcpp_state_supported()
+{
+    return (file_format == FileFormat::GGUF_GENERIC && llama_ctx_v4 != nullptr && draft_ctx == nullptr
+    && file_format_meta.model_architecture != GGUFArch::ARCH_MAMBA && file_format_meta.model_architecture != GGUFArch::ARCH_RWKV);
+}
+size_t gpttype_get_state_size()
+{
+    if(!kcpp_state_supported())
+    {
+        return 0;
+    }
+    return llama_state_seq_get_size(llama_ctx_v4, 0);
+}
+size_t gpttype_save_state(uint8_t * dst, size_t size)
+{
+    if(!kcpp_state_supported())
+    {
+        return 0;
+    }
+    return llama_state_seq_get_data(llama_ctx_v4, dst, size, 0);
+}
+bool gpttype_load_state(const uint8_t * src, size_t size, const std::vector<int> & tokens)
+{
+    if(!kcpp_state_supported())
+    {
+        return false;
+    }
+    llama_kv_cache_clear(llama_ctx_v4);
+    if(llama_state_seq_set_data(llama_ctx_v4, src, size, 0)==0)
+    {
+        current_context_tokens.clear();
+        return false;
+    }
+    current_context_tokens = tokens;
+    return true;
+}
+const std::vector<int> & gpttype_get_context_tokens()
+{
+    return current_context_tokens;
+}
+
 std::string gpttype_detokenize(const std::vector<int> & inputids, bool render_special)
 {
     std::string output = "";
@@ -2809,9 +2937,28 @@ const std::string & gpttype_get_pending_output()
 
 const std::vector<TopPicksData> gpttype_get_top_picks_data()
 {
+    std::lock_guard<std::mutex> lock(top_picks_mtx);
     return top_picks_history;
 }
 
+const std::vector<TopPicksData> gpttype_get_top_picks_range(int start, int end)
+{
+    std::lock_guard<std::mutex> lock(top_picks_mtx);
+    int total = top_picks_history.size();
+    start = (start < 0 ? 0 : (start > total ? total : start));
+    end = (end < 0 || end > total ? total : end);
+    if(end <= start)
+    {
+        return std::vector<TopPicksData>();
+    }
+    return std::vector<TopPicksData>(top_picks_history.begin() + start, top_picks_history.begin() + end);
+}
+
+std::string gpttype_get_token_piece(int id)
+{
+    return FileFormatTokenizeID(id, file_format, true);
+}
+
 bool VecContainsIntVal(const std::vector<int> & vec, const int val)
 {
     for (const auto &matched : vec)
@@ -2849,6 +2996,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
         output.prompt_tokens = output.completion_tokens = 0;
         output.stopreason = stop_reason::INVALID;
         generation_finished = true;
+        notify_stream(stream_event::STREAM_FINISHED);
         return output;
     }
 
@@ -2860,6 +3008,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
     generation_finished = false; // Set current generation status
     generated_tokens.clear(); // New Generation, new tokens
     delayed_generated_tokens.clear();
+    notify_stream(stream_event::STREAM_STARTED);
 
     concat_output_mtx.lock();
     concat_output = "";
@@ -2872,7 +3021,9 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
     dry_repeat_count.clear();
     dry_sequence_breakers.clear();
     dry_max_token_repeat.clear();
+    top_picks_mtx.lock();
     top_picks_history.clear();
+    top_picks_mtx.unlock();
     early_abort = false;
 
     double time0 = 0, time1 = 0, time2 = 0;
@@ -3355,6 +3506,8 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
     bool blasmode = (embd_inp.size() >= 32 && kcpp_cpu_has_blas() && kcpp_data->n_batch>=32);
 
     current_context_tokens.resize(n_past);
+    last_reused_tokens = n_past;
+    last_reprocessed_tokens = embd_inp.size();
 
     remaining_tokens = kcpp_data->n_predict;
     int input_consumed = 0;
@@ -3563,6 +3716,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
                 output.prompt_tokens = output.completion_tokens = 0;
                 output.stopreason = stop_reason::INVALID;
                 generation_finished = true;
+                notify_stream(stream_event::STREAM_FINISHED);
                 return output;
             }
         }
@@ -3732,6 +3886,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
                         concat_output += delayed_generated_tokens[0];
                         concat_output_mtx.unlock();
                         delayed_generated_tokens.pop_front();
+                        notify_stream(stream_event::STREAM_NEW_TOKENS);
                     }
                 }
 
@@ -3945,6 +4100,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
                                 output.prompt_tokens = output.completion_tokens = 0;
                                 output.stopreason = stop_reason::INVALID;
                                 generation_finished = true;
+                                notify_stream(stream_event::STREAM_FINISHED);
                                 return output;
                             }
                         }
@@ -3957,6 +4113,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
                             output.prompt_tokens = output.completion_tokens = 0;
                             output.stopreason = stop_reason::INVALID;
                             generation_finished = true;
+                            notify_stream(stream_event::STREAM_FINISHED);
                             return output;
                         }
                     }
@@ -3989,6 +4146,7 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
         concat_output += delayed_generated_tokens[0];
         concat_output_mtx.unlock();
         delayed_generated_tokens.pop_front();
+        notify_stream(stream_event::STREAM_NEW_TOKENS);
     }
 
     if(debugmode==1 && file_format == FileFormat::GGUF_GENERIC)
@@ -4021,5 +4179,6 @@ generation_outputs gpttype_generate(const generation_inputs inputs)
     concat_output_mtx.unlock();
     output.text = concat_output_reader_copy_res.c_str();
     generation_finished = true;
+    notify_stream(stream_event::STREAM_FINISHED);
     return output;
 }
@@ -0,0 +1,670 @@
+import re
+import json
+
+
+# Python port of common/json-schema-to-grammar.cpp, used for OpenAI style response_format json schemas.
+# The output matches the C++ converter rule for rule. Remote $refs are not fetched.
+
+SPACE_RULE = '| " " | "\\n" [ \\t]{0,20}'
+
+# name -> (content, deps)
+PRIMITIVE_RULES = {
+    'boolean': ('("true" | "false") space', []),
+    'decimal-part': ('[0-9]{1,16}', []),
+    'integral-part': ('[0] | [1-9] [0-9]{0,15}', []),
+    'number': ('("-"? integral-part) ("." decimal-part)? ([eE] [-+]? integral-part)? space', ['integral-part', 'decimal-part']),
+    'integer': ('("-"? integral-part) space', ['integral-part']),
+    'value': ('object | array | string | number | boolean | null', ['object', 'array', 'string', 'number', 'boolean', 'null']),
+    'object': ('"{" space ( string ":" space value ("," space string ":" space value)* )? "}" space', ['string', 'value']),
+    'array': ('"[" space ( value ("," space value)* )? "]" space', ['value']),
+    'uuid': ('"\\"" [0-9a-fA-F]{8} "-" [0-9a-fA-F]{4} "-" [0-9a-fA-F]{4} "-" [0-9a-fA-F]{4} "-" [0-9a-fA-F]{12} "\\"" space', []),
+    'char': ('[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\bfnrt] | "u" [0-9a-fA-F]{4})', []),
+    'string': ('"\\"" char* "\\"" space', ['char']),
+    'null': ('"null" space', []),
+}
+
+STRING_FORMAT_RULES = {
+    'date': ('[0-9]{4} "-" ( "0" [1-9] | "1" [0-2] ) "-" ( "0" [1-9] | [1-2] [0-9] | "3" [0-1] )', []),
+    'time': ('([01] [0-9] | "2" [0-3]) ":" [0-5] [0-9] ":" [0-5] [0-9] ( "." [0-9]{3} )? ( "Z" | ( "+" | "-" ) ( [01] [0-9] | "2" [0-3] ) ":" [0-5] [0-9] )', []),
+    'date-time': ('date "T" time', ['date', 'time']),
+    'date-string': ('"\\"" date "\\"" space', ['date']),
+    'time-string': ('"\\"" time "\\"" space', ['time']),
+    'date-time-string': ('"\\"" date-time "\\"" space', ['date-time']),
+}
+
+RESERVED_NAMES = set(['root'] + list(PRIMITIVE_RULES.keys()) + list(STRING_FORMAT_RULES.keys()))
+
+INVALID_RULE_CHARS_RE = re.compile(r'[^a-zA-Z0-9-]+')
+GRAMMAR_LITERAL_ESCAPE_RE = re.compile(r'[\r\n"]')
+GRAMMAR_LITERAL_ESCAPES = {'\r': '\\r', '\n': '\\n', '"': '\\"', '-': '\\-', ']': '\\]'}
+UUID_FORMAT_RE = re.compile(r'^uuid[1-5]?$')
+
+NON_LITERAL_SET = set('|.()[]{}*+?')
+ESCAPED_IN_REGEXPS_BUT_NOT_IN_LITERALS = set('^$.[]()|{}*+?')
+
+
+def dump_json(value):
+    # same text as nlohmann::json::dump()
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def format_literal(literal):
+    escaped = GRAMMAR_LITERAL_ESCAPE_RE.sub(lambda m: GRAMMAR_LITERAL_ESCAPES[m.group(0)], literal)
+    return f'"{escaped}"'
+
+
+def build_repetition(item_rule, min_items, max_items, separator_rule=None):
+    # max_items is None when unbounded
+    if min_items == 0 and max_items == 1:
+        return f'{item_rule}?'
+
+    if not separator_rule:
+        if min_items == 1 and max_items is None:
+            return f'{item_rule}+'
+        elif min_items == 0 and max_items is None:
+            return f'{item_rule}*'
+        else:
+            return f'{item_rule}{{{min_items},{max_items if max_items is not None else ""}}}'
+
+    result = item_rule + ' ' + build_repetition(f'({separator_rule} {item_rule})', min_items - 1 if min_items > 0 else 0, max_items - 1 if max_items is not None else None)
+    return f'({result})?' if min_items == 0 else result
+
+
+def _build_min_max_int(min_value, max_value, out, decimals_left=16, top_level=True):
+    # min_value and max_value are None when unbounded
+    has_min = min_value is not None
+    has_max = max_value is not None
+
+    def digit_range(from_char, to_char):
+        out.append('[')
+        if from_char == to_char:
+            out.append(from_char)
+        else:
+            out.append(from_char)
+            out.append('-')
+            out.append(to_char)
+        out.append(']')
+
+    def more_digits(min_digits, max_digits):
+        out.append('[0-9]')
+        if min_digits == max_digits and min_digits == 1:
+            return
+        out.append('{')
+        out.append(str(min_digits))
+        if max_digits != min_digits:
+            out.append(',')
+            if max_digits is not None:
+                out.append(str(max_digits))
+        out.append('}')
+
+    def uniform_range(from_str, to_str):
+        i = 0
+        while i < len(from_str) and i < len(to_str) and from_str[i] == to_str[i]:
+            i += 1
+        if i > 0:
+            out.append('"')
+            out.append(from_str[:i])
+            out.append('"')
+        if i < len(from_str) and i < len(to_str):
+            if i > 0:
+                out.append(' ')
+            sub_len = len(from_str) - i - 1
+            if sub_len > 0:
+                from_sub = from_str[i+1:]
+                to_sub = to_str[i+1:]
+                sub_zeros = '0' * sub_len
+                sub_nines = '9' * sub_len
+
+                to_reached = False
+                out.append('(')
+                if from_sub == sub_zeros:
+                    digit_range(from_str[i], chr(ord(to_str[i]) - 1))
+                    out.append(' ')
+                    more_digits(sub_len, sub_len)
+                else:
+                    out.append(f'[{from_str[i]}] ')
+                    out.append('(')
+                    uniform_range(from_sub, sub_nines)
+                    out.append(')')
+                    if ord(from_str[i]) < ord(to_str[i]) - 1:
+                        out.append(' | ')
+                        if to_sub == sub_nines:
+                            digit_range(chr(ord(from_str[i]) + 1), to_str[i])
+                            to_reached = True
+                        else:
+                            digit_range(chr(ord(from_str[i]) + 1), chr(ord(to_str[i]) - 1))
+                        out.append(' ')
+                        more_digits(sub_len, sub_len)
+                if not to_reached:
+                    out.append(' | ')
+                    digit_range(to_str[i], to_str[i])
+                    out.append(' ')
+                    uniform_range(sub_zeros, to_sub)
+                out.append(')')
+            else:
+                out.append(f'[{from_str[i]}-{to_str[i]}]')
+
+    if has_min and has_max:
+        if min_value < 0 and max_value < 0:
+            out.append('"-" (')
+            _build_min_max_int(-max_value, -min_value, out, decimals_left, top_level=True)
+            out.append(')')
+            return
+
+        if min_value < 0:
+            out.append('"-" (')
+            _build_min_max_int(0, -min_value, out, decimals_left, top_level=True)
+            out.append(') | ')
+            min_value = 0
+
+        min_s = str(min_value)
+        max_s = str(max_value)
+        min_digits = len(min_s)
+        max_digits = len(max_s)
+
+        for digits in range(min_digits, max_digits):
+            uniform_range(min_s, '9' * digits)
+            min_s = '1' + '0' * digits
+            out.append(' | ')
+        uniform_range(min_s, max_s)
+        return
+
+    less_decimals = max(decimals_left - 1, 1)
+
+    if has_min:
+        if min_value < 0:
+            out.append('"-" (')
+            _build_min_max_int(None, -min_value, out, decimals_left, top_level=False)
+            out.append(') | [0] | [1-9] ')
+            more_digits(0, decimals_left - 1)
+        elif min_value == 0:
+            if top_level:
+                out.append('[0] | [1-9] ')
+                more_digits(0, less_decimals)
+            else:
+                more_digits(1, decimals_left)
+        elif min_value <= 9:
+            c = str(min_value)
+            range_start = '1' if top_level else '0'
+            if c > range_start:
+                digit_range(range_start, chr(ord(c) - 1))
+                out.append(' ')
+                more_digits(1, less_decimals)
+                out.append(' | ')
+            digit_range(c, '9')
+            out.append(' ')
+            more_digits(0, less_decimals)
+        else:
+            min_s = str(min_value)
+            length = len(min_s)
+            c = min_s[0]
+
+            if c > '1':
+                digit_range('1' if top_level else '0', chr(ord(c) - 1))
+                out.append(' ')
+                more_digits(length, less_decimals)
+                out.append(' | ')
+            digit_range(c, c)
+            out.append(' (')
+            _build_min_max_int(int(min_s[1:]), None, out, less_decimals, top_level=False)
+            out.append(')')
+            if c < '9':
+                out.append(' | ')
+                digit_range(chr(ord(c) + 1), '9')
+                out.append(' ')
+                more_digits(length - 1, less_decimals)
+        return
+
+    if has_max:
+        if max_value >= 0:
+            if top_level:
+                out.append('"-" [1-9] ')
+                more_digits(0, less_decimals)
+                out.append(' | ')
+            _build_min_max_int(0, max_value, out, decimals_left, top_level=True)
+        else:
+            out.append('"-" (')
+            _build_min_max_int(-max_value, None, out, decimals_left, top_level=False)
+            out.append(')')
+        return
+
+    raise RuntimeError('At least one of min_value or max_value must be set')
+
+
+class SchemaConverter:
+    def __init__(self, dotall=False):
+        self._dotall = dotall
+        self._rules = {'space': SPACE_RULE}
+        self._refs = {}
+        self._refs_being_resolved = set()
+        self._errors = []
+        self._warnings = []
+
+    def _add_rule(self, name, rule):
+        esc_name = INVALID_RULE_CHARS_RE.sub('-', name)
+        if esc_name not in self._rules or self._rules[esc_name] == rule:
+            key = esc_name
+        else:
+            i = 0
+            while f'{esc_name}{i}' in self._rules and self._rules[f'{esc_name}{i}'] != rule:
+                i += 1
+            key = f'{esc_name}{i}'
+        self._rules[key] = rule
+        return key
+
+    def _add_primitive(self, name, rule):
+        content, deps = rule
+        n = self._add_rule(name, content)
+        for dep in deps:
+            dep_rule = PRIMITIVE_RULES.get(dep) or STRING_FORMAT_RULES.get(dep)
+            if dep_rule is None:
+                self._errors.append(f'Rule {dep} not known')
+                continue
+            if dep not in self._rules:
+                self._add_primitive(dep, dep_rule)
+        return n
+
+    def _generate_union_rule(self, name, alt_schemas):
+        return ' | '.join(self.visit(alt_schema, f'{name}{"-" if name else "alternative-"}{i}') for i, alt_schema in enumerate(alt_schemas))
+
+    def _visit_pattern(self, pattern, name):
+        if not (pattern.startswith('^') and pattern.endswith('$')):
+            self._errors.append("Pattern must start with '^' and end with '$'")
+            return ''
+        sub_pattern = pattern[1:-1]
+        sub_rule_ids = {}
+        length = len(sub_pattern)
+        i = 0
+
+        # items are (text, is_literal)
+        def to_rule(item):
+            text, is_literal = item
+            return f'"{text}"' if is_literal else text
+
+        def get_dot():
+            rule = '[\\U00000000-\\U0010FFFF]' if self._dotall else '[^\\x0A\\x0D]'
+            return self._add_rule('dot', rule)
+
+        def transform():
+            nonlocal i
+            start = i
+            seq = []
+
+            def join_seq():
+                # joins the sequence, merging consecutive literals together
+                ret = []
+                literal = ''
+                for text, is_literal in seq:
+                    if is_literal:
+                        literal += text
+                    else:
+                        if literal:
+                            ret.append((literal, True))
+                            literal = ''
+                        ret.append((text, False))
+                if literal:
+                    ret.append((literal, True))
+                return (' '.join(to_rule(item) for item in ret), False)
+
+            while i < length:
+                c = sub_pattern[i]
+                if c == '.':
+                    seq.append((get_dot(), False))
+                    i += 1
+                elif c == '(':
+                    i += 1
+                    if i < length and sub_pattern[i] == '?':
+                        self._warnings.append('Unsupported pattern syntax')
+                    seq.append((f'({to_rule(transform())})', False))
+                elif c == ')':
+                    i += 1
+                    if start > 0 and sub_pattern[start - 1] != '(':
+                        self._errors.append('Unbalanced parentheses')
+                    return join_seq()
+                elif c == '[':
+                    square_brackets = c
+                    i += 1
+                    while i < length and sub_pattern[i] != ']':
+                        if sub_pattern[i] == '\\':
+                            square_brackets += sub_pattern[i:i+2]
+                            i += 2
+                        else:
+                            square_brackets += sub_pattern[i]
+                            i += 1
+                    if i >= length:
+                        self._errors.append('Unbalanced square brackets')
+                    square_brackets += ']'
+                    i += 1
+                    seq.append((square_brackets, False))
+                elif c == '|':
+                    seq.append(('|', False))
+                    i += 1
+                elif c in ('*', '+', '?'):
+                    if not seq:
+                        self._errors.append(f'Nothing to repeat before {c}')
+                        return ('', False)
+                    seq[-1] = (to_rule(seq[-1]) + c, False)
+                    i += 1
+                elif c == '{':
+                    curly_brackets = c
+                    i += 1
+                    while i < length and sub_pattern[i] != '}':
+                        curly_brackets += sub_pattern[i]
+                        i += 1
+                    if i >= length:
+                        self._errors.append('Unbalanced curly brackets')
+                    curly_brackets += '}'
+                    i += 1
+                    nums = curly_brackets[1:-1].split(',')
+                    min_times = 0
+                    max_times = None
+                    try:
+                        if len(nums) == 1:
+                            min_times = max_times = int(nums[0])
+                        elif len(nums) != 2:
+                            self._errors.append('Wrong number of values in curly brackets')
+                        else:
+                            if nums[0]:
+                                min_times = int(nums[0])
+                            if nums[1]:
+                                max_times = int(nums[1])
+                    except ValueError:
+                        self._errors.append('Invalid number in curly brackets')
+                        return ('', False)
+                    if not seq:
+                        self._errors.append('Nothing to repeat before {')
+                        return ('', False)
+                    sub, sub_is_literal = seq[-1]
+
+                    if not sub_is_literal:
+                        sub_id = sub_rule_ids.get(sub)
+                        if sub_id is None:
+                            sub_id = self._add_rule(f'{name}-{len(sub_rule_ids) + 1}', sub)
+                            sub_rule_ids[sub] = sub_id
+                        sub = sub_id
+
+                    seq[-1] = (build_repetition(f'"{sub}"' if sub_is_literal else sub, min_times, max_times), False)
+                else:
+                    literal = ''
+                    while i < length:
+                        if sub_pattern[i] == '\\' and i < length - 1:
+                            next_char = sub_pattern[i + 1]
+                            if next_char in ESCAPED_IN_REGEXPS_BUT_NOT_IN_LITERALS:
+                                i += 1
+                                literal += sub_pattern[i]
+                                i += 1
+                            else:
+                                literal += sub_pattern[i:i+2]
+                                i += 2
+                        elif sub_pattern[i] == '"':
+                            literal += '\\"'
+                            i += 1
+                        elif sub_pattern[i] not in NON_LITERAL_SET and \
+                                (i == length - 1 or literal == '' or sub_pattern[i + 1] == '.' or sub_pattern[i + 1] not in NON_LITERAL_SET):
+                            literal += sub_pattern[i]
+                            i += 1
+                        else:
+                            break
+                    if literal:
+                        seq.append((literal, True))
+            return join_seq()
+
+        return self._add_rule(name, '"\\"" (' + to_rule(transform()) + ') "\\"" space')
+
+    def _not_strings(self, strings):
+        # a rule matching a json string that is none of the given strings, see the C++ converter for examples
+        class TrieNode:
+            def __init__(self):
+                self.children = {}
+                self.is_end_of_string = False
+
+            def insert(self, string):
+                node = self
+                for c in string:
+                    node = node.children.setdefault(c, TrieNode())
+                node.is_end_of_string = True
+
+        trie = TrieNode()
+        for s in strings:
+            trie.insert(s)
+
+        char_rule = self._add_primitive('char', PRIMITIVE_RULES['char'])
+        out = ['["] ( ']
+
+        def visit(node):
+            rejects = []
+            first = True
+            for c in sorted(node.children.keys()):
+                child = node.children[c]
+                rejects.append(c)
+                if first:
+                    first = False
+                else:
+                    out.append(' | ')
+                out.append(f'[{c}]')
+                if child.children:
+                    out.append(' (')
+                    visit(child)
+                    out.append(')')
+                elif child.is_end_of_string:
+                    out.append(f' {char_rule}+')
+            if node.children:
+                if not first:
+                    out.append(' | ')
+                out.append(f'[^"{"".join(rejects)}] {char_rule}*')
+
+        visit(trie)
+        out.append(' )')
+        if not trie.is_end_of_string:
+            out.append('?')
+        out.append(' ["] space')
+        return ''.join(out)
+
+    def _resolve_ref(self, ref):
+        ref_name = ref.split('/')[-1]
+        if ref_name not in self._rules and ref not in self._refs_being_resolved:
+            self._refs_being_resolved.add(ref)
+            resolved = self._refs.get(ref)
+            ref_name = self.visit(resolved if resolved is not None else {}, ref_name)
+            self._refs_being_resolved.discard(ref)
+        return ref_name
+
+    def _build_object_rule(self, properties, required, name, additional_properties):
+        required_props = []
+        optional_props = []
+        prop_kv_rule_names = {}
+        prop_names = []
+        for prop_name, prop_schema in properties:
+            prop_rule_name = self.visit(prop_schema, f'{name}{"-" if name else ""}{prop_name}')
+            prop_kv_rule_names[prop_name] = self._add_rule(
+                f'{name}{"-" if name else ""}{prop_name}-kv',
+                format_literal(dump_json(prop_name)) + ' space ":" space ' + prop_rule_name
+            )
+            if prop_name in required:
+                required_props.append(prop_name)
+            else:
+                optional_props.append(prop_name)
+            prop_names.append(prop_name)
+
+        if additional_properties is True or isinstance(additional_properties, dict):
+            sub_name = f'{name}{"-" if name else ""}additional'
+            if isinstance(additional_properties, dict):
+                value_rule = self.visit(additional_properties, f'{sub_name}-value')
+            else:
+                value_rule = self._add_primitive('value', PRIMITIVE_RULES['value'])
+            if prop_names:
+                key_rule = self._add_rule(f'{sub_name}-k', self._not_strings(prop_names))
+            else:
+                key_rule = self._add_primitive('string', PRIMITIVE_RULES['string'])
+            prop_kv_rule_names['*'] = self._add_rule(f'{sub_name}-kv', f'{key_rule} ":" space {value_rule}')
+            optional_props.append('*')
+
+        rule = '"{" space '
+        rule += ' "," space '.join(prop_kv_rule_names[k] for k in required_props)
+
+        if optional_props:
+            rule += ' ('
+            if required_props:
+                rule += ' "," space ( '
+
+            def get_recursive_refs(ks, first_is_optional):
+                k = ks[0]
+                kv_rule_name = prop_kv_rule_names[k]
+                comma_ref = f'( "," space {kv_rule_name} )'
+                if first_is_optional:
+                    res = comma_ref + ('*' if k == '*' else '?')
+                else:
+                    res = kv_rule_name + (' ' + comma_ref + '*' if k == '*' else '')
+                if len(ks) > 1:
+                    res += ' ' + self._add_rule(f'{name}{"-" if name else ""}{k}-rest', get_recursive_refs(ks[1:], True))
+                return res
+
+            rule += ' | '.join(get_recursive_refs(optional_props[i:], False) for i in range(len(optional_props)))
+            if required_props:
+                rule += ' )'
+            rule += ' )?'
+
+        rule += ' "}" space'
+        return rule
+
+    def resolve_refs(self, schema, url):
+        # resolves the local $refs in the schema, rewriting each to an absolute reference
+        # and recording the referenced subschema in _refs
+        def visit_refs(n):
+            if isinstance(n, list):
+                for x in n:
+                    visit_refs(x)
+            elif isinstance(n, dict):
+                ref = n.get('$ref')
+                if isinstance(ref, str):
+                    if ref in self._refs:
+                        return
+                    if ref.startswith('#/'):
+                        target = schema
+                        ref = url + ref
+                        n['$ref'] = ref
+                    else:
+                        self._errors.append(f'Unsupported ref: {ref}')
+                        return
+                    for sel in ref.split('#', 1)[1].split('/')[1:]:
+                        if not isinstance(target, dict) or sel not in target:
+                            self._errors.append(f'Error resolving ref {ref}: {sel} not in {dump_json(target)}')
+                            return
+                        target = target[sel]
+                    self._refs[ref] = target
+                else:
+                    for v in n.values():
+                        visit_refs(v)
+
+        visit_refs(schema)
+        return schema
+
+    def visit(self, schema, name):
+        if not isinstance(schema, dict):
+            self._errors.append(f'Unrecognized schema: {dump_json(schema)}')
+            return ''
+        schema_type = schema.get('type')
+        schema_format = schema.get('format') or ''
+        rule_name = name + '-' if name in RESERVED_NAMES else name or 'root'
+
+        if '$ref' in schema:
+            return self._add_rule(rule_name, self._resolve_ref(schema['$ref']))
+        elif 'oneOf' in schema or 'anyOf' in schema:
+            return self._add_rule(rule_name, self._generate_union_rule(name, schema['oneOf'] if 'oneOf' in schema else schema['anyOf']))
+        elif isinstance(schema_type, list):
+            return self._add_rule(rule_name, self._generate_union_rule(name, [{**schema, 'type': t} for t in schema_type]))
+        elif 'const' in schema:
+            return self._add_rule(rule_name, format_literal(dump_json(schema['const'])) + ' space')
+        elif 'enum' in schema:
+            rule = '(' + ' | '.join(format_literal(dump_json(v)) for v in schema['enum']) + ') space'
+            return self._add_rule(rule_name, rule)
+        elif schema_type in (None, 'object') and \
+                ('properties' in schema or ('additionalProperties' in schema and schema['additionalProperties'] is not True)):
+            required = set(item for item in schema.get('required', []) if isinstance(item, str)) if isinstance(schema.get('required'), list) else set()
+            properties = list(schema.get('properties', {}).items())
+            return self._add_rule(rule_name, self._build_object_rule(properties, required, name, schema.get('additionalProperties')))
+        elif schema_type in (None, 'object') and 'allOf' in schema:
+            required = set()
+            properties = []
+
+            def add_component(comp_schema, is_required):
+                if '$ref' in comp_schema:
+                    add_component(self._refs.get(comp_schema['$ref'], {}), is_required)
+                elif 'properties' in comp_schema:
+                    for prop_name, prop_schema in comp_schema['properties'].items():
+                        properties.append((prop_name, prop_schema))
+                        if is_required:
+                            required.add(prop_name)
+
+            for t in schema['allOf']:
+                if 'anyOf' in t:
+                    for tt in t['anyOf']:
+                        add_component(tt, False)
+                else:
+                    add_component(t, True)
+
+            return self._add_rule(rule_name, self._build_object_rule(properties, required, name, None))
+        elif schema_type in (None, 'array') and ('items' in schema or 'prefixItems' in schema):
+            items = schema.get('items') if 'items' in schema else schema['prefixItems']
+            if isinstance(items, list):
+                rule = '"[" space '
+                rule += ' "," space '.join(self.visit(item, f'{name}{"-" if name else ""}tuple-{i}') for i, item in enumerate(items))
+                rule += ' "]" space'
+                return self._add_rule(rule_name, rule)
+            else:
+                item_rule_name = self.visit(items, f'{name}{"-" if name else ""}item')
+                min_items = schema.get('minItems', 0)
+                max_items = schema.get('maxItems')
+                max_items = max_items if isinstance(max_items, int) and not isinstance(max_items, bool) else None
+                return self._add_rule(rule_name, '"[" space ' + build_repetition(item_rule_name, min_items, max_items, separator_rule='"," space') + ' "]" space')
+        elif schema_type in (None, 'string') and 'pattern' in schema:
+            return self._visit_pattern(schema['pattern'], rule_name)
+        elif schema_type in (None, 'string') and UUID_FORMAT_RE.match(schema_format):
+            return self._add_primitive('root' if rule_name == 'root' else schema_format, PRIMITIVE_RULES['uuid'])
+        elif schema_type in (None, 'string') and f'{schema_format}-string' in STRING_FORMAT_RULES:
+            prim_name = f'{schema_format}-string'
+            return self._add_rule(rule_name, self._add_primitive(prim_name, STRING_FORMAT_RULES[prim_name]))
+        elif schema_type == 'string' and ('minLength' in schema or 'maxLength' in schema):
+            char_rule = self._add_primitive('char', PRIMITIVE_RULES['char'])
+            min_len = schema.get('minLength', 0)
+            max_len = schema.get('maxLength')
+            return self._add_rule(rule_name, '"\\"" ' + build_repetition(char_rule, min_len, max_len) + ' "\\"" space')
+        elif schema_type == 'integer' and ('minimum' in schema or 'exclusiveMinimum' in schema or 'maximum' in schema or 'exclusiveMaximum' in schema):
+            min_value = None
+            max_value = None
+            if 'minimum' in schema:
+                min_value = int(schema['minimum'])
+            elif 'exclusiveMinimum' in schema:
+                min_value = int(schema['exclusiveMinimum']) + 1
+            if 'maximum' in schema:
+                max_value = int(schema['maximum'])
+            elif 'exclusiveMaximum' in schema:
+                max_value = int(schema['exclusiveMaximum']) - 1
+            out = ['(']
+            _build_min_max_int(min_value, max_value, out)
+            out.append(') space')
+            return self._add_rule(rule_name, ''.join(out))
+        elif not schema or schema_type == 'object':
+            return self._add_rule(rule_name, self._add_primitive('object', PRIMITIVE_RULES['object']))
+        else:
+            if not isinstance(schema_type, str) or schema_type not in PRIMITIVE_RULES:
+                self._errors.append(f'Unrecognized schema: {dump_json(schema)}')
+                return ''
+            return self._add_primitive('root' if rule_name == 'root' else schema_type, PRIMITIVE_RULES[schema_type])
+
+    def check_errors(self):
+        if self._errors:
+            raise ValueError('JSON schema conversion failed:\n' + '\n'.join(self._errors))
+        return self._warnings
+
+    def format_grammar(self):
+        return ''.join(f'{name} ::= {rule}\n' for name, rule in sorted(self._rules.items()))
+
+
+def json_schema_to_grammar(schema):
+    """Converts a JSON schema (a parsed dict) to a GBNF grammar, raising ValueError if it cannot be converted."""
+    converter = SchemaConverter()
+    schema = converter.resolve_refs(json.loads(json.dumps(schema)), 'input')
+    converter.visit(schema, '')
+    converter.check_errors()
+    return converter.format_grammar()
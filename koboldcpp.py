@@ -9,7 +9,7 @@
 # scenarios and everything Kobold and KoboldAI Lite have to offer.
 
 import ctypes
-import os, math, re
+import os, math, re, heapq, hashlib, collections, array, functools, contextvars, bisect, queue
 import argparse
 import platform
 import base64
@@ -17,6 +17,8 @@ import struct
 import json
 import sys
 import http.server
+import http.client
+import io
 import time
 import asyncio
 import socket
@@ -24,6 +26,7 @@ import threading
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from gguf import gguf_reader
+from gguf.constants import GGUFValueType, Keys, GGML_QUANT_SIZES
 
 # constants
 sampler_order_max = 7
@@ -54,8 +57,6 @@ fullwhispermodelpath = "" #if empty, it's not initialized
 maxctx = 4096
 maxhordectx = 4096
 maxhordelen = 400
-modelbusy = threading.Lock()
-requestsinqueue = 0
 defaultport = 5001
 KcppVersion = "1.80.3"
 showdebug = True
@@ -77,6 +78,12 @@ runmode_untouched = True
 modelfile_extracted_meta = None
 importvars_in_progress = False
 has_multiplayer = False
+has_reuse_stats = False #false if the loaded library cannot report fast forward reuse
+has_logprob_columns = False #false if the loaded library can only return logprobs as per token structs
+has_grammar_cache = False #false if the loaded library cannot compile grammars ahead of a request
+prefix_routing_chars = 16384 #how much of a prompt is tokenized to compare prefixes when queueing
+max_tokenize_len = 1048576 #largest token array accepted from or sent to the tokenizer, set by --tokenizelimit
+max_tokenize_batch = 256 #most prompts accepted by one batch tokenize request
 multiplayer_story_data_compressed = None #stores the full compressed story of the current multiplayer session
 multiplayer_turn_major = 1 # to keep track of when a client needs to sync their stories
 multiplayer_turn_minor = 1
@@ -111,6 +118,7 @@ VKDevicesNames = ["","","",""]
 VKIsDGPU = [0,0,0,0]
 MaxMemory = [0]
 MaxFreeMemory = [0]
+GPUDeviceMemory = [] # (total, free) bytes of each detected cuda/rocm device
 
 class logit_bias(ctypes.Structure):
     _fields_ = [("token_id", ctypes.c_int32),
@@ -130,6 +138,15 @@ class logprob_item(ctypes.Structure):
 class last_logprobs_outputs(ctypes.Structure):
     _fields_ = [("count", ctypes.c_int),
                 ("logprob_items", ctypes.POINTER(logprob_item))]
+# the same top picks flattened into columns, stride entries per token in the top_ arrays
+class logprob_columns_outputs(ctypes.Structure):
+    _fields_ = [("count", ctypes.c_int),
+                ("stride", ctypes.c_int),
+                ("selected_ids", ctypes.POINTER(ctypes.c_int)),
+                ("selected_logprobs", ctypes.POINTER(ctypes.c_float)),
+                ("option_counts", ctypes.POINTER(ctypes.c_int)),
+                ("top_ids", ctypes.POINTER(ctypes.c_int)),
+                ("top_logprobs", ctypes.POINTER(ctypes.c_float))]
 
 class load_model_inputs(ctypes.Structure):
     _fields_ = [("threads", ctypes.c_int),
@@ -269,12 +286,1034 @@ class whisper_generation_inputs(ctypes.Structure):
     _fields_ = [("prompt", ctypes.c_char_p),
                 ("audio_data", ctypes.c_char_p),
                 ("suppress_non_speech", ctypes.c_bool),
-                ("quiet", ctypes.c_bool)]
+                ("quiet", ctypes.c_bool),
+                ("audio_bytes", ctypes.c_void_p),
+                ("audio_bytes_len", ctypes.c_int)]
 
 class whisper_generation_outputs(ctypes.Structure):
     _fields_ = [("status", ctypes.c_int),
                 ("data", ctypes.c_char_p)]
 
+# Request scheduler that sits in front of the backend, replacing the old single modelbusy lock.
+# Waiting requests are kept in a bounded priority queue ordered by (priority, times this client
+# was already served, arrival order), so one client spamming requests cannot starve the others.
+# --slots sets the slot count, but the text backend holds a single generation context and is
+# not reentrant, so it is capped to max_backend_slots for now.
+# Requests may carry the token ids of their prompt prefix; among waiters of equal priority the one
+# sharing the longest prefix with the last granted prompt goes first, so fast forward can reuse
+# the cached context. A waiter can be passed over at most max_skips times.
+class GenerationScheduler:
+    def __init__(self, slots=1, max_skips=3):
+        self.cond = threading.Condition()
+        self.slot_busy = [False] * max(1, slots)
+        self.slot_genkey = [""] * max(1, slots) #last genkey that ran in each slot, kept after release for polling
+        self.slot_start = [0.0] * max(1, slots)
+        self.waiting = [] #heap of [priority, served, seq, ticket]
+        self.served = {} #per client grant counts, reset whenever the scheduler goes idle
+        self.seq = 0
+        self.avg_job_time = 0.0
+        self.total_jobs = 0
+        self.max_wait_time = 0.0
+        self.max_skips = max_skips
+        self.context_ids = [] #prefix ids of the most recently granted request
+        self.context_fn = None #computes context_ids when the granted request was not tokenized yet
+        self.reordered = 0
+        self.reused_tokens = 0
+        self.reprocessed_tokens = 0
+
+    def configure(self, slots):
+        with self.cond:
+            slots = max(1, slots)
+            while len(self.slot_busy) < slots:
+                self.slot_busy.append(False)
+                self.slot_genkey.append("")
+                self.slot_start.append(0.0)
+            while len(self.slot_busy) > slots and not self.slot_busy[-1]:
+                self.slot_busy.pop()
+                self.slot_genkey.pop()
+                self.slot_start.pop()
+            self.cond.notify_all()
+
+    def total_slots(self):
+        return len(self.slot_busy)
+
+    def busy_slots(self):
+        return sum(1 for b in self.slot_busy if b)
+
+    def locked(self): #kept for compatibility with the old lock based checks, true when no slot is free
+        return self.busy_slots() >= self.total_slots()
+
+    def queue_length(self):
+        return len(self.waiting)
+
+    def _free_slot(self):
+        for i, busy in enumerate(self.slot_busy):
+            if not busy:
+                return i
+        return -1
+
+    def _grant(self, client):
+        slot = self._free_slot()
+        self.slot_busy[slot] = True
+        self.slot_start[slot] = time.time()
+        self.served[client] = self.served.get(client, 0) + 1
+        return slot
+
+    @staticmethod
+    def common_prefix_len(a, b):
+        n = min(len(a), len(b))
+        i = 0
+        while i < n and a[i] == b[i]:
+            i += 1
+        return i
+
+    def _next_entry(self):
+        head = self.waiting[0]
+        if head[3]["skipped"] >= self.max_skips:
+            return head
+        best = head
+        for entry in self.waiting:
+            if entry[0] == head[0] and (entry[3]["reuse"], -entry[1], -entry[2]) > (best[3]["reuse"], -best[1], -best[2]):
+                best = entry
+        return best
+
+    def _set_context(self, prefix_ids, prefix_fn=None):
+        if prefix_ids is None:
+            if prefix_fn is not None: #computed only once some request has to wait
+                self.context_ids = []
+                self.context_fn = prefix_fn
+            return
+        self.context_ids = prefix_ids
+        self.context_fn = None
+        for entry in self.waiting:
+            entry[3]["reuse"] = self.common_prefix_len(entry[3]["prefix_ids"], prefix_ids)
+
+    def acquire(self, client="", priority=0, blocking=True, maxqueue=0, prefix_ids=None, prefix_fn=None):
+        # returns a slot index, or None if the request should be rejected as busy. Prefix ids can be
+        # given as prefix_fn, which is only called (outside the lock) if the request has to wait.
+        with self.cond:
+            if not self.waiting and self._free_slot() >= 0:
+                self._set_context(prefix_ids, prefix_fn)
+                return self._grant(client)
+            if not blocking or (maxqueue > 0 and len(self.waiting) >= maxqueue):
+                return None
+            context_fn = self.context_fn
+        if prefix_ids is None and prefix_fn is not None:
+            prefix_ids = prefix_fn()
+        context_ids = context_fn() if context_fn is not None else None
+        with self.cond:
+            if context_fn is not None and self.context_fn is context_fn:
+                self._set_context(context_ids)
+            if not self.waiting and self._free_slot() >= 0: #freed while the ids were computed
+                self._set_context(prefix_ids)
+                return self._grant(client)
+            if maxqueue > 0 and len(self.waiting) >= maxqueue:
+                return None
+            self.seq += 1
+            ticket = {"client":client, "priority":priority, "queued_at":time.time(), "skipped":0,
+            "prefix_ids":(prefix_ids or []), "reuse":self.common_prefix_len(prefix_ids or [], self.context_ids)}
+            heapq.heappush(self.waiting, [priority, self.served.get(client, 0), self.seq, ticket])
+            while True:
+                if self._free_slot() >= 0:
+                    entry = self._next_entry()
+                    if entry[3] is ticket:
+                        break
+                self.cond.wait()
+            if self.waiting[0] is not entry:
+                self.waiting[0][3]["skipped"] += 1
+                self.reordered += 1
+            self.waiting.remove(entry)
+            heapq.heapify(self.waiting)
+            self.max_wait_time = max(self.max_wait_time, time.time() - ticket["queued_at"])
+            self._set_context(prefix_ids)
+            slot = self._grant(client)
+            self.cond.notify_all() #another slot may still be free for the next waiter
+            return slot
+
+    def record_reuse(self, reused, reprocessed):
+        with self.cond:
+            self.reused_tokens += reused
+            self.reprocessed_tokens += reprocessed
+
+    def release(self, slot):
+        with self.cond:
+            if slot is None or not self.slot_busy[slot]:
+                return
+            jobtime = time.time() - self.slot_start[slot]
+            self.avg_job_time = jobtime if self.total_jobs == 0 else (self.avg_job_time * 0.8 + jobtime * 0.2)
+            self.total_jobs += 1
+            self.slot_busy[slot] = False
+            if not self.waiting and self.busy_slots() == 0:
+                self.served.clear()
+            self.cond.notify_all()
+
+    def assign_genkey(self, slot, genkey):
+        if slot is not None:
+            self.slot_genkey[slot] = genkey
+
+    def owns_genkey(self, genkey):
+        return genkey!="" and genkey in self.slot_genkey
+
+    def estimate_wait(self, position):
+        return round(self.avg_job_time * (position // self.total_slots() + 1), 2)
+
+    def get_stats(self):
+        with self.cond:
+            entries = sorted(self.waiting)
+            now = time.time()
+            return {"total_slots": self.total_slots(), "busy_slots": self.busy_slots(), "queue": len(entries),
+            "avg_job_time": round(self.avg_job_time, 3), "max_wait_time": round(self.max_wait_time, 3),
+            "queue_eta": (self.estimate_wait(len(entries)) if self.locked() else 0),
+            "reordered": self.reordered, "reused_tokens": self.reused_tokens, "reprocessed_tokens": self.reprocessed_tokens,
+            "queue_entries": [{"position": n, "priority": e[0], "waited": round(now - e[3]["queued_at"], 2), "eta": self.estimate_wait(n), "prefix_reuse": e[3]["reuse"]} for n, e in enumerate(entries)]}
+
+max_backend_slots = 1
+modelbusy = GenerationScheduler(slots=1)
+
+def get_multiuser_limits(): #returns (multiuser mode, max queued requests)
+    muint = int(args.multiuser)
+    if muint<=0 and ((args.whispermodel and args.whispermodel!="") or (args.sdmodel and args.sdmodel!="")):
+        muint = 2 # this prevents errors when using voice/img together with text
+    multiuserlimit = ((muint-1) if muint > 1 else 6)
+    #backwards compatibility for up to 7 concurrent requests, use default limit of 7 if multiuser set to 1
+    return muint, multiuserlimit
+
+# Receives stream events pushed from the backend generation thread (see set_stream_callback)
+# and wakes any waiting SSE writers, so tokens are flushed as soon as they exist.
+class TokenStreamNotifier:
+    STARTED = 0
+    NEW_TOKENS = 1
+    FINISHED = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.supported = False #false if the loaded library predates set_stream_callback
+        self.listeners = []
+        self.generation_seq = 0
+        self.token_times = []
+        self.emitted_tokens = 0
+        self.total_emit_delay = 0.0
+        self.max_emit_delay = 0.0
+        self.last_emit_delay = 0.0
+
+    def on_backend_event(self, event, token_count):
+        now = time.perf_counter()
+        with self.lock:
+            if event == self.STARTED:
+                self.generation_seq += 1
+                self.token_times = []
+            while len(self.token_times) < token_count:
+                self.token_times.append(now)
+            listeners = list(self.listeners)
+        for loop, evt in listeners:
+            loop.call_soon_threadsafe(evt.set)
+
+    def subscribe(self, loop):
+        evt = asyncio.Event()
+        with self.lock:
+            self.listeners.append((loop, evt))
+        return evt
+
+    def unsubscribe(self, evt):
+        with self.lock:
+            self.listeners = [item for item in self.listeners if item[1] is not evt]
+
+    def record_emitted(self, start, end): #tokens [start,end) were just flushed to a client
+        now = time.perf_counter()
+        with self.lock:
+            for i in range(start, min(end, len(self.token_times))):
+                delay = now - self.token_times[i]
+                self.emitted_tokens += 1
+                self.total_emit_delay += delay
+                self.max_emit_delay = max(self.max_emit_delay, delay)
+                self.last_emit_delay = delay
+
+    def get_stats(self):
+        return {"push_enabled": self.supported, "emitted_tokens": self.emitted_tokens,
+        "avg_emit_delay": (self.total_emit_delay / self.emitted_tokens if self.emitted_tokens > 0 else 0),
+        "max_emit_delay": self.max_emit_delay, "last_emit_delay": self.last_emit_delay}
+
+stream_notifier = TokenStreamNotifier()
+stream_callback_type = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_int)
+stream_callback_ref = stream_callback_type(stream_notifier.on_backend_event) #must stay referenced while the library is loaded
+
+# Process wide pool for blocking backend calls (text, image and audio generation). The scheduler
+# already serializes access to the model, so a few workers are enough and the thread count
+# stays fixed no matter how much traffic arrives.
+class GenerationExecutor:
+    def __init__(self, max_workers=4):
+        self.lock = threading.Lock()
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kcpp_gen")
+        self.active = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.closed = False
+
+    def submit(self, fn, *args, **kwargs):
+        queued_at = time.perf_counter()
+        context = contextvars.copy_context() #keeps the caller's request trace current in the worker
+        def tracked():
+            waited = time.perf_counter() - queued_at
+            trace_add("executor_wait", queued_at)
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+                    if not ok:
+                        self.failed += 1
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Generation executor has been shut down")
+            self.queued += 1
+        try:
+            future = self.pool.submit(context.run, tracked)
+        except RuntimeError:
+            with self.lock:
+                self.queued -= 1
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        # a future cancelled while still queued, e.g. by shutdown, never reaches tracked()
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def run(self, fn, *args, **kwargs): #blocking call from a request thread
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def run_async(self, fn, *args, **kwargs): #awaitable call from an event loop
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=False):
+        with self.lock:
+            self.closed = True
+        self.pool.shutdown(wait=wait, cancel_futures=True)
+
+    def get_stats(self):
+        with self.lock:
+            started = self.completed + self.active
+            return {"max_workers": self.max_workers, "active": self.active, "queued": self.queued,
+            "completed": self.completed, "failed": self.failed, "max_wait": round(self.max_wait, 3),
+            "avg_wait": round(self.total_wait / started, 3) if started > 0 else 0}
+
+generation_executor = GenerationExecutor(max_workers=4)
+
+# Opt-in cache for deterministic text generations (--responsecache). A request is only cacheable
+# when its output cannot vary: temperature <= 0 or a fixed sampler_seed, not streamed and without
+# logprobs. Entries are keyed on a hash of the transformed genparams plus the loaded model and
+# prompt template, and evicted least recently used first once over the byte budget or the TTL.
+class ResponseCache:
+    ignored_keys = ("genkey", "bypass_cache", "quiet")
+
+    def __init__(self, max_bytes=0, ttl=0):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() #key -> (stored_at, size, result)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def configure(self, max_bytes, ttl):
+        with self.lock:
+            self.max_bytes = max(0, max_bytes)
+            self.ttl = max(0, ttl)
+            self._evict()
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def make_key(self, genparams, stream_flag):
+        # returns None if this request must not be served from or stored in the cache
+        if not self.enabled():
+            return None
+        if genparams.get("bypass_cache", False):
+            with self.lock:
+                self.bypassed += 1
+            return None
+        if stream_flag or genparams.get("logprobs", False):
+            return None
+        temperature = genparams.get("temperature", 0.75)
+        seed = tryparseint(genparams.get("sampler_seed", -1))
+        deterministic = (isinstance(temperature, (int, float)) and temperature <= 0) or (isinstance(seed, int) and seed >= 0)
+        if not deterministic:
+            return None
+        try:
+            canonical = json.dumps({k: v for k, v in genparams.items() if k not in self.ignored_keys}, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            return None
+        identity = json.dumps([args.model_param, args.lora, friendlymodelname, maxctx, list(selected_template), koboldcpp_promt_template.ENABLE_TEMPLATE_PROCESSING], default=str)
+        return hashlib.sha256((identity + "\n" + canonical).encode("UTF-8", "ignore")).hexdigest()
+
+    def _evict(self):
+        now = time.time()
+        while self.entries:
+            key, (stored_at, size, _) = next(iter(self.entries.items()))
+            if self.current_bytes <= self.max_bytes and (self.ttl <= 0 or now - stored_at <= self.ttl):
+                break
+            del self.entries[key]
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl > 0 and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.current_bytes -= entry[1]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[2])
+
+    def put(self, key, result):
+        if result.get("status", 0) != 1:
+            return # never cache failed or aborted generations
+        size = len(result.get("text", "").encode("UTF-8", "ignore")) + 256 #rough per entry overhead
+        with self.lock:
+            if size > self.max_bytes:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self.entries[key] = (time.time(), size, dict(result))
+            self.current_bytes += size
+            self._evict()
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"enabled": self.enabled(), "entries": len(self.entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes,
+            "ttl": self.ttl, "hits": self.hits, "misses": self.misses, "bypassed": self.bypassed, "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0}
+
+response_cache = ResponseCache()
+
+# Cache in front of the tokenizer used by tokencount, tokenize and the other helpers that call
+# tokenize_ids. Long prompts are split into segments at line starts roughly every segment_chars
+# characters, and each segment's tokens are stored under a hash of all the text up to its end,
+# so a prompt that only differs at the tail reuses the unchanged leading segments and tokenizes
+# just the rest. Whether tokenizing segments separately gives the same ids as tokenizing the
+# whole text depends on the tokenizer, so every newly made cut is checked by tokenizing a small
+# window of text around it in one piece, and segmenting is switched off for the loaded model
+# (returning a full tokenization) the first time a window tokenizes differently across its cut.
+class TokenizationCache:
+    entry_overhead = 96 #rough per entry bookkeeping cost in bytes
+
+    def __init__(self, max_bytes=0, segment_chars=4096, verify_window=64):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() #(digest of text up to segment end, addspecial) -> array of the segment's ids
+        self.max_bytes = max_bytes
+        self.segment_chars = segment_chars
+        self.verify_window = verify_window
+        self.verified_cuts = 0
+        self.segmenting = True
+        self.current_bytes = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_chars = 0
+        self.tokenized_chars = 0
+
+    def configure(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max(0, max_bytes)
+            self._evict()
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def segment_ends(self, text):
+        # a cut is only made after a newline followed by a non whitespace character, so no word or run of
+        # whitespace is ever split, and each cut depends only on the text before it. The last end is len(text).
+        ends = []
+        if self.segmenting:
+            start = 0
+            while True:
+                pos = text.find("\n", start + self.segment_chars - 1)
+                while pos >= 0 and pos + 1 < len(text) and text[pos+1].isspace():
+                    pos = text.find("\n", pos + 1)
+                if pos < 0 or pos + 1 >= len(text):
+                    break
+                start = pos + 1
+                ends.append(start)
+        ends.append(len(text))
+        return ends
+
+    def _evict(self):
+        while self.entries and self.current_bytes > self.max_bytes:
+            _, seg = self.entries.popitem(last=False)
+            self.current_bytes -= len(seg) * seg.itemsize + self.entry_overhead
+            self.evictions += 1
+
+    def _disable_segmenting(self):
+        with self.lock:
+            if self.segmenting:
+                utfprint("Tokenization cache: segmented tokenization does not match this tokenizer, only whole prompts will be cached.", "warning")
+            self.segmenting = False
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def cut_is_safe(self, text, cut, tokenizer):
+        # tokens never merge across the cut if the window around it tokenizes the same in one piece
+        left = text[max(0, cut - self.verify_window):cut]
+        right = text[cut:cut + self.verify_window]
+        return tokenizer(left + right, False) == tokenizer(left, False) + tokenizer(right, False)
+
+    def tokenize(self, text, addspecial, tokenizer):
+        if not self.enabled():
+            return tokenizer(text, addspecial)
+        ends = self.segment_ends(text)
+        keys = []
+        hasher = hashlib.sha256()
+        start = 0
+        for end in ends:
+            hasher.update(text[start:end].encode("UTF-8", "surrogatepass"))
+            keys.append((hasher.digest(), bool(addspecial)))
+            start = end
+        segments = []
+        with self.lock:
+            for key in keys:
+                seg = self.entries.get(key)
+                if seg is None:
+                    break
+                self.entries.move_to_end(key)
+                segments.append(seg)
+        cached = len(segments)
+        reused = ends[cached-1] if cached > 0 else 0
+
+        if cached < len(keys):
+            start = reused
+            for i in range(cached, len(ends)):
+                segments.append(array.array('i', tokenizer(text[start:ends[i]], addspecial and i == 0)))
+                start = ends[i]
+        ids = array.array('i')
+        for seg in segments:
+            ids.extend(seg)
+        ids = ids.tolist()
+
+        # cuts between two cached segments were checked when the later one was stored
+        newcuts = [ends[i-1] for i in range(max(cached, 1), len(ends))]
+        for cut in newcuts:
+            if not self.cut_is_safe(text, cut, tokenizer):
+                self._disable_segmenting()
+                return tokenizer(text, addspecial)
+
+        with self.lock:
+            self.verified_cuts += len(newcuts)
+            if cached == len(keys):
+                self.hits += 1
+            elif cached > 0:
+                self.partial_hits += 1
+            else:
+                self.misses += 1
+            self.reused_chars += reused
+            self.tokenized_chars += len(text) - reused
+            for key, seg in zip(keys[cached:], segments[cached:]):
+                size = len(seg) * seg.itemsize + self.entry_overhead
+                if size > self.max_bytes or key in self.entries or (len(keys) > 1 and not self.segmenting):
+                    continue
+                self.entries[key] = seg
+                self.current_bytes += size
+            self._evict()
+        return ids
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.partial_hits + self.misses
+            totalchars = self.reused_chars + self.tokenized_chars
+            return {"enabled": self.enabled(), "segmenting": self.segmenting, "verified_cuts": self.verified_cuts, "entries": len(self.entries), "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes, "hits": self.hits, "partial_hits": self.partial_hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0,
+            "reused_char_rate": round(self.reused_chars / totalchars, 3) if totalchars > 0 else 0}
+
+tokenize_cache = TokenizationCache(max_bytes=32*1024*1024)
+
+# Saved backend context states (KV cache plus the tokens it holds), keyed by a name or by a hash
+# of the token prefix. Restoring one lets fast forward skip re-processing a long fixed prefix such
+# as a system prompt and character card. Snapshots live in RAM and, if a directory is configured,
+# spill to disk when evicted; both tiers are bounded and evicted least recently used first.
+# All backend calls must be made while holding a scheduler slot.
+class ContextSnapshotManager:
+    def __init__(self, max_ram_bytes=0, max_disk_bytes=0, disk_dir=""):
+        self.lock = threading.Lock()
+        self.ram = collections.OrderedDict() #name -> {"tokens", "data", "size", "created"}
+        self.disk = collections.OrderedDict() #name -> {"path", "size", "token_count", "created"}
+        self.max_ram_bytes = max_ram_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_dir = disk_dir
+        self.ram_bytes = 0
+        self.disk_bytes = 0
+        self.saves = 0
+        self.restores = 0
+        self.restore_failures = 0
+        self.evictions = 0
+        self.supported = False #false if the loaded library cannot save states
+
+    def configure(self, max_ram_bytes, max_disk_bytes=0, disk_dir=""):
+        with self.lock:
+            self.max_ram_bytes = max(0, max_ram_bytes)
+            self.max_disk_bytes = max(0, max_disk_bytes) if disk_dir else 0
+            self.disk_dir = disk_dir
+            if self.max_disk_bytes > 0:
+                os.makedirs(disk_dir, exist_ok=True)
+            self._evict()
+
+    def enabled(self):
+        return self.supported and self.max_ram_bytes > 0
+
+    @staticmethod
+    def hash_tokens(tokens):
+        return "prefix-" + hashlib.sha256(struct.pack(f"<{len(tokens)}i", *tokens)).hexdigest()[:24]
+
+    def _disk_path(self, name):
+        return os.path.join(self.disk_dir, hashlib.sha256(name.encode("UTF-8")).hexdigest() + ".kvstate")
+
+    def _spill(self, name, entry):
+        if self.max_disk_bytes <= 0 or entry["size"] > self.max_disk_bytes:
+            return
+        path = self._disk_path(name)
+        header = json.dumps({"name": name, "tokens": entry["tokens"], "created": entry["created"]}).encode("UTF-8")
+        try:
+            with open(path, "wb") as f:
+                f.write(struct.pack("<Q", len(header)))
+                f.write(header)
+                f.write(entry["data"])
+        except OSError as e:
+            utfprint(f"Could not write context snapshot to disk: {e}", "warning")
+            return
+        self.disk[name] = {"path": path, "size": entry["size"], "token_count": len(entry["tokens"]), "created": entry["created"]}
+        self.disk_bytes += entry["size"]
+
+    def _drop_disk(self, name):
+        entry = self.disk.pop(name, None)
+        if entry is not None:
+            self.disk_bytes -= entry["size"]
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.ram and self.ram_bytes > self.max_ram_bytes:
+            name, entry = self.ram.popitem(last=False)
+            self.ram_bytes -= entry["size"]
+            self.evictions += 1
+            self._spill(name, entry)
+        while self.disk and self.disk_bytes > self.max_disk_bytes:
+            self._drop_disk(next(iter(self.disk)))
+            self.evictions += 1
+
+    def _load_from_disk(self, name):
+        entry = self.disk.get(name)
+        if entry is None:
+            return None
+        try:
+            with open(entry["path"], "rb") as f:
+                headerlen = struct.unpack("<Q", f.read(8))[0]
+                header = json.loads(f.read(headerlen).decode("UTF-8"))
+                data = f.read()
+        except (OSError, ValueError, struct.error) as e:
+            utfprint(f"Could not read context snapshot from disk: {e}", "warning")
+            self._drop_disk(name)
+            return None
+        self._drop_disk(name)
+        return {"tokens": header["tokens"], "data": data, "size": len(data), "created": header["created"]}
+
+    def save(self, name=None):
+        # snapshot the current backend context, returns a summary dict or None if nothing to save
+        if not self.enabled():
+            return None
+        tokens = get_context_ids()
+        if not tokens:
+            return None
+        size = handle.get_state_size()
+        if size <= 0 or size > self.max_ram_bytes:
+            return None
+        buf = ctypes.create_string_buffer(size)
+        written = handle.save_state(buf, size)
+        if written <= 0:
+            return None
+        name = name if name else self.hash_tokens(tokens)
+        entry = {"tokens": tokens, "data": buf.raw[:written], "size": written, "created": time.time()}
+        with self.lock:
+            old = self.ram.pop(name, None)
+            if old is not None:
+                self.ram_bytes -= old["size"]
+            self._drop_disk(name)
+            self.ram[name] = entry
+            self.ram_bytes += written
+            self.saves += 1
+            self._evict()
+        return {"name": name, "tokens": len(tokens), "size": written}
+
+    def restore(self, name):
+        # load a snapshot back into the backend, skipped if the context already starts with it
+        if not self.enabled():
+            return False
+        with self.lock:
+            entry = self.ram.get(name)
+            if entry is None:
+                entry = self._load_from_disk(name)
+                if entry is not None:
+                    self.ram[name] = entry
+                    self.ram_bytes += entry["size"]
+                    self._evict()
+            else:
+                self.ram.move_to_end(name)
+        if entry is None:
+            return False
+        current = get_context_ids()
+        if len(current) >= len(entry["tokens"]) and current[:len(entry["tokens"])] == entry["tokens"]:
+            return True
+        tokarr, keepalive = token_outputs_from_ids(entry["tokens"])
+        ok = handle.load_state(entry["data"], entry["size"], tokarr)
+        with self.lock:
+            if ok:
+                self.restores += 1
+            else:
+                self.restore_failures += 1
+        return ok
+
+    def delete(self, name):
+        with self.lock:
+            entry = self.ram.pop(name, None)
+            if entry is not None:
+                self.ram_bytes -= entry["size"]
+            found = entry is not None or name in self.disk
+            self._drop_disk(name)
+            return found
+
+    def get_stats(self):
+        with self.lock:
+            return {"enabled": self.enabled(), "ram_entries": len(self.ram), "ram_bytes": self.ram_bytes, "max_ram_bytes": self.max_ram_bytes,
+            "disk_entries": len(self.disk), "disk_bytes": self.disk_bytes, "max_disk_bytes": self.max_disk_bytes,
+            "saves": self.saves, "restores": self.restores, "restore_failures": self.restore_failures, "evictions": self.evictions,
+            "snapshots": [{"name": n, "tokens": len(e["tokens"]), "size": e["size"], "tier": "ram"} for n, e in self.ram.items()]
+            + [{"name": n, "tokens": e["token_count"], "size": e["size"], "tier": "disk"} for n, e in self.disk.items()]}
+
+context_snapshots = ContextSnapshotManager()
+
+# Per endpoint byte and latency totals for POST requests, reported under "requests" in /api/extra/perf.
+class RequestAccounting:
+    def __init__(self, max_endpoints=64):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.max_endpoints = max_endpoints
+
+    def record(self, path, bytes_in, bytes_out, read_time, total_time):
+        key = path.split("?", 1)[0]
+        with self.lock:
+            if key not in self.endpoints and len(self.endpoints) >= self.max_endpoints:
+                key = "other"
+            stats = self.endpoints.setdefault(key, {"requests": 0, "bytes_in": 0, "bytes_out": 0, "read_time": 0.0, "total_time": 0.0, "max_time": 0.0})
+            stats["requests"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["read_time"] += read_time
+            stats["total_time"] += total_time
+            stats["max_time"] = max(stats["max_time"], total_time)
+
+    def get_stats(self):
+        with self.lock:
+            return {key: {"requests": s["requests"], "bytes_in": s["bytes_in"], "bytes_out": s["bytes_out"],
+            "avg_read_time": round(s["read_time"] / s["requests"], 4), "avg_time": round(s["total_time"] / s["requests"], 4),
+            "max_time": round(s["max_time"], 4)} for key, s in self.endpoints.items()}
+
+request_accounting = RequestAccounting()
+
+# Latency spans for individual requests. A trace is opened when a POST arrives and made current
+# through a context variable, which follows the request onto the event loop and into executor
+# workers, so any stage can record a span with trace_span or trace_add. Finished traces of
+# generation, image and transcription requests are kept in a ring buffer and served by
+# /api/extra/trace as json, or in the chrome trace event format for chrome://tracing and Perfetto.
+class RequestTrace:
+    def __init__(self, trace_id, path):
+        self.trace_id = trace_id
+        self.path = path
+        self.kind = "" #set once the request is known to reach a model
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.duration = 0.0
+        self.spans = [] #[name, start offset, duration, thread name, args]
+        self.accumulated = {} #name -> span, for stages that repeat many times per request
+
+    def add(self, name, start, end, args=None):
+        self.spans.append([name, start - self.start, end - start, threading.current_thread().name, args])
+
+    def accumulate(self, name, start, end):
+        # folds repeated short stages (like sse flushes) into one span holding the summed time and a count
+        span = self.accumulated.get(name)
+        if span is None:
+            span = self.accumulated[name] = [name, start - self.start, 0.0, threading.current_thread().name, {"count": 0}]
+            self.spans.append(span)
+        span[2] += end - start
+        span[4]["count"] += 1
+
+    def to_dict(self):
+        return {"id": self.trace_id, "path": self.path, "kind": self.kind, "started": self.wall_start, "duration": round(self.duration, 6),
+        "spans": [{"name": n, "start": round(st, 6), "duration": round(d, 6), "thread": t, **({"args": a} if a else {})} for n, st, d, t, a in self.spans]}
+
+class RequestTracer:
+    def __init__(self, capacity=128):
+        self.lock = threading.Lock()
+        self.traces = collections.deque(maxlen=max(1, capacity))
+        self.capacity = capacity
+        self.next_id = 1
+        self.current = contextvars.ContextVar("kcpp_request_trace", default=None)
+
+    def configure(self, capacity):
+        with self.lock:
+            self.capacity = max(0, capacity)
+            self.traces = collections.deque(self.traces, maxlen=max(1, self.capacity))
+
+    def enabled(self):
+        return self.capacity > 0
+
+    def begin(self, path):
+        # starts a trace and makes it current, returns None when tracing is off
+        if not self.enabled():
+            return None
+        with self.lock:
+            trace = RequestTrace(self.next_id, path.split("?", 1)[0])
+            self.next_id += 1
+        self.current.set(trace)
+        return trace
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        trace.duration = time.perf_counter() - trace.start
+        self.current.set(None)
+        if trace.kind:
+            with self.lock:
+                self.traces.append(trace)
+
+    def get_traces(self, limit=0):
+        with self.lock:
+            traces = list(self.traces)
+        return traces[-limit:] if limit > 0 else traces
+
+    def get_summary(self):
+        # duration percentiles per span name over the buffered traces, in milliseconds
+        durations = {"total": []}
+        for trace in self.get_traces():
+            durations["total"].append(trace.duration)
+            for span in trace.spans:
+                durations.setdefault(span[0], []).append(span[2])
+        summary = {}
+        for name, values in durations.items():
+            if not values:
+                continue
+            values.sort()
+            summary[name] = {"count": len(values), "avg_ms": round(sum(values) * 1000 / len(values), 3),
+            "p50_ms": round(values[len(values) // 2] * 1000, 3), "p99_ms": round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3)}
+        return summary
+
+    def to_chrome_trace(self, limit=0):
+        # one process per request, one row per thread that worked on it, timestamps in microseconds
+        events = []
+        for trace in self.get_traces(limit):
+            base = trace.wall_start * 1000000
+            pid = trace.trace_id
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"#{trace.trace_id} {trace.path}"}})
+            events.append({"name": trace.kind or "request", "cat": "request", "ph": "X", "pid": pid, "tid": 0, "ts": base, "dur": trace.duration * 1000000})
+            for name, start, duration, thread, args in trace.spans:
+                events.append({"name": name, "cat": trace.kind, "ph": "X", "pid": pid, "tid": thread, "ts": base + start * 1000000, "dur": duration * 1000000, "args": args or {}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+request_tracer = RequestTracer()
+
+class TraceSpan:
+    def __init__(self, name, args=None):
+        self.trace = request_tracer.current.get()
+        self.name = name
+        self.args = args
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+def trace_span(name, **kwargs): #records the duration of a with block on the current request's trace
+    return TraceSpan(name, kwargs or None)
+
+def trace_add(name, start, end=None, **kwargs): #records an already measured perf_counter interval
+    trace = request_tracer.current.get()
+    if trace is not None:
+        trace.add(name, start, time.perf_counter() if end is None else end, kwargs or None)
+
+# Counters and histograms for the /metrics endpoint, in the prometheus text exposition format.
+# Each thread updates its own shard without locking, so observing a value never contends with
+# other requests; a scrape sums the shards and folds those of finished threads into a retired
+# total. Gauges are read from their owners (scheduler, caches, executor) at scrape time.
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock() #only taken when a thread first records something, and by scrapes
+        self.local = threading.local()
+        self.shards = [] #(thread, shard)
+        self.retired = {}
+        self.definitions = {} #name -> (type, help, buckets)
+        self.gauges = [] #(name, help, callback returning [(labels, value)])
+
+    def define_counter(self, name, helptext):
+        self.definitions[name] = ("counter", helptext, None)
+
+    def define_histogram(self, name, helptext, buckets):
+        self.definitions[name] = ("histogram", helptext, tuple(buckets))
+
+    def define_gauge(self, name, helptext, callback):
+        self.gauges.append((name, helptext, callback))
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        # histogram entries hold per bucket counts (not cumulative), then the +Inf count and the sum
+        buckets = self.definitions[name][2]
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    @staticmethod
+    def _merge(total, shard):
+        for key, value in list(shard.items()):
+            if isinstance(value, list):
+                current = total.get(key)
+                total[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else: #a finished thread never writes again, so its shard can be folded in for good
+                    self._merge(self.retired, shard)
+            self.shards = alive
+            total = {}
+            self._merge(total, self.retired)
+            for _, shard in alive:
+                self._merge(total, shard)
+        return total
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        total = self.collect()
+        lines = []
+        for name, (mtype, helptext, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for (key, labels), value in sorted(((k, v) for k, v in total.items() if k[0] == name), key=lambda kv: kv[0][1]):
+                if mtype == "counter":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, ('le', repr(float(bound))))} {cumulative}")
+                cumulative += value[len(buckets)]
+                lines.append(f"{name}_bucket{self._labels(labels, ('le', '+Inf'))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, helptext, callback in self.gauges:
+            try:
+                values = callback()
+            except Exception:
+                continue
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in values:
+                lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+request_arrival = contextvars.ContextVar("kcpp_request_arrival", default=None) #perf_counter when the current request arrived
+api_format_names = {1: "basic", 2: "kai", 3: "oai", 4: "oai-chat", 5: "interrogate", 6: "ollama", 7: "ollamachat"}
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+metrics.define_counter("koboldcpp_requests_total", "Generation requests received, by api format.")
+metrics.define_counter("koboldcpp_rejected_requests_total", "Requests answered with 503, by reason.")
+metrics.define_counter("koboldcpp_aborts_total", "Generations aborted, by reason.")
+metrics.define_counter("koboldcpp_prompt_tokens_total", "Prompt tokens submitted to the text model.")
+metrics.define_counter("koboldcpp_generated_tokens_total", "Tokens generated by the text model.")
+metrics.define_histogram("koboldcpp_request_duration_seconds", "Time from request arrival until the response was sent, by api format.", latency_buckets)
+metrics.define_histogram("koboldcpp_time_to_first_token_seconds", "Time from request arrival until the first generated token.", latency_buckets)
+metrics.define_histogram("koboldcpp_prompt_tokens_per_second", "Prompt processing speed per generation.", (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+metrics.define_histogram("koboldcpp_generation_tokens_per_second", "Token generation speed per generation.", (1, 2.5, 5, 10, 20, 40, 60, 100, 200))
+metrics.define_histogram("koboldcpp_image_generation_seconds", "Duration of image generations.", latency_buckets)
+metrics.define_histogram("koboldcpp_transcription_seconds", "Duration of whisper transcriptions.", latency_buckets)
+metrics.define_histogram("koboldcpp_generation_seconds", "Duration of text generations in the backend, by grammar source.", latency_buckets)
+metrics.define_histogram("koboldcpp_grammar_compile_seconds", "Time spent converting json schemas to grammars, on cache misses.", (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+metrics.define_counter("koboldcpp_grammar_compiles_total", "JSON schema to grammar conversions, by result (ok, error or cached).")
+
+def metrics_cache_gauge():
+    values = []
+    for cachename, stats in (("response", response_cache.get_stats()), ("tokenize", tokenize_cache.get_stats())):
+        values.append(({"cache": cachename}, stats["hit_rate"]))
+    return values
+
+def metrics_cache_lookups():
+    values = []
+    for cachename, stats in (("response", response_cache.get_stats()), ("tokenize", tokenize_cache.get_stats())):
+        for result in ("hits", "partial_hits", "misses"):
+            if result in stats:
+                values.append(({"cache": cachename, "result": result}, stats[result]))
+    return values
+
+metrics.define_gauge("koboldcpp_queue_depth", "Requests waiting for the model (requestsinqueue).", lambda: [({}, modelbusy.queue_length())])
+metrics.define_gauge("koboldcpp_busy", "1 while a request holds the model.", lambda: [({}, 1 if modelbusy.locked() else 0)])
+metrics.define_gauge("koboldcpp_executor_jobs", "Generation executor jobs, by state.", lambda: [({"state": st}, generation_executor.get_stats()[st]) for st in ("active", "queued")])
+metrics.define_gauge("koboldcpp_cache_hit_ratio", "Hit ratio of the response and tokenization caches.", metrics_cache_gauge)
+metrics.define_gauge("koboldcpp_cache_lookups", "Lookups of the response and tokenization caches, by result.", metrics_cache_lookups)
+
 def getdirpath():
     return os.path.dirname(os.path.realpath(__file__))
 def getabspath():
@@ -437,6 +1476,47 @@ def init_library():
     handle.last_logprobs.restype = last_logprobs_outputs
     handle.detokenize.argtypes = [token_count_outputs]
     handle.detokenize.restype = ctypes.c_char_p
+    try:
+        global has_reuse_stats
+        handle.get_last_reused_tokens.restype = ctypes.c_int
+        handle.get_last_reprocessed_tokens.restype = ctypes.c_int
+        has_reuse_stats = True
+    except AttributeError:
+        has_reuse_stats = False
+    try:
+        global has_logprob_columns
+        handle.get_logprob_columns.argtypes = [ctypes.c_int, ctypes.c_int]
+        handle.get_logprob_columns.restype = logprob_columns_outputs
+        handle.get_token_piece.argtypes = [ctypes.c_int]
+        handle.get_token_piece.restype = ctypes.c_char_p
+        has_logprob_columns = True
+    except AttributeError:
+        has_logprob_columns = False
+    try:
+        global has_grammar_cache
+        handle.compile_grammar.argtypes = [ctypes.c_char_p]
+        handle.compile_grammar.restype = ctypes.c_int
+        handle.forget_grammar.argtypes = [ctypes.c_char_p]
+        has_grammar_cache = True
+    except AttributeError:
+        has_grammar_cache = False
+    try:
+        handle.get_context_tokens.restype = token_count_outputs
+        handle.get_state_size.restype = ctypes.c_size_t
+        handle.save_state.argtypes = [ctypes.c_char_p, ctypes.c_size_t]
+        handle.save_state.restype = ctypes.c_size_t
+        handle.load_state.argtypes = [ctypes.c_char_p, ctypes.c_size_t, token_count_outputs]
+        handle.load_state.restype = ctypes.c_bool
+        context_snapshots.supported = True
+    except AttributeError:
+        context_snapshots.supported = False
+    try:
+        handle.set_stream_callback.argtypes = [stream_callback_type]
+        handle.set_stream_callback.restype = None
+        handle.set_stream_callback(stream_callback_ref)
+        stream_notifier.supported = True
+    except AttributeError:
+        print("Note: This library does not support push based token streaming, falling back to polling.")
 
 def set_backend_props(inputs):
     clblastids = 0
@@ -562,81 +1642,454 @@ def exit_with_error(code, message, title="Error"):
     time.sleep(2)
     sys.exit(code)
 
-def utfprint(str):
-    maxlen = 32000
-    if args.debugmode >= 1:
-        maxlen = 64000
-    strlength = len(str)
-    if strlength > maxlen: #limit max output len
-        str = str[:maxlen] + f"... (+{strlength-maxlen} chars)"
-    try:
-        print(str)
-    except UnicodeEncodeError:
-        # Replace or omit the problematic character
-        utf_string = str.encode('ascii', 'ignore').decode('ascii',"ignore")
-        utf_string = utf_string.replace('\a', '') #remove bell characters
-        print(utf_string)
+# Level gated console logging for request dumps and other per request output. A message is
+# only formatted if its level is enabled, is truncated before it is queued, and is written by a
+# background thread, so request threads never wait on console i/o. Per request debug dumps can
+# also be sampled, logging only one request in every N. Records are plain text by default or
+# one json object per line with --logjson. Runtime console output goes through utfprint, so the
+# single writer queue keeps it in order.
+class KcppLogger:
+    levels = {"error": 40, "warning": 30, "info": 20, "debug": 10}
+
+    def __init__(self, level="info", max_chars=32000, sample_every=1, json_format=False, max_queued=2048):
+        self.level = self.levels[level]
+        self.max_chars = max_chars
+        self.sample_every = max(1, sample_every)
+        self.json_format = json_format
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.lock = threading.Lock()
+        self.writer = None
+        self.request_counter = 0
+        self.dropped = 0
+        self.sampled = contextvars.ContextVar("kcpp_log_sampled", default=True)
+
+    def configure(self, level=None, max_chars=None, sample_every=None, json_format=None):
+        if level is not None:
+            self.level = self.levels[level]
+        if max_chars is not None:
+            self.max_chars = max(0, max_chars)
+        if sample_every is not None:
+            self.sample_every = max(1, sample_every)
+        if json_format is not None:
+            self.json_format = json_format
+
+    def enabled(self, level):
+        return self.levels[level] >= self.level
+
+    def begin_request(self):
+        # decides once per request whether its debug dumps are logged, the decision follows the request's context
+        with self.lock:
+            self.request_counter += 1
+            sampled = (self.request_counter % self.sample_every) == 0 or self.sample_every <= 1
+        self.sampled.set(sampled)
+
+    def request_debug(self, event, message, *fmtargs):
+        if self.levels["debug"] >= self.level and self.sampled.get():
+            self.log("debug", event, message, *fmtargs)
+
+    def log(self, level, event, message, *fmtargs, max_chars=None):
+        if self.levels[level] < self.level:
+            return
+        if fmtargs:
+            message = message % fmtargs
+        limit = self.max_chars if max_chars is None else max_chars
+        if limit > 0 and len(message) > limit: #limit max output len
+            message = message[:limit] + f"... (+{len(message)-limit} chars)"
+        if self.json_format:
+            message = json.dumps({"time": round(time.time(), 3), "level": level, "event": event, "message": message}, ensure_ascii=False)
+        self._ensure_writer()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def debug(self, event, message, *fmtargs):
+        self.log("debug", event, message, *fmtargs)
+
+    def info(self, event, message, *fmtargs):
+        self.log("info", event, message, *fmtargs)
+
+    def warning(self, event, message, *fmtargs):
+        self.log("warning", event, message, *fmtargs)
+
+    def error(self, event, message, *fmtargs):
+        self.log("error", event, message, *fmtargs)
+
+    def _ensure_writer(self):
+        if self.writer is None:
+            with self.lock:
+                if self.writer is None:
+                    import atexit
+                    self.writer = threading.Thread(target=self._write_loop, name="kcpp_log", daemon=True)
+                    self.writer.start()
+                    atexit.register(self.flush)
+
+    def _write_loop(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if self.dropped > 0:
+                    with self.lock:
+                        dropped, self.dropped = self.dropped, 0
+                    self._write(f"[{dropped} log messages were dropped because the console could not keep up]")
+                self._write(message)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, message):
+        try:
+            print(message, flush=True)
+        except UnicodeEncodeError:
+            # Replace or omit the problematic character
+            utf_string = message.encode('ascii', 'ignore').decode('ascii',"ignore")
+            utf_string = utf_string.replace('\a', '') #remove bell characters
+            print(utf_string, flush=True)
+        except Exception:
+            pass
+
+    def flush(self):
+        if self.writer is not None:
+            self.queue.join()
+
+kcpp_log = KcppLogger()
+
+def utfprint(str, level="info"):
+    kcpp_log.log(level, "console", str)
 
 def bring_terminal_to_foreground():
     if os.name=='nt':
         ctypes.windll.user32.ShowWindow(ctypes.windll.kernel32.GetConsoleWindow(), 9)
         ctypes.windll.user32.SetForegroundWindow(ctypes.windll.kernel32.GetConsoleWindow())
 
-def string_has_overlap(str_a, str_b, maxcheck):
-    max_overlap = min(maxcheck, len(str_a), len(str_b))
-    for i in range(1, max_overlap + 1):
-        if str_a[-i:] == str_b[:i]:
-            return True
-    return False
+@functools.lru_cache(maxsize=64)
+def build_stop_automaton(sequences):
+    # aho-corasick trie over the stop sequences, returns per state (transitions, failure link,
+    # longest sequence ending here, depth). Built once per distinct stop list.
+    goto = [{}]
+    fail = [0]
+    match_len = [0]
+    depth = [0]
+    for seq in sequences:
+        state = 0
+        for ch in seq:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][ch] = nxt
+                goto.append({})
+                fail.append(0)
+                match_len.append(0)
+                depth.append(depth[state] + 1)
+            state = nxt
+        match_len[state] = max(match_len[state], len(seq))
+    queue = collections.deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, nxt in goto[state].items():
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            match_len[nxt] = max(match_len[nxt], match_len[fail[nxt]])
+            queue.append(nxt)
+    return goto, fail, match_len, depth
+
+# Incremental matcher for a request's stop sequences. Text is fed in as it streams, and the
+# matcher tracks the earliest start of any complete stop sequence seen so far plus how many
+# trailing characters could still be the beginning of one, which streaming must hold back.
+class StopSequenceMatcher:
+    def __init__(self, sequences):
+        sequences = tuple(dict.fromkeys(s for s in (sequences or []) if isinstance(s, str) and s != ""))
+        self.goto, self.fail, self.match_len, self.depth = build_stop_automaton(sequences)
+        self.state = 0
+        self.consumed = 0 #characters fed so far
+        self.match_start = -1 #offset of the earliest complete stop sequence, -1 if none yet
+
+    def feed(self, text):
+        goto, fail, match_len = self.goto, self.fail, self.match_len
+        state = self.state
+        pos = self.consumed
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            pos += 1
+            if match_len[state]:
+                start = pos - match_len[state]
+                if self.match_start < 0 or start < self.match_start:
+                    self.match_start = start
+        self.state = state
+        self.consumed = pos
+        return self.match_start
+
+    def held_chars(self):
+        # length of the longest suffix of the fed text that is a prefix of some stop sequence
+        return self.depth[self.state]
+
+    def trim(self, text):
+        # whole text in one go, cut at the earliest stop sequence
+        self.feed(text)
+        return text[:self.match_start] if self.match_start >= 0 else text
+
+GGUFModelShape = collections.namedtuple('GGUFModelShape', ['layers','head_count_kv','kv_length','head_count','embedding_length','context_length','expert_count','expert_used_count','file_type','architecture',
+    'feed_forward_length','vocab_size','input_bytes','output_bytes','layer_bytes'], defaults=(0,0,0,0,()))
+
+class GGUFHeaderParser:
+    # streams the KV section of a gguf file without mapping it. string arrays such as the vocab are
+    # skipped by walking their length prefixes, only small numeric arrays are kept (per-layer head counts)
+    chunk_size = 1024*1024
+    max_kept_array = 4096
+    scalar_formats = {
+        GGUFValueType.UINT8: 'B', GGUFValueType.INT8: 'b',
+        GGUFValueType.UINT16: 'H', GGUFValueType.INT16: 'h',
+        GGUFValueType.UINT32: 'I', GGUFValueType.INT32: 'i',
+        GGUFValueType.FLOAT32: 'f', GGUFValueType.BOOL: '?',
+        GGUFValueType.UINT64: 'Q', GGUFValueType.INT64: 'q',
+        GGUFValueType.FLOAT64: 'd',
+    }
 
-def string_contains_or_overlaps_sequence_substring(inputstr, sequences):
-    if inputstr=="":
-        return False
-    for s in sequences:
-        if s.strip()=="":
-            continue
-        if s.strip() in inputstr.strip() or inputstr.strip() in s.strip():
-            return True
-        if string_has_overlap(inputstr, s, 10):
-            return True
-    return False
+    def __init__(self, f, limit=256*1024*1024):
+        self.f = f
+        self.limit = limit # never read more than this many bytes of header
+        self.buf = b''
+        self.pos = 0
+        self.consumed = 0
+        self.structs = {}
+        self.unsupported = None # first value type that could not be walked, its size is unknown
+
+    def need(self, n):
+        if self.pos + n <= len(self.buf):
+            return
+        if self.consumed + self.pos + n > self.limit:
+            raise ValueError("GGUF header exceeds read limit")
+        more = self.f.read(max(n, self.chunk_size))
+        self.consumed += self.pos
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        if n > len(self.buf):
+            raise ValueError("Truncated GGUF header")
+
+    def skip(self, n):
+        remaining = len(self.buf) - self.pos
+        if n <= remaining:
+            self.pos += n
+            return
+        if self.consumed + self.pos + n > self.limit:
+            raise ValueError("GGUF header exceeds read limit")
+        self.f.seek(n - remaining, 1)
+        self.consumed += self.pos + n
+        self.buf = b''
+        self.pos = 0
+
+    def unpack(self, fmt):
+        st = self.structs.get(fmt)
+        if st is None:
+            st = self.structs[fmt] = struct.Struct(self.endian + fmt)
+        self.need(st.size)
+        val = st.unpack_from(self.buf, self.pos)[0]
+        self.pos += st.size
+        return val
+
+    def read_string(self):
+        n = self.unpack('Q')
+        if n > self.limit:
+            raise ValueError("Invalid GGUF string length")
+        self.need(n)
+        val = self.buf[self.pos:self.pos+n].decode('utf-8', errors='replace')
+        self.pos += n
+        return val
+
+    def skip_strings(self, count):
+        unpack = struct.Struct(self.endian + 'Q').unpack_from
+        buf, pos = self.buf, self.pos
+        end = len(buf) - 8
+        for _ in range(count):
+            if pos > end:
+                self.pos = pos
+                self.need(8)
+                buf, pos = self.buf, self.pos
+                end = len(buf) - 8
+            n, = unpack(buf, pos)
+            pos += 8 + n
+            if pos > end + 8:
+                self.pos = pos - n
+                if n > self.limit:
+                    raise ValueError("Invalid GGUF string length")
+                self.skip(n)
+                buf, pos = self.buf, self.pos
+                end = len(buf) - 8
+        self.pos = pos
+
+    def skip_array(self, depth=0):
+        # walks past an array that is not kept, including arrays of arrays
+        if depth > 64:
+            raise ValueError("GGUF arrays nested too deep")
+        itype = self.unpack('I')
+        count = self.unpack('Q')
+        if itype == GGUFValueType.STRING:
+            self.skip_strings(count)
+        elif itype == GGUFValueType.ARRAY:
+            for _ in range(count):
+                self.skip_array(depth + 1)
+                if self.unsupported is not None:
+                    return
+        elif itype in self.scalar_formats:
+            self.skip(count * struct.calcsize(self.scalar_formats[itype]))
+        else:
+            self.unsupported = itype
+
+    def read_value(self, vtype):
+        # returns None for values that are not kept. a value of unknown type sets self.unsupported,
+        # as nothing after it can be located
+        if vtype == GGUFValueType.STRING:
+            return self.read_string()
+        if vtype == GGUFValueType.ARRAY:
+            itype = self.unpack('I')
+            count = self.unpack('Q')
+            if itype == GGUFValueType.STRING:
+                self.skip_strings(count)
+                return None
+            if itype == GGUFValueType.ARRAY:
+                for _ in range(count):
+                    self.skip_array(1)
+                    if self.unsupported is not None:
+                        break
+                return None
+            fmt = self.scalar_formats.get(itype)
+            if fmt is None:
+                self.unsupported = itype
+                return None
+            if count > self.max_kept_array:
+                self.skip(count * struct.calcsize(fmt))
+                return None
+            return [self.unpack(fmt) for _ in range(count)]
+        fmt = self.scalar_formats.get(vtype)
+        if fmt is None:
+            self.unsupported = vtype
+            return None
+        return self.unpack(fmt)
+
+    def parse(self, read_tensors=False):
+        # returns the metadata dict. big arrays and nested arrays map to None. with read_tensors, the tensor
+        # table is also read into self.tensors as (name, dims, type, offset relative to self.data_offset).
+        # a value of unknown type ends parsing there, keeping the keys before it and leaving self.tensors None
+        self.need(24)
+        if self.buf[:4] != b'GGUF':
+            raise ValueError("File is not GGUF format")
+        self.endian = '<'
+        if struct.unpack_from('<I', self.buf, 4)[0] & 0xFFFF == 0:
+            self.endian = '>' # big endian file
+        self.pos = 4
+        version = self.unpack('I')
+        if version not in gguf_reader.READER_SUPPORTED_VERSIONS:
+            raise ValueError(f"Unsupported GGUF version {version}")
+        tensor_count = self.unpack('Q')
+        if tensor_count > 1024*1024:
+            raise ValueError("Invalid GGUF tensor count")
+        kv_count = self.unpack('Q')
+        if kv_count > 1024*1024:
+            raise ValueError("Invalid GGUF KV count")
+        kv = {}
+        self.tensors = None
+        for _ in range(kv_count):
+            key = self.read_string()
+            kv[key] = self.read_value(self.unpack('I'))
+            if self.unsupported is not None:
+                print(f"GGUF metadata: '{key}' has unsupported value type {self.unsupported}, skipping the rest of the header")
+                del kv[key]
+                return kv
+        if read_tensors:
+            self.tensors = []
+            for _ in range(tensor_count):
+                name = self.read_string()
+                n_dims = self.unpack('I')
+                if n_dims > 8:
+                    raise ValueError("Invalid GGUF tensor dims")
+                dims = [self.unpack('Q') for _ in range(n_dims)]
+                self.tensors.append((name, dims, self.unpack('I'), self.unpack('Q')))
+            alignment = kv.get(Keys.General.ALIGNMENT) or 32
+            header_end = self.consumed + self.pos
+            self.data_offset = header_end + (alignment - header_end % alignment) % alignment
+        return kv
+
+def gguf_tensor_bytes(tensors, data_size):
+    # byte size of each tensor from its type, falling back to the gap to the next tensor for types gguf-py does not know
+    sizes = []
+    ends = sorted(t[3] for t in tensors) + [data_size]
+    for name, dims, ttype, offset in tensors:
+        quant = GGML_QUANT_SIZES.get(ttype)
+        if quant:
+            nelem = math.prod(dims) if dims else 1
+            sizes.append(nelem // quant[0] * quant[1])
+        else:
+            sizes.append(max(0, ends[bisect.bisect_right(ends, offset)] - offset))
+    return sizes
+
+def gguf_model_shape(kv, tensors=None, data_size=0):
+    arch = kv.get('general.architecture') or ''
+    def archval(key):
+        val = kv.get(key.format(arch=arch))
+        if isinstance(val, list): # per-layer values, e.g. variable kv heads
+            val = max(val) if val else 0
+        return int(val) if isinstance(val, (int, float)) else 0
+    layers = archval(Keys.LLM.BLOCK_COUNT)
+    head_count = archval(Keys.Attention.HEAD_COUNT)
+    head_count_kv = archval(Keys.Attention.HEAD_COUNT_KV) or head_count
+    embd = archval(Keys.LLM.EMBEDDING_LENGTH)
+    kv_length = max(archval(Keys.Attention.KEY_LENGTH), archval(Keys.Attention.VALUE_LENGTH))
+    if kv_length == 0 and head_count > 0:
+        kv_length = embd // head_count # same default as llama.cpp
+    file_type = kv.get(Keys.General.FILE_TYPE)
+    vocab_size = 0
+    input_bytes = output_bytes = 0
+    layer_bytes = []
+    if tensors:
+        # blk.N tensors belong to layer N, the input embeddings always stay on the CPU, everything else goes with the output layer
+        layer_bytes = [0] * layers
+        has_output = False
+        embd_bytes = 0
+        for (name, dims, _, _), nbytes in zip(tensors, gguf_tensor_bytes(tensors, data_size)):
+            if name.startswith('blk.'):
+                il = int(name.split('.')[1])
+                if il >= len(layer_bytes):
+                    layer_bytes.extend([0] * (il + 1 - len(layer_bytes)))
+                layer_bytes[il] += nbytes
+            elif name.startswith(('token_embd', 'token_types', 'position_embd')):
+                input_bytes += nbytes
+                if name == 'token_embd.weight':
+                    embd_bytes = nbytes
+                    vocab_size = dims[1] if len(dims) > 1 else 0
+            else:
+                has_output = has_output or name == 'output.weight'
+                output_bytes += nbytes
+        if not has_output: # tied embeddings, llama.cpp duplicates token_embd as the output matrix
+            output_bytes += embd_bytes
+    return GGUFModelShape(layers=layers, head_count_kv=head_count_kv, kv_length=kv_length, head_count=head_count,
+        embedding_length=embd, context_length=archval(Keys.LLM.CONTEXT_LENGTH),
+        expert_count=archval(Keys.LLM.EXPERT_COUNT), expert_used_count=archval(Keys.LLM.EXPERT_USED_COUNT),
+        file_type=(int(file_type) if isinstance(file_type, int) else -1), architecture=arch,
+        feed_forward_length=archval(Keys.LLM.FEED_FORWARD_LENGTH), vocab_size=vocab_size,
+        input_bytes=input_bytes, output_bytes=output_bytes, layer_bytes=tuple(layer_bytes))
 
 def read_gguf_metadata(file_path):
     print(f'Reading GGUF metadata from {file_path}')
-    chunk_size = 8192  # read only first 8kb of file
     try:
-        def read_gguf_key(keyname,data,maxval):
-            keylen = len(keyname)
-            index = data.find(keyname)  # Search for the magic number, Read 2 chunks of 4 byte numbers
-            if index != -1 and index + keylen + 8 <= chunk_size:
-                start_index = index + keylen
-                first_value_bytes = data[start_index:start_index + 4]
-                second_value_bytes = data[start_index + 4:start_index + 8]
-                # Unpack each 4 bytes as an unsigned int32 in little-endian format
-                value1 = struct.unpack('<I', first_value_bytes)[0] #4 means its a uint32
-                value2 = struct.unpack('<I', second_value_bytes)[0]
-                if value1 == 4 and value2 > 0 and value2 <= maxval:
-                    return value2 #contains the desired value
-                return 0
-            else:
-                return 0 #not found
-
         fsize = os.path.getsize(file_path)
         if fsize < 10000: #ignore files under 10kb
             return None
         with open(file_path, 'rb') as f:
-            file_header = f.read(4)
-            if file_header != b'GGUF': #file is not GGUF
+            if f.read(4) != b'GGUF': #file is not GGUF
                 print(f'File is not GGUF format')
                 return None
-            data = f.read(chunk_size)
-            layercount = read_gguf_key(b'.block_count',data,512)
-            head_count_kv = read_gguf_key(b'.attention.head_count_kv',data,8192)
-            key_length = read_gguf_key(b'.attention.key_length',data,8192)
-            val_length = read_gguf_key(b'.attention.value_length',data,8192)
-            print(f'GGUF metadata: {layercount} layers, {head_count_kv} heads, {max(key_length,val_length)} key/val length')
-            return [layercount,head_count_kv, max(key_length,val_length)]
-    except Exception:
+            f.seek(0)
+            parser = GGUFHeaderParser(f, limit=min(fsize, 256*1024*1024))
+            kv = parser.parse(read_tensors=True)
+            shape = gguf_model_shape(kv, parser.tensors, (fsize - parser.data_offset) if parser.tensors is not None else 0)
+            print(f'GGUF metadata: {shape.architecture} {shape.layers} layers, {shape.head_count_kv} kv heads, {shape.kv_length} key/val length, {shape.embedding_length} embd, {shape.context_length} ctx' + (f', {shape.expert_used_count}/{shape.expert_count} experts' if shape.expert_count else ''))
+            return shape
+    except Exception as e:
+        print(f'Could not read GGUF metadata: {e}')
         return None
 
 def extract_modelfile_params(filepath,sdfilepath,whisperfilepath,mmprojfilepath,draftmodelpath):
@@ -659,11 +2112,168 @@ def extract_modelfile_params(filepath,sdfilepath,whisperfilepath,mmprojfilepath,
             fsize = os.path.getsize(filepath)
             if fsize>10000000: #dont bother with models < 10mb as they are probably bad
                 ggufmeta = read_gguf_metadata(filepath)
-                modelfile_extracted_meta = [ggufmeta,fsize,sdfsize,whisperfsize,mmprojsize,draftmodelsize] #extract done. note that meta may be null
+                draftmeta = (read_gguf_metadata(draftmodelpath) if draftmodelsize > 10000000 else None)
+                modelfile_extracted_meta = [ggufmeta,fsize,sdfsize,whisperfsize,mmprojsize,draftmodelsize,draftmeta] #extract done. note that meta may be null
         except Exception:
             modelfile_extracted_meta = None
 
-def autoset_gpu_layers(ctxsize,sdquanted,bbs): #shitty algo to determine how many layers to use
+plan_device_reserve = 400*1024*1024 # driver context and fragmentation headroom kept free on every gpu
+plan_kv_type_bytes = {0: 2.0, 1: 34/32, 2: 18/32} # quantkv: f16, q8_0, q4_0
+
+def estimate_kv_bytes(meta, ctxsize, quantkv):
+    # bytes of k and v cache for a single layer
+    return int(2 * ctxsize * meta.head_count_kv * meta.kv_length * plan_kv_type_bytes.get(quantkv, 2.0))
+
+def estimate_compute_bytes(meta, ctxsize, bbs, flashattn, with_output):
+    # peak size of the compute graph buffer for one batch. without flash attention the full f32 KQ matrix
+    # for every head is materialized, which dominates at long contexts
+    nb = bbs if bbs > 0 else 16
+    ffn = nb * 4 * (meta.feed_forward_length or 4 * meta.embedding_length) * 3
+    if flashattn:
+        attn = nb * 4 * meta.head_count * meta.kv_length * 2 + nb * ctxsize * 2
+    else:
+        attn = nb * 4 * ctxsize * (meta.head_count + 1)
+    logits = nb * 4 * meta.vocab_size if with_output else 0
+    return max(ffn, attn, logits) + nb * 4 * meta.embedding_length * 4
+
+def estimate_extra_footprints(meta, sdquanted, ctxsize, bbs, quantkv, flashattn, draftgpulayers):
+    # gpu memory used by models loaded next to the text model, all placed on the main gpu
+    extras = []
+    fsize, sdfsize, whisperfsize, mmprojsize, draftmodelsize = meta[1:6]
+    draftmeta = meta[6] if len(meta) > 6 else None
+    if draftmeta and draftmeta.layer_bytes:
+        layers = min(draftmeta.layers, max(0, draftgpulayers))
+        draftmem = sum(draftmeta.layer_bytes[draftmeta.layers-layers:]) + layers * estimate_kv_bytes(draftmeta, ctxsize, quantkv)
+        if layers:
+            draftmem += (draftmeta.output_bytes if draftgpulayers > draftmeta.layers else 0) + estimate_compute_bytes(draftmeta, ctxsize, bbs, flashattn, True)
+        extras.append(("draft", draftmem))
+    elif draftmodelsize > 1024*1024*10:
+        extras.append(("draft", int(draftmodelsize * 1.5)))
+    if mmprojsize > 1024*1024*10:
+        extras.append(("mmproj", mmprojsize + 256*1024*1024))
+    if sdfsize > 1024*1024*512:
+        sdxl = sdfsize > 1024*1024*1024*5
+        extras.append(("sd", int(sdfsize * (0.55 if sdquanted else 1.0)) + 1024*1024*(2560 if sdxl else 1536)))
+    if whisperfsize > 1024*1024*10:
+        extras.append(("whisper", whisperfsize + 150*1024*1024))
+    return extras
+
+def plan_memory(meta, ctxsize, bbs, quantkv=0, flashattn=False, tensor_split=None, devices=None, sdquanted=False, draftgpulayers=999):
+    # meta is modelfile_extracted_meta, devices a list of (total, free) bytes per gpu. finds the largest number of
+    # offloaded layers that fits every device. with no tensor_split the layers are packed greedily, which also
+    # gives the split to suggest, otherwise they are distributed the way llama.cpp does for the given ratios
+    shape = meta[0]
+    layers = shape.layers
+    kvlayer = estimate_kv_bytes(shape, ctxsize, quantkv)
+    costs = [b + kvlayer for b in shape.layer_bytes[:layers]] + [shape.output_bytes]
+    extras = estimate_extra_footprints(meta, sdquanted, ctxsize, bbs, quantkv, flashattn, draftgpulayers)
+    devices = devices or []
+    budgets = [max(0, (free if free > 0 else total) - plan_device_reserve) for total, free in devices]
+    fixed = [0] * len(devices)
+    if devices:
+        fixed[0] = sum(e[1] for e in extras)
+    compute = estimate_compute_bytes(shape, ctxsize, bbs, flashattn, False)
+    compute_out = estimate_compute_bytes(shape, ctxsize, bbs, flashattn, True)
+    ratios = [max(0.0, float(r)) for r in tensor_split[:len(devices)]] if tensor_split and len(devices) > 1 else None
+    if ratios and sum(ratios) <= 0:
+        ratios = None
+
+    def device_usage(assign, start):
+        # assign[i] is the device of offloaded item start+i, item index layers is the output layer
+        used = list(fixed)
+        for d in set(assign):
+            used[d] += compute
+        if assign and start + len(assign) > layers:
+            used[assign[-1]] += compute_out - compute
+        for i, d in enumerate(assign):
+            used[d] += costs[start + i]
+        return used
+
+    def assign_items(count):
+        start = layers - min(count, layers)
+        if ratios:
+            total, splits = 0.0, []
+            for r in ratios:
+                total += r / sum(ratios)
+                splits.append(total)
+            return start, [min(len(devices) - 1, bisect.bisect_right(splits, i / count)) for i in range(count)]
+        assign, used, d = [], list(fixed), 0
+        for i in range(count):
+            item = start + i
+            while d < len(devices):
+                first = not assign or assign[-1] != d
+                extra = costs[item] + (compute if first else 0) + (compute_out - compute if item == layers else 0)
+                if used[d] + extra <= budgets[d]:
+                    break
+                d += 1
+            if d >= len(devices):
+                return start, None
+            used[d] += extra
+            assign.append(d)
+        return start, assign
+
+    best = (0, layers, [])
+    for count in range(layers + 1 if devices else 0, 0, -1):
+        start, assign = assign_items(count)
+        if assign is None:
+            continue
+        used = device_usage(assign, start)
+        if all(u <= b for u, b in zip(used, budgets)):
+            best = (count, start, assign)
+            break
+    count, start, assign = best
+    used = device_usage(assign, start) if devices else []
+    rows = []
+    for d, (total, free) in enumerate(devices):
+        items = [start + i for i, dev in enumerate(assign) if dev == d]
+        weights = sum(shape.layer_bytes[i] for i in items if i < layers) + (shape.output_bytes if layers in items else 0)
+        kvmem = kvlayer * len([i for i in items if i < layers])
+        rows.append({"device": f"GPU {d}", "budget": budgets[d], "weights": weights, "kv": kvmem, "compute": used[d] - weights - kvmem - fixed[d],
+                     "extras": fixed[d], "total": used[d], "layers": len([i for i in items if i < layers])})
+    cpulayers = layers - min(count, layers)
+    cpuweights = shape.input_bytes + sum(shape.layer_bytes[:cpulayers]) + (0 if count > layers else shape.output_bytes)
+    cpucompute = estimate_compute_bytes(shape, ctxsize, bbs, flashattn, count <= layers) if count <= layers else 0
+    cpuextras = (0 if devices else sum(e[1] for e in extras))
+    rows.append({"device": "CPU / RAM", "budget": 0, "weights": cpuweights, "kv": kvlayer * cpulayers, "compute": cpucompute,
+                 "extras": cpuextras, "total": cpuweights + kvlayer * cpulayers + cpucompute + cpuextras, "layers": cpulayers})
+    split = None
+    if len(devices) > 1 and not ratios and count > 0:
+        split = [assign.count(d) for d in range(len(devices))]
+    gpulayers = (layers + 3) if count > layers else count # full offload is reported the same way the launcher shows the maximum
+    return {"gpulayers": gpulayers, "tensor_split": split, "rows": rows, "extras": extras, "kv_per_layer": kvlayer, "compute": compute_out}
+
+def get_planner_devices(tensor_split=None, usecublas=None):
+    # per gpu (total, free) bytes. only cuda/rocm report each device, otherwise assume identical devices of the smallest size
+    if GPUDeviceMemory:
+        devices = list(GPUDeviceMemory)
+        if usecublas:
+            picked = [int(x) for x in usecublas if x in ('0','1','2','3')]
+            if picked and picked[0] < len(devices):
+                return [devices[picked[0]]]
+        return devices
+    if MaxMemory[0] > 0:
+        return [(MaxMemory[0], MaxFreeMemory[0])] * (len(tensor_split) if tensor_split else 1)
+    return []
+
+def print_memory_plan(plan, meta, ctxsize, bbs, quantkv, flashattn):
+    shape = meta[0]
+    mb = lambda n: f"{n/1024/1024:.0f} MB"
+    kvname = ["f16","q8_0","q4_0"][quantkv] if quantkv in (0,1,2) else "f16"
+    print(f"Memory plan: {shape.architecture}, {shape.layers} layers, context {ctxsize}, batch {bbs}, KV {kvname}, flash attention {'on' if flashattn else 'off'}")
+    print(f"KV cache per layer: {mb(plan['kv_per_layer'])}, compute buffer: {mb(plan['compute'])}")
+    for name, size in plan["extras"]:
+        print(f"  {name}: {mb(size)}")
+    header = ["Device","Budget","Weights","KV cache","Compute","Extras","Total","Layers"]
+    print("".join(h.rjust(12) if i else h.ljust(12) for i, h in enumerate(header)))
+    for row in plan["rows"]:
+        cols = [row["device"], (mb(row["budget"]) if row["budget"] else "-"), mb(row["weights"]), mb(row["kv"]), mb(row["compute"]), mb(row["extras"]), mb(row["total"]), str(row["layers"])]
+        print("".join(c.rjust(12) if i else c.ljust(12) for i, c in enumerate(cols)))
+    rec = f"--gpulayers {plan['gpulayers']}"
+    if plan["tensor_split"]:
+        rec += " --tensor_split " + " ".join(str(x) for x in plan["tensor_split"])
+    print(f"Recommended: {rec}")
+
+def autoset_gpu_layers(ctxsize,sdquanted,bbs,quantkv=0,flashattn=False,tensor_split=None,usecublas=None,draftgpulayers=999):
     global showusedmemwarning, modelfile_extracted_meta # reference cached values instead
     gpumem = MaxMemory[0]
     usedmem = 0
@@ -672,44 +2282,25 @@ def autoset_gpu_layers(ctxsize,sdquanted,bbs): #shitty algo to determine how man
         if showusedmemwarning and usedmem > (2.5*1024*1024*1024):
             showusedmemwarning = False
             print(f"Note: KoboldCpp has detected that a significant amount of GPU VRAM ({usedmem/1024/1024} MB) is currently used by another application.\nFor best results, you may wish to close that application and then restart KoboldCpp.\n***")
-    reservedmem = max(1.3*1024*1024*1024,(0.5*1024*1024*1024 + usedmem)) # determine vram overhead
     try:
         if not modelfile_extracted_meta:
             return 0
         layerlimit = 0
         fsize = modelfile_extracted_meta[1]
         if fsize>10000000: #dont bother with models < 10mb
-            cs = ctxsize
-            mem = gpumem
-            if modelfile_extracted_meta[2] > 1024*1024*1024*5: #sdxl tax
-                mem -= 1024*1024*1024*(6 if sdquanted else 9)
-            elif modelfile_extracted_meta[2] > 1024*1024*512: #normal sd tax
-                mem -= 1024*1024*1024*(3.25 if sdquanted else 4.25)
-            if modelfile_extracted_meta[3] > 1024*1024*10: #whisper tax
-                mem -= 350*1024*1024
-            if modelfile_extracted_meta[4] > 1024*1024*10: #mmproj tax
-                mem -= 350*1024*1024
-            if modelfile_extracted_meta[5] > 1024*1024*10: #draft model tax
-                mem -= (modelfile_extracted_meta[5] * 1.5)
-            mem = 0 if mem < 0 else mem
-
-            csmul = 1.0
-            if cs:
-                csmul = (cs/4096) if cs >= 8192 else 1.8 if cs > 4096 else 1.2 if cs > 2048 else 1.0
             ggufmeta = modelfile_extracted_meta[0]
-            if not ggufmeta or ggufmeta[0]==0: #fail to read or no layers
+            if not ggufmeta or ggufmeta.layers==0 or not ggufmeta.layer_bytes: #fail to read or no layers, crude guess from the file size
+                cs = ctxsize
+                mem = gpumem - sum(e[1] for e in estimate_extra_footprints(modelfile_extracted_meta, sdquanted, cs, bbs, quantkv, flashattn, draftgpulayers))
+                mem = 0 if mem < 0 else mem
+                csmul = 1.0
+                if cs:
+                    csmul = (cs/4096) if cs >= 8192 else 1.8 if cs > 4096 else 1.2 if cs > 2048 else 1.0
                 sizeperlayer = fsize*csmul*0.052
                 layerlimit = int(min(200,(mem-usedmem)/sizeperlayer))
             else:
-                layers = ggufmeta[0]
-                headcount = ggufmeta[1]
-                headkvlen = (ggufmeta[2] if ggufmeta[2] > 0 else 128)
-                ratio = (mem-usedmem)/(fsize*csmul*1.6*(1.0 if bbs <= 512 else 1.2))
-                computemem = layers*(4 if bbs <= 512 else (bbs/128))*headkvlen*cs*4*1.55 # apply blasbatchsize calculations if over 512
-                contextmem = layers*headcount*headkvlen*cs*4*1.15
-                if headcount > 0:
-                    ratio = max(ratio, (mem - reservedmem - computemem) / (fsize + contextmem))
-                layerlimit = min(int(ratio*layers), (layers + 3))
+                plan = plan_memory(modelfile_extracted_meta, ctxsize, bbs, quantkv, flashattn, tensor_split, get_planner_devices(tensor_split, usecublas), sdquanted, draftgpulayers)
+                layerlimit = plan["gpulayers"]
         layerlimit = (0 if layerlimit<=2 else layerlimit)
         return layerlimit
     except Exception:
@@ -750,15 +2341,21 @@ def fetch_gpu_properties(testCL,testCU,testVK):
                 pass
         lowestcumem = 0
         lowestfreecumem = 0
+        GPUDeviceMemory.clear()
         for idx in range(0,4):
             if(len(FetchedCUdevices)>idx):
                 CUDevicesNames[idx] = FetchedCUdevices[idx]
+                totalmem = freemem = 0
                 if len(FetchedCUdeviceMem)>idx:
                     dmem = int(FetchedCUdeviceMem[idx]) if AMDgpu else (int(FetchedCUdeviceMem[idx])*1024*1024)
                     lowestcumem = dmem if lowestcumem==0 else (dmem if dmem<lowestcumem else lowestcumem)
+                    totalmem = dmem
                 if len(FetchedCUfreeMem)>idx:
                     dmem = (int(FetchedCUfreeMem[idx])*1024*1024)
                     lowestfreecumem = dmem if lowestfreecumem==0 else (dmem if dmem<lowestfreecumem else lowestfreecumem)
+                    freemem = dmem
+                if totalmem > 0:
+                    GPUDeviceMemory.append((totalmem, freemem))
 
         MaxMemory[0] = max(lowestcumem,MaxMemory[0])
         MaxFreeMemory[0] = max(lowestfreecumem,MaxFreeMemory[0])
@@ -893,220 +2490,610 @@ def load_model(model_filename):
     ret = handle.load_model(inputs)
     return ret
 
-from importlib import reload
 import koboldcpp_promt_template
-def generate(genparams, is_quiet=False, stream_flag=False):
-    global maxctx, args, currentusergenkey, totalgens, pendingabortkey
-
-    prompt = genparams.get('prompt', "")
-    memory = genparams.get('memory', "")
-    
-    utfprint('\n================================')
-    utfprint(f"接收到的消息：{prompt}\n当前的记忆：{memory}")
-    utfprint('--------------------------------')
-    reload(koboldcpp_promt_template)
-    prompt, memory, prompt_template_state = koboldcpp_promt_template.prompt_template(
-        prompt, memory, selected_template[0], selected_template[1])
-    utfprint(f"模板处理后的消息：{prompt}\n当前的记忆：{memory}")
-    utfprint('================================\n')
-    
-    images = genparams.get('images', [])
-    max_context_length = genparams.get('max_context_length', maxctx)
-    max_length = genparams.get('max_length', 200)
-    temperature = genparams.get('temperature', 0.75)
-    top_k = genparams.get('top_k', 100)
-    top_a = genparams.get('top_a', 0.0)
-    top_p = genparams.get('top_p', 0.92)
-    min_p = genparams.get('min_p', 0.0)
-    typical_p = genparams.get('typical', 1.0)
-    tfs = genparams.get('tfs', 1.0)
-    rep_pen = genparams.get('rep_pen', 1.0)
-    rep_pen_range = genparams.get('rep_pen_range', 320)
-    rep_pen_slope = genparams.get('rep_pen_slope', 1.0)
-    presence_penalty = genparams.get('presence_penalty', 0.0)
-    mirostat = genparams.get('mirostat', 0)
-    mirostat_tau = genparams.get('mirostat_tau', 5.0)
-    mirostat_eta = genparams.get('mirostat_eta', 0.1)
-    dry_multiplier = genparams.get('dry_multiplier', 0.0)
-    dry_base = genparams.get('dry_base', 1.75)
-    dry_allowed_length = genparams.get('dry_allowed_length', 2)
-    dry_penalty_last_n = genparams.get('dry_penalty_last_n', 320)
-    dry_sequence_breakers = genparams.get('dry_sequence_breakers', [])
-    xtc_threshold = genparams.get('xtc_threshold', 0.2)
-    xtc_probability = genparams.get('xtc_probability', 0)
-    sampler_order = genparams.get('sampler_order', [6, 0, 1, 3, 4, 2, 5])
-    seed = tryparseint(genparams.get('sampler_seed', -1))
-    stop_sequence = genparams.get('stop_sequence', [])
-    ban_eos_token = genparams.get('ban_eos_token', False)
-    stream_sse = stream_flag
-    grammar = genparams.get('grammar', '')
-    grammar_retain_state = genparams.get('grammar_retain_state', False)
-    genkey = genparams.get('genkey', '')
-    trimstop = genparams.get('trim_stop', True)
-    quiet = is_quiet
-    dynatemp_range = genparams.get('dynatemp_range', 0.0)
-    dynatemp_exponent = genparams.get('dynatemp_exponent', 1.0)
-    smoothing_factor = genparams.get('smoothing_factor', 0.0)
-    logit_biases = genparams.get('logit_bias', {})
-    render_special = genparams.get('render_special', False)
-    banned_strings = genparams.get('banned_strings', []) # SillyTavern uses that name
-    banned_tokens = genparams.get('banned_tokens', banned_strings)
-    bypass_eos_token = genparams.get('bypass_eos', False)
-    custom_token_bans = genparams.get('custom_token_bans', '')
-
-    for tok in custom_token_bans.split(','):
-        tok = tok.strip()  # Remove leading/trailing whitespace
-        if tok.isdigit():
-            logit_biases[tok] = bias_min_value
-
-    inputs = generation_inputs()
-    inputs.prompt = prompt.encode("UTF-8")
-    inputs.memory = memory.encode("UTF-8")
-    for n in range(images_max):
-        if not images or n >= len(images):
-            inputs.images[n] = "".encode("UTF-8")
-        else:
-            inputs.images[n] = images[n].encode("UTF-8")
-    global showmaxctxwarning
-    if max_context_length > maxctx:
-        if showmaxctxwarning:
-            print(f"\n(Warning! Request max_context_length={max_context_length} exceeds allocated context size of {maxctx}. It will be reduced to fit. Consider launching with increased --contextsize to avoid errors. This message will only show once per session.)")
-            showmaxctxwarning = False
-        max_context_length = maxctx
-    min_remain = min(max_context_length-4, 16)
-    if max_length >= (max_context_length-min_remain):
-        max_length = max_context_length-min_remain
-        print("\nWarning: You are trying to generate with max_length near or exceeding max_context_length. Most of the context will be removed, and your outputs will not be very coherent.")
-
-    inputs.max_context_length = max_context_length   # this will resize the context buffer if changed
-    inputs.max_length = max_length
-    inputs.temperature = temperature
-    inputs.top_k = top_k
-    inputs.top_a = top_a
-    inputs.top_p = top_p
-    inputs.min_p = min_p
-    inputs.typical_p = typical_p
-    inputs.tfs = tfs
-    inputs.rep_pen = rep_pen
-    inputs.rep_pen_range = rep_pen_range
-    inputs.rep_pen_slope = rep_pen_slope
-    inputs.presence_penalty = presence_penalty
-    inputs.stream_sse = stream_sse
-    inputs.quiet = quiet
-    inputs.dynatemp_range = dynatemp_range
-    inputs.dynatemp_exponent = dynatemp_exponent
-    inputs.smoothing_factor = smoothing_factor
-    inputs.grammar = grammar.encode("UTF-8")
-    inputs.grammar_retain_state = grammar_retain_state
-    inputs.allow_eos_token = not ban_eos_token
-    inputs.bypass_eos_token = bypass_eos_token
-    inputs.render_special = render_special
-    if mirostat in (1, 2):
-        inputs.mirostat = mirostat
-        inputs.mirostat_tau = mirostat_tau
-        inputs.mirostat_eta = mirostat_eta
-    else:
-        inputs.mirostat = inputs.mirostat_tau = inputs.mirostat_eta = 0
-    inputs.dry_multiplier = dry_multiplier
-    inputs.dry_base = dry_base
-    inputs.xtc_threshold = xtc_threshold
-    inputs.xtc_probability = xtc_probability
-    inputs.dry_allowed_length = dry_allowed_length
-    inputs.dry_penalty_last_n = dry_penalty_last_n
-    # Handle dry_sequence_breakers being passed as a json-encoded array of
-    # strings, rather than as an array of strings itself. This is to support
-    # SillyTavern, which passes sequence breakers to Oobabooga that way.
-    if dry_multiplier > 0 and isinstance(dry_sequence_breakers, str):
+import json_schema_to_grammar
+# Builds the ctypes generation_inputs for a request. Clients tend to resend the same presets
+# with every request, so the encoded string arrays (stop sequences, dry sequence breakers, banned
+# tokens), grammars and logit bias arrays are cached by content and reused, and each thread
+# refills one preallocated struct. Numeric sampler fields are coerced in one table driven pass,
+# falling back to the default for a value of the wrong type instead of failing the request.
+class GenerationInputsMarshaller:
+    # genparams key, generation_inputs field, type, default
+    sampler_fields = (("temperature", "temperature", float, 0.75), ("top_k", "top_k", int, 100), ("top_a", "top_a", float, 0.0),
+    ("top_p", "top_p", float, 0.92), ("min_p", "min_p", float, 0.0), ("typical", "typical_p", float, 1.0), ("tfs", "tfs", float, 1.0),
+    ("rep_pen", "rep_pen", float, 1.0), ("rep_pen_range", "rep_pen_range", int, 320), ("rep_pen_slope", "rep_pen_slope", float, 1.0),
+    ("presence_penalty", "presence_penalty", float, 0.0), ("dynatemp_range", "dynatemp_range", float, 0.0),
+    ("dynatemp_exponent", "dynatemp_exponent", float, 1.0), ("smoothing_factor", "smoothing_factor", float, 0.0),
+    ("dry_multiplier", "dry_multiplier", float, 0.0), ("dry_base", "dry_base", float, 1.75), ("dry_allowed_length", "dry_allowed_length", int, 2),
+    ("dry_penalty_last_n", "dry_penalty_last_n", int, 320), ("xtc_threshold", "xtc_threshold", float, 0.2), ("xtc_probability", "xtc_probability", float, 0.0),
+    ("grammar_retain_state", "grammar_retain_state", bool, False), ("render_special", "render_special", bool, False), ("bypass_eos", "bypass_eos_token", bool, False))
+
+    def __init__(self, max_entries=256):
+        self.lock = threading.Lock()
+        self.presets = collections.OrderedDict() #(kind, content) -> encoded ctypes value
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.coerced = 0
+
+    def _cached(self, kind, content, build):
         try:
-            dry_sequence_breakers = json.loads(dry_sequence_breakers)
-        except ValueError as e:
-            print(f"ERROR: dry_sequence_breakers must be an array of strings or a json encoded array of strings. Could not parse '{dry_sequence_breakers}': " + str(e))
-            dry_sequence_breakers = []
+            key = (kind, content)
+            hash(key)
+        except TypeError: #unhashable content, e.g. a list of dicts, is built every time
+            return build()
+        with self.lock:
+            value = self.presets.get(key)
+            if value is not None:
+                self.presets.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = build()
+        with self.lock:
+            self.presets[key] = value
+            while len(self.presets) > self.max_entries:
+                self.presets.popitem(last=False)
+        return value
 
-    if dry_multiplier <= 0 or dry_sequence_breakers is None: # prevent explicitly set to None, retain old behavior
-        dry_sequence_breakers = []
+    @staticmethod
+    def _encode(value):
+        return value.encode("UTF-8") if isinstance(value, str) else ("" if value is None else str(value)).encode("UTF-8")
 
-    dry_sequence_breakers = dry_sequence_breakers[:dry_seq_break_max]
-    inputs.dry_sequence_breakers_len = len(dry_sequence_breakers)
-    inputs.dry_sequence_breakers = (ctypes.c_char_p * inputs.dry_sequence_breakers_len)()
+    def string_array(self, kind, strings):
+        strings = tuple(strings)
+        return self._cached(kind, strings, lambda: (ctypes.c_char_p * len(strings))(*[self._encode(v) for v in strings]))
 
-    for n, breaker in enumerate(dry_sequence_breakers):
-        inputs.dry_sequence_breakers[n] = breaker.encode("UTF-8")
+    def encoded(self, kind, text):
+        return self._cached(kind, text, lambda: self._encode(text))
 
-    if sampler_order and 0 < len(sampler_order) <= sampler_order_max:
+    def logit_bias_array(self, biases):
+        items = tuple(biases.items())
+        def build():
+            entries = []
+            for key, value in items[:logit_bias_max]:
+                try:
+                    t_id = int(key)
+                    bias = float(value)
+                    t_id = -1 if t_id < 0 else t_id
+                    bias = (bias_max_value if bias > bias_max_value else (bias_min_value if bias < bias_min_value else bias))
+                    entries.append(logit_bias(t_id, bias))
+                except Exception as ex:
+                    entries.append(logit_bias(-1, 0.0))
+                    utfprint(f"Skipped unparsable logit bias:{ex}", "warning")
+            return (logit_bias * len(entries))(*entries)
+        return self._cached("logit_bias", items, build)
+
+    @staticmethod
+    def _parse_bool(value):
+        # bool("false") would be True, so strings are matched explicitly
+        if isinstance(value, str):
+            lowered = value.strip().lower()
+            if lowered in ("true", "1", "yes", "on"):
+                return True
+            if lowered in ("false", "0", "no", "off", ""):
+                return False
+            raise ValueError(f"not a boolean: {value!r}")
+        if isinstance(value, (int, float)):
+            return bool(value)
+        raise TypeError(f"not a boolean: {value!r}")
+
+    def coerce(self, genparams, inputs):
+        for key, field, kind, default in self.sampler_fields:
+            value = genparams.get(key, default)
+            try:
+                if type(value) is not kind:
+                    value = self._parse_bool(value) if kind is bool else kind(value)
+                if kind is float and not math.isfinite(value):
+                    raise ValueError(f"{key} must be finite")
+            except (TypeError, ValueError, OverflowError): #int() of inf or 1e999 overflows
+                value = default
+                with self.lock:
+                    self.coerced += 1
+            setattr(inputs, field, value)
+
+    def release(self, inputs):
+        # the reused struct would otherwise keep this request's images and prompt alive until the next one
+        for n in range(images_max):
+            inputs.images[n] = b""
+        inputs.prompt = b""
+        inputs.memory = b""
+
+    def build(self, genparams, prompt, memory, stream_flag, is_quiet):
+        global showmaxctxwarning, showsamplerwarning
+        inputs = getattr(self.local, "inputs", None)
+        if inputs is None:
+            inputs = self.local.inputs = generation_inputs()
+        else: #every field starts from zero, exactly like a fresh struct
+            ctypes.memset(ctypes.addressof(inputs), 0, ctypes.sizeof(inputs))
+
+        images = genparams.get('images', [])
+        max_context_length = genparams.get('max_context_length', maxctx)
+        max_length = genparams.get('max_length', 200)
+        mirostat = genparams.get('mirostat', 0)
+        sampler_order = genparams.get('sampler_order', [6, 0, 1, 3, 4, 2, 5])
+        seed = tryparseint(genparams.get('sampler_seed', -1))
+        stop_sequence = genparams.get('stop_sequence', [])
+        ban_eos_token = genparams.get('ban_eos_token', False)
+        grammar = genparams.get('grammar', '')
+        dry_sequence_breakers = genparams.get('dry_sequence_breakers', [])
+        logit_biases = genparams.get('logit_bias', {})
+        banned_strings = genparams.get('banned_strings', []) # SillyTavern uses that name
+        banned_tokens = genparams.get('banned_tokens', banned_strings)
+        custom_token_bans = genparams.get('custom_token_bans', '')
+
+        inputs.prompt = prompt.encode("UTF-8")
+        inputs.memory = memory.encode("UTF-8")
+        for n in range(images_max):
+            if not images or n >= len(images):
+                inputs.images[n] = b""
+            else:
+                inputs.images[n] = images[n].encode("UTF-8")
+        if max_context_length > maxctx:
+            if showmaxctxwarning:
+                utfprint(f"\n(Warning! Request max_context_length={max_context_length} exceeds allocated context size of {maxctx}. It will be reduced to fit. Consider launching with increased --contextsize to avoid errors. This message will only show once per session.)", "warning")
+                showmaxctxwarning = False
+            max_context_length = maxctx
+        min_remain = min(max_context_length-4, 16)
+        if max_length >= (max_context_length-min_remain):
+            max_length = max_context_length-min_remain
+            utfprint("\nWarning: You are trying to generate with max_length near or exceeding max_context_length. Most of the context will be removed, and your outputs will not be very coherent.", "warning")
+
+        inputs.max_context_length = max_context_length   # this will resize the context buffer if changed
+        inputs.max_length = max_length
+        self.coerce(genparams, inputs)
+        inputs.stream_sse = stream_flag
+        inputs.quiet = is_quiet
+        inputs.grammar = self.encoded("grammar", grammar) if grammar else b""
+        inputs.allow_eos_token = not ban_eos_token
+        if mirostat in (1, 2):
+            inputs.mirostat = mirostat
+            inputs.mirostat_tau = genparams.get('mirostat_tau', 5.0)
+            inputs.mirostat_eta = genparams.get('mirostat_eta', 0.1)
+
+        # Handle dry_sequence_breakers being passed as a json-encoded array of
+        # strings, rather than as an array of strings itself. This is to support
+        # SillyTavern, which passes sequence breakers to Oobabooga that way.
+        if inputs.dry_multiplier > 0 and isinstance(dry_sequence_breakers, str):
+            try:
+                dry_sequence_breakers = json.loads(dry_sequence_breakers)
+            except ValueError as e:
+                utfprint(f"ERROR: dry_sequence_breakers must be an array of strings or a json encoded array of strings. Could not parse '{dry_sequence_breakers}': " + str(e), "error")
+                dry_sequence_breakers = []
+        if inputs.dry_multiplier <= 0 or dry_sequence_breakers is None: # prevent explicitly set to None, retain old behavior
+            dry_sequence_breakers = []
+        dry_sequence_breakers = dry_sequence_breakers[:dry_seq_break_max]
+        inputs.dry_sequence_breakers_len = len(dry_sequence_breakers)
+        inputs.dry_sequence_breakers = self.string_array("dry_sequence_breakers", dry_sequence_breakers)
+
+        if sampler_order and 0 < len(sampler_order) <= sampler_order_max:
+            try:
+                for i, sampler in enumerate(sampler_order):
+                    inputs.sampler_order[i] = sampler
+                inputs.sampler_len = len(sampler_order)
+                if showsamplerwarning and inputs.mirostat==0 and inputs.sampler_len>0 and (inputs.sampler_order[0]!=6 or inputs.sampler_order[inputs.sampler_len-1]!=5):
+                    utfprint("\n(Note: Non-default sampler_order detected. Recommended sampler values are [6,0,1,3,4,2,5]. This message will only show once per session.)", "warning")
+                    showsamplerwarning = False
+            except TypeError as e:
+                inputs.sampler_len = 0
+                utfprint("ERROR: sampler_order must be a list of integers: " + str(e), "error")
+        inputs.seed = seed
+
+        if stop_sequence is None:
+            stop_sequence = []
+        stop_sequence = stop_sequence[:stop_token_max]
+        inputs.stop_sequence_len = len(stop_sequence)
+        inputs.stop_sequence = self.string_array("stop_sequence", stop_sequence)
+
+        biases = {}
         try:
-            for i, sampler in enumerate(sampler_order):
-                inputs.sampler_order[i] = sampler
-            inputs.sampler_len = len(sampler_order)
-            global showsamplerwarning
-            if showsamplerwarning and inputs.mirostat==0 and inputs.sampler_len>0 and (inputs.sampler_order[0]!=6 or inputs.sampler_order[inputs.sampler_len-1]!=5):
-                print("\n(Note: Non-default sampler_order detected. Recommended sampler values are [6,0,1,3,4,2,5]. This message will only show once per session.)")
-                showsamplerwarning = False
-        except TypeError as e:
-            print("ERROR: sampler_order must be a list of integers: " + str(e))
-    inputs.seed = seed
+            if logit_biases and len(logit_biases) > 0:
+                biases = dict(logit_biases.items())
+        except Exception as ex:
+            utfprint(f"Logit bias dictionary is invalid: {ex}", "warning")
+        for tok in custom_token_bans.split(','):
+            tok = tok.strip()  # Remove leading/trailing whitespace
+            if tok.isdigit():
+                biases[tok] = bias_min_value
+        biasarr = self.logit_bias_array(biases)
+        inputs.logit_biases_len = len(biasarr)
+        inputs.logit_biases = biasarr
+
+        if banned_tokens is None:
+            banned_tokens = []
+        banned_tokens = banned_tokens[:ban_token_max]
+        inputs.banned_tokens_len = len(banned_tokens)
+        inputs.banned_tokens = self.string_array("banned_tokens", banned_tokens)
+        return inputs
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.presets), "hits": self.hits, "misses": self.misses, "coerced": self.coerced,
+            "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0}
+
+inputs_marshaller = GenerationInputsMarshaller()
+
+def benchmark_generation_inputs(iterations=2000):
+    # per request marshalling cost for a typical sillytavern style request, with the preset cache cold and warm,
+    # against the old path that built a fresh struct and encoded every array on every request
+    genparams = {"prompt": "", "max_context_length": 4096, "max_length": 200, "temperature": 0.7, "top_k": 40, "top_p": 0.9,
+    "rep_pen": 1.1, "dry_multiplier": 0.8, "dry_sequence_breakers": ["\n", ":", "\"", "*"] * 8, "sampler_order": [6, 0, 1, 3, 4, 2, 5],
+    "stop_sequence": [f"\n{name}:" for name in ("User", "Assistant", "System", "Narrator")] * 16, "banned_tokens": [f"banned phrase {i}" for i in range(128)],
+    "logit_bias": {str(i): -5.0 for i in range(256)}}
+    def legacy_build(genparams, prompt, memory):
+        inputs = generation_inputs()
+        inputs.prompt = prompt.encode("UTF-8")
+        inputs.memory = memory.encode("UTF-8")
+        for n in range(images_max):
+            inputs.images[n] = "".encode("UTF-8")
+        inputs.max_context_length = genparams.get('max_context_length', maxctx)
+        inputs.max_length = genparams.get('max_length', 200)
+        for key, field, kind, default in GenerationInputsMarshaller.sampler_fields:
+            setattr(inputs, field, genparams.get(key, default))
+        inputs.grammar = genparams.get('grammar', '').encode("UTF-8")
+        breakers = genparams.get('dry_sequence_breakers', [])[:dry_seq_break_max]
+        inputs.dry_sequence_breakers_len = len(breakers)
+        inputs.dry_sequence_breakers = (ctypes.c_char_p * len(breakers))()
+        for n, breaker in enumerate(breakers):
+            inputs.dry_sequence_breakers[n] = breaker.encode("UTF-8")
+        for i, sampler in enumerate(genparams.get('sampler_order', [])):
+            inputs.sampler_order[i] = sampler
+        stops = genparams.get('stop_sequence', [])[:stop_token_max]
+        inputs.stop_sequence_len = len(stops)
+        inputs.stop_sequence = (ctypes.c_char_p * len(stops))()
+        for n, sequence in enumerate(stops):
+            inputs.stop_sequence[n] = sequence.encode("UTF-8") if sequence else "".encode("UTF-8")
+        bias_list = [{"key": key, "value": value} for key, value in genparams.get('logit_bias', {}).items()][:logit_bias_max]
+        inputs.logit_biases_len = len(bias_list)
+        inputs.logit_biases = (logit_bias * len(bias_list))()
+        for n, lb in enumerate(bias_list):
+            bias = float(lb['value'])
+            inputs.logit_biases[n] = logit_bias(max(int(lb['key']), -1), min(max(bias, bias_min_value), bias_max_value))
+        banned = genparams.get('banned_tokens', [])[:ban_token_max]
+        inputs.banned_tokens_len = len(banned)
+        inputs.banned_tokens = (ctypes.c_char_p * len(banned))()
+        for n, tok in enumerate(banned):
+            inputs.banned_tokens[n] = tok.encode("UTF-8")
+        return inputs
+
+    marshaller = GenerationInputsMarshaller()
+    results = {}
+    for mode in ("legacy", "cold", "warm"):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if mode == "legacy":
+                legacy_build(genparams, "Hello there", "")
+                continue
+            if mode == "cold":
+                marshaller.presets.clear()
+            marshaller.build(genparams, "Hello there", "", False, True)
+        results[mode] = (time.perf_counter() - start) / iterations
+    print(f"generation_inputs marshalling over {iterations} requests: {results['legacy']*1e6:.1f} us per request on the old per request path, {results['cold']*1e6:.1f} us with a cold preset cache, {results['warm']*1e6:.1f} us warm ({results['legacy']/max(results['warm'],1e-9):.1f}x)")
+    return results
+
+# GBNF grammar used to force a json array response when openai tools are requested
+# (see https://github.com/ggerganov/llama.cpp/blob/master/grammars/json_arr.gbnf)
+openai_tools_grammar = r"""
+root   ::= arr
+value  ::= object | array | string | number | ("true" | "false" | "null") ws
+arr  ::=
+  "[\n" ws (
+            value
+    (",\n" ws value)*
+  )? "]"
+object ::=
+  "{" ws (
+            string ":" ws value
+    ("," ws string ":" ws value)*
+  )? "}" ws
+array  ::=
+  "[" ws (
+            value
+    ("," ws value)*
+  )? "]" ws
+string ::=
+  "\"" (
+    [^"\\\x7F\x00-\x1F] |
+    "\\" (["\\bfnrt] | "u" [0-9a-fA-F]{4})
+  )* "\"" ws
+number ::= ("-"? ([0-9] | [1-9] [0-9]{0,15})) ("." [0-9]+)? ([eE] [-+]? [1-9] [0-9]{0,15})? ws
+ws ::= | " " | "\n" [ \t]{0,20}
+"""
 
-    if stop_sequence is None:
-        stop_sequence = []
-    stop_sequence = stop_sequence[:stop_token_max]
-    inputs.stop_sequence_len = len(stop_sequence)
-    inputs.stop_sequence = (ctypes.c_char_p * inputs.stop_sequence_len)()
+# Grammars registered through /api/extra/grammar, addressed by the sha256 of their text so a
+# request can send "grammar_id" instead of resending a large grammar every time. Registering
+# compiles the grammar in the backend right away, which rejects invalid grammars up front and
+# leaves the parsed rules cached there, so requests using it skip parsing. The backend keeps its
+# own small cache keyed by content, which also covers grammars sent inline. Entries are evicted
+# least recently used first once over the byte budget; pinned entries are never evicted.
+class GrammarRegistry:
+    def __init__(self, max_bytes=8*1024*1024):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() #id -> {"grammar", "rules", "uses", "pinned"}
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.registered = 0
+        self.resolved = 0
+        self.unknown = 0
+        self.inline = 0
+        self.evictions = 0
+
+    @staticmethod
+    def grammar_id(text):
+        return hashlib.sha256(text.encode("UTF-8", "surrogatepass")).hexdigest()
+
+    def configure(self, max_bytes):
+        evicted = []
+        with self.lock:
+            self.max_bytes = max(0, max_bytes)
+            evicted = self._evict()
+        self._forget(evicted)
+
+    def _evict(self):
+        evicted = []
+        for gid in list(self.entries.keys()):
+            if self.current_bytes <= self.max_bytes:
+                break
+            entry = self.entries[gid]
+            if entry["pinned"]:
+                continue
+            del self.entries[gid]
+            self.current_bytes -= len(entry["grammar"])
+            self.evictions += 1
+            evicted.append(entry["grammar"])
+        return evicted
+
+    def _forget(self, grammars):
+        if has_grammar_cache:
+            for text in grammars:
+                handle.forget_grammar(text.encode("UTF-8"))
+
+    def register(self, text, pinned=False):
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError("grammar must be a non-empty string")
+        gid = self.grammar_id(text)
+        with self.lock:
+            entry = self.entries.get(gid)
+            if entry is not None:
+                self.entries.move_to_end(gid)
+                entry["pinned"] = entry["pinned"] or pinned
+                return gid, entry["rules"]
+        rules = None
+        if has_grammar_cache:
+            rules = handle.compile_grammar(text.encode("UTF-8"))
+            if rules <= 0:
+                raise ValueError("grammar could not be parsed")
+        with self.lock:
+            if gid not in self.entries:
+                self.entries[gid] = {"grammar": text, "rules": rules, "uses": 0, "pinned": pinned}
+                self.current_bytes += len(text)
+                self.registered += 1
+            evicted = self._evict()
+        self._forget(evicted)
+        if gid not in self.entries:
+            raise ValueError(f"grammar is larger than the grammar registry budget of {self.max_bytes} bytes")
+        return gid, rules
+
+    def remove(self, gid):
+        with self.lock:
+            entry = self.entries.get(gid)
+            if entry is None:
+                return False
+            if entry["pinned"]:
+                raise ValueError(f"grammar {gid} is pinned and cannot be removed")
+            del self.entries[gid]
+            self.current_bytes -= len(entry["grammar"])
+        self._forget([entry["grammar"]])
+        return True
 
-    for n, sequence in enumerate(stop_sequence):
-        if sequence:
-            inputs.stop_sequence[n] = sequence.encode("UTF-8")
-        else:
-            inputs.stop_sequence[n] = "".encode("UTF-8")
+    def get(self, gid):
+        with self.lock:
+            entry = self.entries.get(gid)
+            return entry["grammar"] if entry is not None else None
+
+    def resolve(self, genparams):
+        # replaces a grammar_id in the request by the registered grammar, returns an error message for unknown ids
+        gid = genparams.get("grammar_id", None)
+        if not gid:
+            if genparams.get("grammar", None):
+                with self.lock:
+                    self.inline += 1
+            return None
+        with self.lock:
+            entry = self.entries.get(gid) if isinstance(gid, str) else None
+            if entry is None:
+                self.unknown += 1
+                return f"Unknown grammar_id {gid}, register it with /api/extra/grammar first."
+            self.entries.move_to_end(gid)
+            entry["uses"] += 1
+            self.resolved += 1
+        genparams["grammar"] = entry["grammar"]
+        genparams["grammar_source"] = "registered"
+        return None
 
-    bias_list = []
+    def list_entries(self):
+        with self.lock:
+            return [{"id": gid, "bytes": len(e["grammar"]), "rules": e["rules"], "uses": e["uses"], "pinned": e["pinned"]} for gid, e in self.entries.items()]
+
+    def get_stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.current_bytes, "max_bytes": self.max_bytes, "compiled": has_grammar_cache,
+            "registered": self.registered, "resolved": self.resolved, "unknown": self.unknown, "inline": self.inline, "evictions": self.evictions}
+
+grammar_registry = GrammarRegistry()
+
+# Grammars compiled from OpenAI response_format json schemas (and ollama format schemas), cached
+# by the sha256 of the schema text so a repeated schema costs one lookup after its first request.
+# Schemas that fail to convert are cached too, with their error.
+class SchemaGrammarCache:
+    def __init__(self, max_entries=128):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() #digest -> (grammar, error)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.compile_seconds = 0.0
+
+    def get_grammar(self, schema):
+        # returns the grammar for a parsed json schema, raising ValueError if it cannot be converted
+        digest = hashlib.sha256(json_schema_to_grammar.dump_json(schema).encode("UTF-8", "surrogatepass")).digest()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+                self.hits += 1
+        if entry is not None:
+            metrics.inc("koboldcpp_grammar_compiles_total", result="cached")
+        else:
+            start = time.perf_counter()
+            with trace_span("schema_compile"):
+                try:
+                    entry = (json_schema_to_grammar.json_schema_to_grammar(schema), None)
+                except (ValueError, TypeError, AttributeError, KeyError, RecursionError) as e:
+                    entry = (None, str(e))
+            elapsed = time.perf_counter() - start
+            metrics.observe("koboldcpp_grammar_compile_seconds", elapsed)
+            metrics.inc("koboldcpp_grammar_compiles_total", result=("error" if entry[1] is not None else "ok"))
+            with self.lock:
+                self.misses += 1
+                self.errors += (1 if entry[1] is not None else 0)
+                self.compile_seconds += elapsed
+                self.entries[digest] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        if entry[1] is not None:
+            raise ValueError(entry[1])
+        return entry[0]
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "errors": self.errors,
+            "compile_seconds": round(self.compile_seconds, 4), "hit_rate": round(self.hits / lookups, 3) if lookups > 0 else 0}
+
+schema_grammars = SchemaGrammarCache()
+
+def apply_response_format(genparams, api_format):
+    # turns an openai response_format or ollama format schema into a grammar, returns an error message if the schema is unusable
+    schema = None
+    if api_format in (3, 4):
+        response_format = genparams.get('response_format', None)
+        if isinstance(response_format, dict):
+            formattype = response_format.get('type', 'text')
+            if formattype == "json_schema":
+                schemaobj = response_format.get('json_schema', {})
+                schema = schemaobj.get('schema', None) if isinstance(schemaobj, dict) else None
+                if not isinstance(schema, dict):
+                    return "response_format json_schema requires a schema object."
+            elif formattype == "json_object":
+                schema = {"type": "object"}
+    elif api_format in (6, 7):
+        ollamaformat = genparams.get('format', None)
+        if ollamaformat == "json":
+            schema = {"type": "object"}
+        elif isinstance(ollamaformat, dict):
+            schema = ollamaformat
+    if schema is None or genparams.get('grammar', None):
+        return None
     try:
-        if logit_biases and len(logit_biases) > 0:
-            bias_list = [{"key": key, "value": value} for key, value in logit_biases.items()]
-    except Exception as ex:
-        print(f"Logit bias dictionary is invalid: {ex}")
+        genparams["grammar"] = schema_grammars.get_grammar(schema)
+        genparams["grammar_source"] = "json_schema"
+    except ValueError as e:
+        return f"Invalid JSON schema in response format: {e}"
+    return None
 
-    bias_list = bias_list[:logit_bias_max]
-    inputs.logit_biases_len = len(bias_list)
-    inputs.logit_biases = (logit_bias * inputs.logit_biases_len)()
-    for n, lb in enumerate(bias_list):
-        try:
-            t_id = int(lb['key'])
-            bias = float(lb['value'])
-            t_id = -1 if t_id < 0 else t_id
-            bias = (bias_max_value if bias > bias_max_value else (bias_min_value if bias < bias_min_value else bias))
-            inputs.logit_biases[n] = logit_bias(t_id, bias)
-        except Exception as ex:
-            inputs.logit_biases[n] = logit_bias(-1, 0.0)
-            print(f"Skipped unparsable logit bias:{ex}")
+def record_generation_metrics(ret, backend_start, backend_end, grammar_source):
+    if ret.status != 1:
+        return
+    metrics.observe("koboldcpp_generation_seconds", backend_end - backend_start, grammar=grammar_source)
+    processtime = max(0.0, handle.get_last_process_time())
+    evaltime = max(0.0, handle.get_last_eval_time())
+    processed = handle.get_last_reprocessed_tokens() if has_reuse_stats else ret.prompt_tokens
+    metrics.inc("koboldcpp_prompt_tokens_total", ret.prompt_tokens)
+    metrics.inc("koboldcpp_generated_tokens_total", ret.completion_tokens)
+    if processtime > 0 and processed > 0:
+        metrics.observe("koboldcpp_prompt_tokens_per_second", processed / processtime)
+    if evaltime > 0 and ret.completion_tokens > 0:
+        metrics.observe("koboldcpp_generation_tokens_per_second", ret.completion_tokens / evaltime)
+    arrival = request_arrival.get()
+    if arrival is not None and ret.completion_tokens > 0:
+        metrics.observe("koboldcpp_time_to_first_token_seconds", (backend_start - arrival) + processtime)
+
+def generate(genparams, is_quiet=False, stream_flag=False):
+    global maxctx, args, currentusergenkey, totalgens, pendingabortkey
 
-    if banned_tokens is None:
-        banned_tokens = []
-    banned_tokens = banned_tokens[:ban_token_max]
-    inputs.banned_tokens_len = len(banned_tokens)
-    inputs.banned_tokens = (ctypes.c_char_p * inputs.banned_tokens_len)()
-    for n, tok in enumerate(banned_tokens):
-        inputs.banned_tokens[n] = tok.encode("UTF-8")
+    cachekey = response_cache.make_key(genparams, stream_flag)
+    if cachekey is not None:
+        cached = response_cache.get(cachekey)
+        if cached is not None:
+            currentusergenkey = genparams.get('genkey', '')
+            totalgens += 1
+            return cached
+
+    prompt = genparams.get('prompt', "")
+    memory = genparams.get('memory', "")
+    
+    kcpp_log.request_debug("prompt", "\n================================\n接收到的消息：%s\n当前的记忆：%s\n--------------------------------", prompt, memory)
+    with trace_span("template_render"):
+        prompt, memory, prompt_template_state = koboldcpp_promt_template.prompt_template(
+            prompt, memory, selected_template[0], selected_template[1])
+    kcpp_log.request_debug("templated_prompt", "模板处理后的消息：%s\n当前的记忆：%s\n================================\n", prompt, memory)
+    
+    marshal_start = time.perf_counter()
+    inputs = inputs_marshaller.build(genparams, prompt, memory, stream_flag, is_quiet)
+    stop_sequence = genparams.get('stop_sequence', [])
+    genkey = genparams.get('genkey', '')
+    trimstop = genparams.get('trim_stop', True)
 
     currentusergenkey = genkey
     totalgens += 1
+    trace_add("marshal_inputs", marshal_start)
     #early exit if aborted
 
     if pendingabortkey!="" and pendingabortkey==genkey:
-        print(f"\nDeferred Abort for GenKey: {pendingabortkey}")
+        utfprint(f"\nDeferred Abort for GenKey: {pendingabortkey}")
         pendingabortkey = ""
+        inputs_marshaller.release(inputs)
         return {"text":"","status":-1,"stopreason":-1, "prompt_tokens":0, "completion_tokens": 0, "total_tokens": 0}
     else:
-        ret = handle.generate(inputs)
+        restorestate = genparams.get('restore_state', "")
+        if restorestate and isinstance(restorestate, str) and not context_snapshots.restore(restorestate):
+            utfprint(f"\nContext snapshot '{restorestate}' could not be restored, processing prompt normally.", "warning")
+        backend_start = time.perf_counter()
+        try:
+            ret = handle.generate(inputs)
+        finally:
+            inputs_marshaller.release(inputs)
+        backend_end = time.perf_counter()
+        record_generation_metrics(ret, backend_start, backend_end, genparams.get('grammar_source', "inline" if genparams.get('grammar', '') else "none"))
+        if request_tracer.current.get() is not None: #split the backend call using its own timings
+            processtime = max(0.0, handle.get_last_process_time())
+            evaltime = max(0.0, handle.get_last_eval_time())
+            trace_add("backend_generate", backend_start, backend_end, prompt_tokens=ret.prompt_tokens, completion_tokens=ret.completion_tokens)
+            trace_add("prompt_processing", backend_start, min(backend_end, backend_start + processtime))
+            trace_add("decode", min(backend_end, backend_start + processtime), min(backend_end, backend_start + processtime + evaltime))
+        savestate = genparams.get('save_state', "")
+        if savestate and isinstance(savestate, str) and ret.status==1:
+            context_snapshots.save(savestate)
         outstr = ""
         if ret.status==1:
             outstr = ret.text.decode("UTF-8","ignore")
         if trimstop:
-            for trim_str in stop_sequence:
-                sindex = outstr.find(trim_str)
-                if sindex != -1 and trim_str!="":
-                    outstr = outstr[:sindex]
+            outstr = StopSequenceMatcher(stop_sequence).trim(outstr)
         # outstr = koboldcpp_promt_template.out_post_process(outstr, prompt_template_state)
-        return {"text":outstr,"status":ret.status,"stopreason":ret.stopreason,"prompt_tokens":ret.prompt_tokens, "completion_tokens": ret.completion_tokens}
+        result = {"text":outstr,"status":ret.status,"stopreason":ret.stopreason,"prompt_tokens":ret.prompt_tokens, "completion_tokens": ret.completion_tokens}
+        if cachekey is not None:
+            response_cache.put(cachekey, result)
+        if has_reuse_stats:
+            result["reused_tokens"] = handle.get_last_reused_tokens()
+            result["reprocessed_tokens"] = handle.get_last_reprocessed_tokens()
+            modelbusy.record_reuse(result["reused_tokens"], result["reprocessed_tokens"])
+            if not is_quiet:
+                utfprint(f"\nContext reuse: {result['reused_tokens']} tokens fast forwarded, {result['reprocessed_tokens']} tokens processed")
+        return result
 
 
 def sd_load_model(model_filename,vae_filename,lora_filename,t5xxl_filename,clipl_filename,clipg_filename):
@@ -1158,7 +3145,7 @@ def sd_comfyui_tranform_params(genparams):
         temp = temp.get('inputs', {})
         genparams["negative_prompt"] = temp.get("text", "")
     else:
-        print("Warning: ComfyUI Payload Missing!")
+        utfprint("Warning: ComfyUI Payload Missing!", "warning")
     return genparams
 
 def sd_generate(genparams):
@@ -1206,7 +3193,7 @@ def sd_generate(genparams):
         sample_steps = (40 if sample_steps > 40 else sample_steps)
         reslimit = int(args.sdclamped)
         reslimit = (512 if reslimit<512 else reslimit)
-        print(f"\nImgGen: Clamped Mode (For Shared Use). Step counts and resolution are clamped to {reslimit}x{reslimit}.")
+        utfprint(f"\nImgGen: Clamped Mode (For Shared Use). Step counts and resolution are clamped to {reslimit}x{reslimit}.", "warning")
 
     biggest = max(width,height)
     if biggest > reslimit:
@@ -1251,6 +3238,7 @@ def whisper_generate(genparams):
     is_quiet = True if (args.quiet or args.debugmode == -1) else False
     prompt = genparams.get("prompt", "")
     audio_data = genparams.get("audio_data", "")
+    audio_bytes = genparams.get("audio_bytes", None) #raw wav from a file upload, no base64 needed
     if audio_data.startswith("data:audio"):
         audio_data = audio_data.split(",", 1)[1]
     inputs = whisper_generation_inputs()
@@ -1258,28 +3246,76 @@ def whisper_generate(genparams):
     inputs.audio_data = audio_data.encode("UTF-8")
     inputs.quiet = is_quiet
     inputs.suppress_non_speech = genparams.get("suppress_non_speech", False)
+    if audio_bytes:
+        audio_buf = (ctypes.c_char * len(audio_bytes)).from_buffer(audio_bytes) #shares the upload buffer, must outlive the call
+        inputs.audio_bytes = ctypes.addressof(audio_buf)
+        inputs.audio_bytes_len = len(audio_bytes)
     ret = handle.whisper_generate(inputs)
     outstr = ""
     if ret.status==1:
         outstr = ret.data.decode("UTF-8","ignore")
     return outstr
 
-def tokenize_ids(countprompt,tcaddspecial):
+def read_c_array(ptr, count, typecode):
+    # bulk copy of a backend array into a packed python array, without touching each element via ctypes
+    arr = array.array(typecode)
+    if count > 0 and ptr:
+        arr.frombytes(ctypes.string_at(ptr, count * arr.itemsize))
+    return arr
+
+def ids_from_token_outputs(rawtokens):
+    count = rawtokens.count
+    if count > max_tokenize_len: # protects the server in case the count got corrupted
+        utfprint(f"Warning: token array of length {count} exceeds the limit of {max_tokenize_len} (see --tokenizelimit) and was discarded.", "warning")
+        return []
+    return read_c_array(rawtokens.ids, count, 'i').tolist()
+
+def token_outputs_from_ids(tokids):
+    # returns a token_count_outputs pointing into a packed int array, which the caller must keep alive
+    arr = array.array('i', tokids)
+    outputs = token_count_outputs()
+    outputs.count = len(arr)
+    if len(arr) > 0:
+        outputs.ids = ctypes.cast(arr.buffer_info()[0], ctypes.POINTER(ctypes.c_int))
+    return outputs, arr
+
+def tokenize_ids_uncached(countprompt,tcaddspecial):
     rawcountdata = handle.token_count(countprompt.encode("UTF-8"),tcaddspecial)
-    countlimit = rawcountdata.count if (rawcountdata.count>=0 and rawcountdata.count<50000) else 0
-    # the above protects the server in case the count limit got corrupted
-    countdata = [rawcountdata.ids[i] for i in range(countlimit)]
-    return countdata
+    return ids_from_token_outputs(rawcountdata)
+
+def tokenize_ids(countprompt,tcaddspecial):
+    return tokenize_cache.tokenize(countprompt, tcaddspecial, tokenize_ids_uncached)
+
+def get_context_ids():
+    return ids_from_token_outputs(handle.get_context_tokens())
+
+def get_prefix_routing_ids(body):
+    # token ids for the start of a text generation request, so the scheduler can group shared prefixes
+    try:
+        reqjson = json.loads(body)
+    except Exception:
+        return None
+    if not isinstance(reqjson, dict):
+        return None
+    text = ""
+    if isinstance(reqjson.get("prompt", None), str):
+        memory = reqjson.get("memory", "")
+        text = (memory if isinstance(memory, str) else "") + reqjson["prompt"]
+    elif isinstance(reqjson.get("messages", None), list):
+        for message in reqjson["messages"]:
+            if isinstance(message, dict) and isinstance(message.get("content", None), str):
+                text += f"{message.get('role', '')}\n{message['content']}\n"
+            if len(text) >= prefix_routing_chars:
+                break
+    if text == "":
+        return None
+    return tokenize_ids(text[:prefix_routing_chars], False)
 
 def detokenize_ids(tokids):
     tokidslen = len(tokids)
     detokstr = ""
-    if tokidslen > 0 and tokidslen < 65536:
-        inputs = token_count_outputs()
-        inputs.count = tokidslen
-        inputs.ids = (ctypes.c_int * tokidslen)()
-        for i, cid in enumerate(tokids):
-            inputs.ids[i] = cid
+    if tokidslen > 0 and tokidslen <= max_tokenize_len:
+        inputs, keepalive = token_outputs_from_ids(tokids)
         detok = handle.detokenize(inputs)
         detokstr = ctypes.string_at(detok).decode("UTF-8","ignore")
     return detokstr
@@ -1316,40 +3352,286 @@ def extract_json_from_string(input_string):
         pass
     return []
 
-def parse_last_logprobs(lastlogprobs):
+# Incremental parser for the tool call json a model writes when openai tools are requested, fed
+# with each streamed text chunk. It follows the json structure character by character and turns
+# each call into openai tool_calls deltas: a header with the id and function name as soon as the
+# name string is complete, then the raw text of the arguments value as it arrives. Calls may be
+# written as {"function": {"name", "arguments"}} or as {"name", "arguments"} directly. Text before
+# the json is passed through as content, and if the json holds no calls it is returned as content.
+class ToolCallStreamParser:
+    arguments_keys = ("arguments", "parameters")
+
+    def __init__(self):
+        self.stack = [] #open containers: [kind, current key or index, expecting a key]
+        self.started = False
+        self.done = False
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.string_is_key = False
+        self.scalar = False
+        self.raw = [] #json text seen so far, returned as content if it holds no tool calls
+        self.calls = [] #per call: {"id", "name", "index", "pending"}, index is set once the header is sent
+        self.capture_call = -1 #call whose arguments value is being read
+        self.capture_depth = 0 #container depth the arguments value started at
+        self.capture_start = 0 #raw offset of the arguments value
+        self.capture_sent = 0 #raw offset up to which the arguments were passed on
+
+    def _call_field(self):
+        # maps the current json path to (call number, field) for the fields of a tool call, or None
+        path = [frame[1] for frame in self.stack]
+        if self.stack and self.stack[0][0] == "obj": #a single call without the surrounding array
+            callnum, rest = 0, path
+        elif len(path) > 1:
+            callnum, rest = path[0], path[1:]
+        else:
+            return None
+        if len(rest) == 2 and rest[0] == "function":
+            rest = rest[1:]
+        if len(rest) == 1 and rest[0] in ("id", "name") + self.arguments_keys:
+            return callnum, ("arguments" if rest[0] in self.arguments_keys else rest[0])
+        return None
+
+    def _call(self, callnum):
+        while len(self.calls) <= callnum:
+            self.calls.append({"id": None, "name": None, "index": None, "pending": []})
+        return self.calls[callnum]
+
+    def _emit(self, callnum, out):
+        call = self.calls[callnum]
+        if call["index"] is None:
+            if call["name"] is None: #arguments written before the name wait for it
+                return
+            call["index"] = sum(1 for c in self.calls if c["index"] is not None)
+            out.append({"index": call["index"], "id": (call["id"] if call["id"] else f"call_{os.urandom(12).hex()}"), "type": "function", "function": {"name": call["name"], "arguments": ""}})
+        if call["pending"]:
+            out.append({"index": call["index"], "function": {"arguments": "".join(call["pending"])}})
+            call["pending"] = []
+
+    def _pass_arguments(self, end):
+        if end > self.capture_sent:
+            self.calls[self.capture_call]["pending"].append("".join(self.raw[self.capture_sent:end]))
+            self.capture_sent = end
+
+    def _value_start(self):
+        # called on the first character of every value, starts capturing a tool call's arguments
+        if self.capture_call < 0:
+            field = self._call_field()
+            if field is not None and field[1] == "arguments":
+                self._call(field[0])
+                self.capture_call = field[0]
+                self.capture_depth = len(self.stack)
+                self.capture_start = self.capture_sent = len(self.raw) - 1
+
+    def _value_end(self, end, out, text=None):
+        # end is the raw offset just past the value, text the decoded value of a string
+        if self.capture_call >= 0 and len(self.stack) == self.capture_depth:
+            if text is not None: #string arguments already hold the json text, pass it on decoded
+                self.calls[self.capture_call]["pending"] = [text]
+            else:
+                self._pass_arguments(end)
+            self._emit(self.capture_call, out)
+            self.capture_call = -1
+        elif self.capture_call < 0 and text is not None:
+            field = self._call_field()
+            if field is not None and field[1] in ("id", "name"):
+                self._call(field[0])[field[1]] = text
+                if field[1] == "name":
+                    self._emit(field[0], out)
+
+    def feed(self, text):
+        # returns (content text, tool_calls deltas) for this chunk
+        content = []
+        out = []
+        for c in text:
+            if self.done:
+                if not c.isspace():
+                    content.append(c)
+                continue
+            if not self.started:
+                if c not in "[{":
+                    content.append(c)
+                    continue
+                self.started = True
+            self.raw.append(c)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    strtext = "".join(self.raw[self.string_start:])
+                    try:
+                        strtext = json.loads(strtext)
+                    except ValueError:
+                        strtext = strtext[1:-1]
+                    if self.string_is_key:
+                        self.stack[-1][1] = strtext
+                        self.stack[-1][2] = False
+                    else:
+                        self._value_end(len(self.raw), out, strtext)
+                continue
+            if self.scalar:
+                if c.isalnum() or c in "+-.":
+                    continue
+                self.scalar = False
+                self._value_end(len(self.raw) - 1, out)
+            if c.isspace() or c == ":":
+                continue
+            if c == ",":
+                if self.stack:
+                    if self.stack[-1][0] == "arr":
+                        self.stack[-1][1] += 1
+                    else:
+                        self.stack[-1][2] = True
+            elif c in "]}":
+                if self.stack:
+                    self.stack.pop()
+                if self.stack:
+                    self._value_end(len(self.raw), out)
+                else:
+                    self.done = True
+            elif c == '"':
+                self.in_string = True
+                self.string_start = len(self.raw) - 1
+                self.string_is_key = bool(self.stack) and self.stack[-1][0] == "obj" and self.stack[-1][2]
+                if not self.string_is_key:
+                    self._value_start()
+            elif c in "[{":
+                self._value_start()
+                self.stack.append(["arr", 0, False] if c == "[" else ["obj", None, True])
+            else: #number, true, false or null
+                self.scalar = True
+                self._value_start()
+        if self.capture_call >= 0 and len(self.stack) > self.capture_depth: #arguments object still open
+            self._pass_arguments(len(self.raw))
+            self._emit(self.capture_call, out)
+        return "".join(content), out
+
+    def has_calls(self):
+        return any(call["index"] is not None for call in self.calls)
+
+    def finish(self):
+        # returns the content and tool_calls deltas still owed once generation has ended
+        out = []
+        if self.capture_call >= 0 and self.scalar:
+            self._pass_arguments(len(self.raw))
+        for callnum in range(len(self.calls)):
+            if self.calls[callnum]["index"] is not None:
+                self._emit(callnum, out)
+        return ("" if self.has_calls() else "".join(self.raw)), out
+
+token_piece_cache = {-1: ""} #token id -> piece text, pieces never change for a loaded model
+logprob_fetch_lock = threading.Lock() #the backend reuses one set of column buffers, and one piece string, for every call
+
+def get_token_pieces(ids):
+    cache = token_piece_cache
+    missing = set(ids).difference(cache)
+    if missing:
+        with logprob_fetch_lock: #the returned pointer is only valid until the next get_token_piece call
+            for tid in missing:
+                piece = handle.get_token_piece(tid)
+                cache[tid] = sys.intern(piece.decode("UTF-8","ignore")) if piece else ""
+    return [cache[tid] for tid in ids]
+
+# Logprobs for a span of generated tokens, kept as columns: packed arrays of logprobs and
+# option counts plus lists of interned token strings, with stride top candidates per token.
+# They are copied out of the backend in bulk and only expanded into the per token JSON
+# shapes by to_dict when a response is serialized.
+class LogprobColumns:
+    utf8_cache = {} #piece -> list of its utf-8 byte values, as openai reports them
+
+    def __init__(self, tokens, token_logprobs, option_counts, top_tokens, top_logprobs, stride=logprobs_max, token_ids=None):
+        self.tokens = tokens
+        self.token_logprobs = token_logprobs
+        self.option_counts = option_counts
+        self.top_tokens = top_tokens
+        self.top_logprobs = top_logprobs
+        self.stride = stride
+        self.token_ids = token_ids
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @classmethod
+    def from_backend(cls, start=0, end=-1):
+        with logprob_fetch_lock:
+            cols = handle.get_logprob_columns(start, end)
+            count = max(0, cols.count)
+            stride = cols.stride
+            ids = read_c_array(cols.selected_ids, count, 'i')
+            logprobs = read_c_array(cols.selected_logprobs, count, 'f')
+            option_counts = read_c_array(cols.option_counts, count, 'i')
+            top_ids = read_c_array(cols.top_ids, count * stride, 'i')
+            top_logprobs = read_c_array(cols.top_logprobs, count * stride, 'f')
+        return cls(get_token_pieces(ids), logprobs, option_counts, get_token_pieces(top_ids), top_logprobs, stride, ids)
+
+    @classmethod
+    def from_items(cls, lastlogprobs):
+        # for libraries without get_logprob_columns, reads the older per token structs
+        count = max(0, lastlogprobs.count)
+        stride = logprobs_max
+        tokens = []
+        logprobs = array.array('f')
+        option_counts = array.array('i')
+        top_tokens = []
+        top_logprobs = array.array('f')
+        decoded = {None: ""}
+        items = ctypes.cast(lastlogprobs.logprob_items, ctypes.POINTER(logprob_item * count)).contents if count > 0 else []
+        for item in items:
+            options = min(item.option_count, stride)
+            for raw in (item.selected_token, *item.tokens[:options]):
+                if raw not in decoded:
+                    decoded[raw] = sys.intern(raw.decode("UTF-8","ignore"))
+            tokens.append(decoded[item.selected_token])
+            logprobs.append(item.selected_logprob)
+            option_counts.append(options)
+            top_tokens.extend([decoded[raw] for raw in item.tokens[:options]] + [""] * (stride - options))
+            top_logprobs.extend(item.logprobs[:options] + [0.0] * (stride - options))
+        return cls(tokens, logprobs, option_counts, top_tokens, top_logprobs, stride)
+
+    def utf8(self, piece):
+        cached = self.utf8_cache.get(piece)
+        if cached is None:
+            cached = self.utf8_cache[piece] = list(piece.encode('utf-8'))
+        return cached
+
+    def to_dict(self, text_offset=0):
+        # openai completion fields (tokens, token_logprobs, top_logprobs, text_offset) and chat content in one dict
+        content = []
+        top_dicts = []
+        text_offsets = []
+        token_logprobs = self.token_logprobs.tolist()
+        top_logprobs = self.top_logprobs.tolist()
+        stride = self.stride
+        for i, token in enumerate(self.tokens):
+            base = i * stride
+            top_items = []
+            tops = {}
+            for j in range(base, base + self.option_counts[i]):
+                tokstr = self.top_tokens[j]
+                tops[tokstr] = top_logprobs[j]
+                top_items.append({'logprob': top_logprobs[j], 'token': tokstr, 'bytes': self.utf8(tokstr)})
+            content.append({'token': token, 'logprob': token_logprobs[i], 'bytes': self.utf8(token), 'top_logprobs': top_items})
+            top_dicts.append(tops)
+            text_offsets.append(text_offset)
+            text_offset += len(token)
+        return {'content': content, 'tokens': list(self.tokens), 'token_logprobs': token_logprobs, 'top_logprobs': top_dicts, 'text_offset': text_offsets}
+
+def get_last_logprobs(start=0, end=-1):
+    if has_logprob_columns:
+        return LogprobColumns.from_backend(start, end)
+    lastlogprobs = handle.last_logprobs()
     if not lastlogprobs:
         return None
-    logprobsdict = {}
-    logprobsdict['content'] = []
-    logprobsdict['tokens'] = []
-    logprobsdict['token_logprobs'] = []
-    logprobsdict['top_logprobs'] = []
-    logprobsdict['text_offset'] = []
-    text_offset_counter = 0
-    for i in range(lastlogprobs.count):
-        lp_content_item = {}
-        logprob_item = lastlogprobs.logprob_items[i]
-        toptoken = ctypes.string_at(logprob_item.selected_token).decode("UTF-8","ignore")
-        logprobsdict['tokens'].append(toptoken)
-        lp_content_item['token'] = toptoken
-        logprobsdict['token_logprobs'].append(logprob_item.selected_logprob)
-        lp_content_item['logprob'] = logprob_item.selected_logprob
-        lp_content_item['bytes'] = list(toptoken.encode('utf-8'))
-        lp_content_item['top_logprobs'] = []
-        logprobsdict['text_offset'].append(text_offset_counter)
-        text_offset_counter += len(toptoken)
-        tops = {}
-        for j in range(min(logprob_item.option_count,logprobs_max)):
-            tl_item = {}
-            tl_item['logprob'] = logprob_item.logprobs[j]
-            tokstr = ctypes.string_at(logprob_item.tokens[j]).decode("UTF-8","ignore")
-            tops[tokstr] = logprob_item.logprobs[j]
-            tl_item['token'] = tokstr
-            tl_item['bytes'] = list(tokstr.encode('utf-8'))
-            lp_content_item['top_logprobs'].append(tl_item)
-        logprobsdict['top_logprobs'].append(tops)
-        logprobsdict['content'].append(lp_content_item)
-    return logprobsdict
+    return LogprobColumns.from_items(lastlogprobs)
+
+def expand_lazy_json(obj):
+    # json.dumps default hook, turns deferred response parts into plain json values
+    if isinstance(obj, LogprobColumns):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 def transform_genparams(genparams, api_format):
     global chatcompl_adapter, maxctx
@@ -1449,33 +3731,9 @@ def transform_genparams(genparams, api_format):
                         genparams["temperature"] = 0.2
                         genparams["using_openai_tools"] = True
 
-                        # Set grammar to llamacpp example grammar to force json response (see https://github.com/ggerganov/llama.cpp/blob/master/grammars/json_arr.gbnf)
-                        genparams["grammar"] = r"""
-root   ::= arr
-value  ::= object | array | string | number | ("true" | "false" | "null") ws
-arr  ::=
-  "[\n" ws (
-            value
-    (",\n" ws value)*
-  )? "]"
-object ::=
-  "{" ws (
-            string ":" ws value
-    ("," ws string ":" ws value)*
-  )? "}" ws
-array  ::=
-  "[" ws (
-            value
-    ("," ws value)*
-  )? "]" ws
-string ::=
-  "\"" (
-    [^"\\\x7F\x00-\x1F] |
-    "\\" (["\\bfnrt] | "u" [0-9a-fA-F]{4})
-  )* "\"" ws
-number ::= ("-"? ([0-9] | [1-9] [0-9]{0,15})) ("." [0-9]+)? ([eE] [-+]? [1-9] [0-9]{0,15})? ws
-ws ::= | " " | "\n" [ \t]{0,20}
-"""
+                        # Set grammar to llamacpp example grammar to force json response
+                        genparams["grammar"] = openai_tools_grammar
+                        genparams["grammar_source"] = "tools"
                 if message['role'] == "system":
                     messages_string += system_message_end
                 elif message['role'] == "user":
@@ -1515,7 +3773,7 @@ ws ::= | " " | "\n" [ \t]{0,20}
         try:
             detokstr = detokenize_ids(tokids)
         except Exception as e:
-            utfprint("Ollama Context Error: " + str(e))
+            utfprint("Ollama Context Error: " + str(e), "error")
         ollamasysprompt = genparams.get('system', "")
         ollamabodyprompt = f"{detokstr}{user_message_start}{genparams.get('prompt', '')}{assistant_message_start}"
         ollamaopts = genparams.get('options', {})
@@ -1542,9 +3800,105 @@ ws ::= | " " | "\n" [ \t]{0,20}
         genparams["prompt"] = ollamasysprompt + ollamabodyprompt
     return genparams
 
+# Incremental multipart/form-data parser. The request body is fed in as it is read from the socket,
+# so an uploaded file is collected once into its part buffer instead of being buffered whole,
+# split and re-encoded.
+class MultipartParser:
+    PREAMBLE = 0
+    HEADERS = 1
+    DATA = 2
+    DONE = 3
+
+    def __init__(self, boundary, max_parts=32, max_header_bytes=16384):
+        self.delimiter = b"\r\n--" + boundary
+        self.buffer = bytearray(b"\r\n") #lets the first boundary match the same delimiter
+        self.state = self.PREAMBLE
+        self.parts = []
+        self.current = None
+        self.max_parts = max_parts
+        self.max_header_bytes = max_header_bytes
+
+    def feed(self, data):
+        if self.state == self.DONE:
+            return
+        self.buffer += data
+        self._parse()
+
+    def close(self):
+        if self.state != self.DONE:
+            raise ValueError("Multipart body ended before the closing boundary")
+
+    def _parse(self):
+        while True:
+            if self.state == self.HEADERS:
+                idx = self.buffer.find(b"\r\n\r\n")
+                if idx < 0:
+                    if len(self.buffer) > self.max_header_bytes:
+                        raise ValueError("Multipart part headers are too large")
+                    return
+                headers = {}
+                for line in bytes(self.buffer[:idx]).decode("utf-8", "ignore").split("\r\n"):
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                disposition = headers.get("content-disposition", "")
+                namematch = re.search(r'(?:^|;)\s*name="([^"]*)"', disposition)
+                filematch = re.search(r'filename="([^"]*)"', disposition)
+                self.current = {"name": (namematch.group(1) if namematch else ""), "filename": (filematch.group(1) if filematch else None),
+                "content_type": headers.get("content-type", ""), "data": bytearray()}
+                del self.buffer[:idx+4]
+                self.state = self.DATA
+                continue
+            idx = self.buffer.find(self.delimiter)
+            if idx < 0:
+                keep = len(self.delimiter) - 1 #the delimiter may be split across two reads
+                if len(self.buffer) > keep:
+                    if self.state == self.DATA:
+                        self.current["data"] += self.buffer[:-keep]
+                    del self.buffer[:-keep]
+                return
+            after = idx + len(self.delimiter)
+            if len(self.buffer) < after + 2:
+                if self.state == self.DATA:
+                    self.current["data"] += self.buffer[:idx]
+                del self.buffer[:idx]
+                return
+            if self.state == self.DATA:
+                self.current["data"] += self.buffer[:idx]
+                self.parts.append(self.current)
+                self.current = None
+            if self.buffer[after:after+2] == b"--":
+                self.state = self.DONE
+                self.buffer.clear()
+                return
+            if len(self.parts) >= self.max_parts:
+                raise ValueError("Too many multipart parts")
+            del self.buffer[:after+2]
+            self.state = self.HEADERS
+
+# Wraps a handler's wfile to count response bytes for request accounting.
+def serialize_generation_response(gen):
+    return json.dumps(gen, default=expand_lazy_json).encode()
+
+class CountingWriter:
+    def __init__(self, inner):
+        self.inner = inner
+        self.bytes_written = 0
+
+    def write(self, data):
+        written = self.inner.write(data)
+        self.bytes_written += len(data)
+        return written
+
+    def flush(self):
+        return self.inner.flush()
+
+    def __getattr__(self, name): #everything else (closed, close...) goes to the real stream
+        return getattr(self.inner, name)
+
 class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
     sys_version = ""
     server_version = "ConcedoLlamaForKoboldServer"
+    trace = None #latency trace of the POST being handled
 
     def __init__(self, addr, port):
         self.addr = addr
@@ -1559,28 +3913,80 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
             super().log_message(format, *args)
         pass
 
-    def extract_b64string_from_file_upload(self, body):
-        try:
-            if 'content-type' in self.headers and self.headers['content-type']:
-                boundary = self.headers['content-type'].split("=")[1].encode()
-                if boundary:
-                    fparts = body.split(boundary)
-                    for fpart in fparts:
-                        detected_upload_filename = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', fpart.decode('utf-8',errors='ignore'))
-                        if detected_upload_filename and len(detected_upload_filename)>0:
-                            utfprint(f"Detected uploaded file: {detected_upload_filename[0]}")
-                            file_content_start = fpart.find(b'\r\n\r\n') + 4  # Position after headers
-                            file_content_end = fpart.rfind(b'\r\n')  # Ending boundary
-                            if file_content_start != -1 and file_content_end != -1:
-                                file_data = fpart[file_content_start:file_content_end]
-                                file_data_base64 = base64.b64encode(file_data).decode('utf-8',"ignore")
-                                base64_string = f"data:audio/wav;base64,{file_data_base64}"
-                                return base64_string
-            print("Uploaded file not found.")
-            return None
-        except Exception as e:
-            print(f"File Upload Process Error: {e}")
+    def get_upload_params(self, parser):
+        # builds transcription params from a parsed multipart upload, the file stays as raw bytes
+        genparams = {}
+        for part in parser.parts:
+            if part["name"]=="file" and part["filename"] is not None:
+                utfprint(f"Detected uploaded file: {part['filename']}")
+                genparams["audio_bytes"] = part["data"]
+            elif part["name"]=="suppress_non_speech":
+                genparams["suppress_non_speech"] = part["data"].decode("utf-8", "ignore").strip().lower() in ("1", "true")
+            elif part["name"]!="" and part["filename"] is None:
+                genparams[part["name"]] = part["data"].decode("utf-8", "ignore")
+        if "audio_bytes" not in genparams:
+            utfprint("Uploaded file not found.", "warning")
             return None
+        return genparams
+
+    def read_request_body(self, multipart=None):
+        # reads the body into one preallocated buffer, or streams it into a multipart parser.
+        # returns (body, error message)
+        maxpayload = 1024*1024*32 #32mb payload limit
+        readstart = time.perf_counter()
+        contlenstr = self.headers['content-length']
+        body = b''
+        received = 0
+        try:
+            if contlenstr:
+                content_length = int(contlenstr)
+                if content_length > maxpayload:
+                    return None, "Payload is too big. Max payload size is 32MB."
+                body = bytearray(content_length if multipart is None else min(content_length, 65536))
+                view = memoryview(body)
+                while received < content_length:
+                    if multipart is None:
+                        n = self.rfile.readinto(view[received:])
+                    else:
+                        n = self.rfile.readinto(view[:min(len(view), content_length-received)])
+                        if n:
+                            multipart.feed(view[:n])
+                    if not n:
+                        break
+                    received += n
+                view.release()
+                if multipart is None and received < content_length:
+                    del body[received:]
+            elif self.headers.get('transfer-encoding', '').lower()=="chunked":
+                body = bytearray()
+                chunklimit = 0  # do not process more than 512 chunks, prevents bad actors
+                while True:
+                    chunklimit += 1
+                    line = self.rfile.readline().strip()
+                    chunk_length = max(0,int(line, 16)) if line else 0
+                    if not line or chunklimit > 512 or received+chunk_length > maxpayload:
+                        return None, "Payload is too big. Max payload size is 32MB."
+                    if chunk_length != 0:
+                        chunk = self.rfile.read(chunk_length)
+                        if multipart is None:
+                            body += chunk
+                        else:
+                            multipart.feed(chunk)
+                        received += chunk_length
+                    self.rfile.readline()
+                    if chunk_length == 0:
+                        break
+            if multipart is not None:
+                multipart.close()
+                body = b''
+        except ValueError as e:
+            return None, ("Failed to parse multipart upload: " + str(e)) if multipart is not None else "Failed to parse chunked request."
+        except Exception:
+            return None, "Failed to parse chunked request."
+        finally:
+            self.body_bytes = received
+            self.body_read_time = time.perf_counter() - readstart
+        return body, None
 
     async def generate_text(self, genparams, api_format, stream_flag):
         global friendlymodelname, chatcompl_adapter, currfinishreason
@@ -1597,23 +4003,18 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
             return generate(genparams=genparams,is_quiet=is_quiet,stream_flag=stream_flag)
 
         genout = {"text": "", "status": -1, "stopreason": -1, "prompt_tokens":0, "completion_tokens": 0, "total_tokens": 0}
-        if stream_flag:
-            loop = asyncio.get_event_loop()
-            executor = ThreadPoolExecutor()
-            genout = await loop.run_in_executor(executor, run_blocking)
-        else:
-            genout = run_blocking()
+        genout = await generation_executor.run_async(run_blocking)
 
         recvtxt = genout['text']
         prompttokens = genout['prompt_tokens']
+        cachedtokens = genout.get('reused_tokens', 0)
         comptokens = genout['completion_tokens']
         currfinishreason = ("length" if (genout['stopreason'] != 1) else "stop")
 
         # grab logprobs if not streaming
         logprobsdict = None
         if not stream_flag and ("logprobs" in genparams and genparams["logprobs"]):
-            lastlogprobs = handle.last_logprobs()
-            logprobsdict = parse_last_logprobs(lastlogprobs)
+            logprobsdict = get_last_logprobs() #expanded when the response is serialized
 
         # flag instance as non-idle for a while
         washordereq = genparams.get('genkey', '').startswith('HORDEREQ_')
@@ -1628,7 +4029,7 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
             res = {"data": {"seqs": [recvtxt]}}
         elif api_format == 3:
             res = {"id": "cmpl-A1", "object": "text_completion", "created": int(time.time()), "model": friendlymodelname,
-                   "usage": {"prompt_tokens": prompttokens, "completion_tokens": comptokens, "total_tokens": (prompttokens+comptokens)},
+                   "usage": {"prompt_tokens": prompttokens, "completion_tokens": comptokens, "total_tokens": (prompttokens+comptokens), "prompt_tokens_details": {"cached_tokens": cachedtokens}},
                    "choices": [{"text": recvtxt, "index": 0, "finish_reason": currfinishreason, "logprobs":logprobsdict}]}
         elif api_format == 4:
             using_openai_tools = genparams.get('using_openai_tools', False)
@@ -1638,7 +4039,7 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
                 if tool_calls and len(tool_calls)>0:
                     recvtxt = None
             res = {"id": "chatcmpl-A1", "object": "chat.completion", "created": int(time.time()), "model": friendlymodelname,
-                   "usage": {"prompt_tokens": prompttokens, "completion_tokens": comptokens, "total_tokens": (prompttokens+comptokens)},
+                   "usage": {"prompt_tokens": prompttokens, "completion_tokens": comptokens, "total_tokens": (prompttokens+comptokens), "prompt_tokens_details": {"cached_tokens": cachedtokens}},
                    "choices": [{"index": 0, "message": {"role": "assistant", "content": recvtxt, "tool_calls": tool_calls}, "finish_reason": currfinishreason, "logprobs":logprobsdict}]}
         elif api_format == 5:
             res = {"caption": end_trim_to_sentence(recvtxt)}
@@ -1649,26 +4050,34 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
         elif api_format == 7:
             res = {"model": friendlymodelname,"created_at": str(datetime.now(timezone.utc).isoformat()),"message":{"role":"assistant","content":recvtxt},"done": True,"done_reason":currfinishreason,"total_duration": 1,"load_duration": 1,"prompt_eval_count": prompttokens,"prompt_eval_duration": 1,"eval_count": comptokens,"eval_duration": 1}
         else:
-            res = {"results": [{"text": recvtxt, "finish_reason": currfinishreason, "logprobs":logprobsdict, "prompt_tokens": prompttokens, "completion_tokens": comptokens}]}
+            res = {"results": [{"text": recvtxt, "finish_reason": currfinishreason, "logprobs":logprobsdict, "prompt_tokens": prompttokens, "completion_tokens": comptokens, "cached_tokens": cachedtokens}]}
 
         try:
             return res
         except Exception as e:
-            print(f"Generate: Error while generating: {e}")
+            utfprint(f"Generate: Error while generating: {e}", "error")
 
     async def send_oai_sse_event(self, data):
+        flushstart = time.perf_counter()
         if data=="[DONE]":
             self.wfile.write(f'data: {data}'.encode())
         else:
             self.wfile.write(f'data: {data}\n\n'.encode())
         self.wfile.flush()
+        await self.drain_output()
+        if self.trace is not None:
+            self.trace.accumulate("sse_flush", flushstart, time.perf_counter())
 
     async def send_kai_sse_event(self, data):
+        flushstart = time.perf_counter()
         self.wfile.write('event: message\n'.encode())
         self.wfile.write(f'data: {data}\n\n'.encode())
         self.wfile.flush()
+        await self.drain_output()
+        if self.trace is not None:
+            self.trace.accumulate("sse_flush", flushstart, time.perf_counter())
 
-    async def handle_sse_stream(self, genparams, api_format):
+    async def handle_sse_stream(self, genparams, api_format, start_seq=None, generate_task=None):
         global friendlymodelname, currfinishreason
         self.send_response(200)
         self.send_header("X-Accel-Buffering", "no")
@@ -1677,11 +4086,39 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers(content_type='text/event-stream')
 
         current_token = 0
+        unsent_token = 0 #first token index not yet flushed to the client, for emit delay stats
         incomplete_token_buffer = bytearray()
         async_sleep_short = 0.02
-        await asyncio.sleep(0.35) #anti race condition, prevent check from overtaking generate
+        stream_logprobs = bool(genparams.get("logprobs", False)) and has_logprob_columns
+        streamed_text_len = 0 #text offset of the next logprobs chunk
+        use_push = stream_notifier.supported and start_seq is not None
+        newtokens = None
+
+        async def wait_for_tokens():
+            if use_push:
+                try: #the timeout only guards against a lost wakeup, tokens normally arrive by event
+                    await asyncio.wait_for(newtokens.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+                newtokens.clear()
+            else:
+                await asyncio.sleep(async_sleep_short)
+
+        if use_push:
+            newtokens = stream_notifier.subscribe(asyncio.get_running_loop())
+            # wait for our generation to begin, so stale state from the previous one is never streamed
+            while stream_notifier.generation_seq == start_seq and not (generate_task and generate_task.done()):
+                await wait_for_tokens()
+            if stream_notifier.generation_seq == start_seq: #generation never started (e.g. deferred abort)
+                current_token = unsent_token = handle.get_stream_count()
+        else:
+            await asyncio.sleep(0.35) #anti race condition, prevent check from overtaking generate
         try:
             tokenReserve = "" #keeps fully formed tokens that we cannot send out yet
+            stopmatcher = StopSequenceMatcher(genparams.get('stop_sequence', [])) if genparams.get('trim_stop', True) else None
+            stopSeen = False
+            toolparser = ToolCallStreamParser() if (api_format == 4 and genparams.get('using_openai_tools', False)) else None
+            heldTextLen = 0 #text kept by the tool call parser, counted into the next chunk's logprobs offset
             while True:
                 streamDone = handle.has_finished() #exit next loop on done
                 if streamDone:
@@ -1705,49 +4142,81 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
                         incomplete_token_buffer.clear()
                         tokenStr += tokenSeg
 
+                if stopSeen:
+                    tokenStr = "" #text after a stop sequence is never sent
                 if tokenStr!="" or streamDone:
-                    sseq = genparams.get('stop_sequence', [])
-                    trimstop = genparams.get('trim_stop', True)
-                    if trimstop and not streamDone and string_contains_or_overlaps_sequence_substring(tokenStr,sseq):
+                    if stopmatcher is not None:
+                        stopmatcher.feed(tokenStr)
                         tokenReserve += tokenStr
-                        await asyncio.sleep(async_sleep_short) #if a stop sequence could trigger soon, do not send output
-                    else:
-                        if tokenStr!="" or tokenReserve!="":
-                            tokenStr = tokenReserve + tokenStr
+                        reserveStart = stopmatcher.consumed - len(tokenReserve)
+                        if stopmatcher.match_start >= 0: #send only what precedes the stop sequence
+                            tokenStr = tokenReserve[:max(0, stopmatcher.match_start - reserveStart)]
                             tokenReserve = ""
-
-                            #apply trimming if needed
-                            if trimstop:
-                                for trim_str in sseq:
-                                    sindex = tokenStr.find(trim_str)
-                                    if sindex != -1 and trim_str!="":
-                                        tokenStr = tokenStr[:sindex]
-
-                        if tokenStr!="" or streamDone:
-                            if api_format == 4:  # if oai chat, set format to expected openai streaming response
-                                event_str = json.dumps({"id":"koboldcpp","object":"chat.completion.chunk","created":int(time.time()),"model":friendlymodelname,"choices":[{"index":0,"finish_reason":currfinishreason,"delta":{'role':'assistant','content':tokenStr}}]})
-                                await self.send_oai_sse_event(event_str)
-                            elif api_format == 3:  # non chat completions
-                                event_str = json.dumps({"id":"koboldcpp","object":"text_completion","created":int(time.time()),"model":friendlymodelname,"choices":[{"index":0,"finish_reason":currfinishreason,"text":tokenStr}]})
-                                await self.send_oai_sse_event(event_str)
-                            else:
-                                event_str = json.dumps({"token": tokenStr, "finish_reason":currfinishreason})
-                                await self.send_kai_sse_event(event_str)
+                            stopSeen = True
+                        elif streamDone:
+                            tokenStr = tokenReserve
+                            tokenReserve = ""
+                        else: #hold back anything a stop sequence could still start with
+                            sendable = max(0, len(tokenReserve) - stopmatcher.held_chars())
+                            tokenStr = tokenReserve[:sendable]
+                            tokenReserve = tokenReserve[sendable:]
+
+                    chatdelta = {'role':'assistant','content':tokenStr}
+                    chunkfinishreason = currfinishreason
+                    if toolparser is not None and (tokenStr!="" or streamDone): #tool call json goes out as tool_calls deltas
+                        toolcontent, toolcalls = toolparser.feed(tokenStr)
+                        if streamDone:
+                            endcontent, endcalls = toolparser.finish()
+                            toolcontent += endcontent
+                            toolcalls += endcalls
+                            if toolparser.has_calls() and chunkfinishreason == "stop":
+                                chunkfinishreason = "tool_calls"
+                        chatdelta = {'role':'assistant','content':toolcontent}
+                        if toolcalls:
+                            chatdelta = {'role':'assistant','content':(toolcontent if toolcontent else None),'tool_calls':toolcalls}
+                        elif toolcontent == "" and not streamDone: #nothing complete yet, the text stays with the parser
+                            heldTextLen += len(tokenStr)
                             tokenStr = ""
+
+                    if tokenStr!="" or streamDone:
+                        chunklogprobs = None
+                        if stream_logprobs and current_token > unsent_token: #logprobs for exactly the tokens in this chunk
+                            chunklogprobs = LogprobColumns.from_backend(unsent_token, current_token).to_dict(streamed_text_len)
+                        streamed_text_len += heldTextLen + len(tokenStr)
+                        heldTextLen = 0
+                        if api_format == 4:  # if oai chat, set format to expected openai streaming response
+                            event_str = json.dumps({"id":"koboldcpp","object":"chat.completion.chunk","created":int(time.time()),"model":friendlymodelname,"choices":[{"index":0,"finish_reason":chunkfinishreason,"delta":chatdelta,"logprobs":chunklogprobs}]})
+                            await self.send_oai_sse_event(event_str)
+                        elif api_format == 3:  # non chat completions
+                            event_str = json.dumps({"id":"koboldcpp","object":"text_completion","created":int(time.time()),"model":friendlymodelname,"choices":[{"index":0,"finish_reason":currfinishreason,"text":tokenStr,"logprobs":chunklogprobs}]})
+                            await self.send_oai_sse_event(event_str)
                         else:
-                            await asyncio.sleep(async_sleep_short)
+                            event_data = {"token": tokenStr, "finish_reason":currfinishreason}
+                            if stream_logprobs:
+                                event_data["logprobs"] = chunklogprobs
+                            event_str = json.dumps(event_data)
+                            await self.send_kai_sse_event(event_str)
+                        stream_notifier.record_emitted(unsent_token, current_token)
+                        unsent_token = current_token
+                        tokenStr = ""
+                    else:
+                        await wait_for_tokens()
                 else:
-                    await asyncio.sleep(async_sleep_short) #this should keep things responsive
+                    await wait_for_tokens() #this should keep things responsive
 
                 if streamDone:
                     if api_format == 4 or api_format == 3:  # if oai chat, send last [DONE] message consistent with openai format
                         await self.send_oai_sse_event('[DONE]')
                     break
         except Exception as ex:
-            print("Token streaming was interrupted or aborted!")
-            print(ex)
+            utfprint("Token streaming was interrupted or aborted!", "warning")
+            utfprint(str(ex), "warning")
             handle.abort_generate()
-            time.sleep(0.2) #short delay
+            metrics.inc("koboldcpp_aborts_total", reason="disconnect")
+            await asyncio.sleep(0.2) #short delay
+        finally:
+            if newtokens is not None:
+                stream_notifier.unsubscribe(newtokens)
 
         # flush buffers, sleep a bit to make sure all data sent, and then force close the connection
         self.wfile.flush()
@@ -1759,30 +4228,38 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
     async def handle_request(self, raw_genparams, api_format, stream_flag):
         tasks = []
 
-        genparams = transform_genparams(raw_genparams, api_format)
-        print('\n=================')
-        print("接收到的消息：")
-        print(f"API Format: {api_format}")
-        print(f"GenParams: {genparams}")
-        print('=================\n')
+        with trace_span("transform_genparams"):
+            genparams = await self.run_blocking(transform_genparams, raw_genparams, api_format)
+        kcpp_log.request_debug("genparams", "\n=================\n接收到的消息：\nAPI Format: %s\nGenParams: %s\n=================\n", api_format, genparams)
 
         try:
-            if stream_flag:
-                tasks.append(self.handle_sse_stream(genparams, api_format))
-
+            start_seq = stream_notifier.generation_seq #captured before generation can begin
             generate_task = asyncio.create_task(self.generate_text(genparams, api_format, stream_flag))
+            if stream_flag:
+                tasks.append(self.handle_sse_stream(genparams, api_format, start_seq, generate_task))
             tasks.append(generate_task)
 
             await asyncio.gather(*tasks)
             generate_result = generate_task.result()
             return generate_result
         except (BrokenPipeError, ConnectionAbortedError) as cae: # attempt to abort if connection lost
-            print("An ongoing connection was aborted or interrupted!")
-            print(cae)
+            utfprint("An ongoing connection was aborted or interrupted!", "warning")
+            utfprint(str(cae), "warning")
             handle.abort_generate()
-            time.sleep(0.2) #short delay
+            metrics.inc("koboldcpp_aborts_total", reason="disconnect")
+            await asyncio.sleep(0.2) #short delay
         except Exception as e:
-            print(e)
+            utfprint(str(e), "error")
+
+    async def run_blocking(self, fn, *args):
+        # each threaded server request already runs on its own thread, blocking it is fine
+        return fn(*args)
+
+    async def wait_for_slot(self, **kwargs):
+        return modelbusy.acquire(**kwargs)
+
+    async def drain_output(self): #waits until the client has taken the written data
+        pass
 
     def get_multiplayer_idle_state(self,userid):
         if modelbusy.locked():
@@ -1792,19 +4269,23 @@ class ServerRequestHandler(http.server.SimpleHTTPRequestHandler):
                 return False
         return True
 
+    def has_password_auth(self): #true only if a password is set and the request carries it
+        if not password:
+            return False
+        auth_header = None
+        if 'Authorization' in self.headers:
+            auth_header = self.headers['Authorization']
+        elif 'authorization' in self.headers:
+            auth_header = self.headers['authorization']
+        if auth_header is not None and auth_header.startswith('Bearer '):
+            token = auth_header[len('Bearer '):].strip()
+            return token==password
+        return False
+
     def secure_endpoint(self): #returns false if auth fails. caller should exit
         #handle password stuff
         if password and password !="":
-            auth_header = None
-            auth_ok = False
-            if 'Authorization' in self.headers:
-                auth_header = self.headers['Authorization']
-            elif 'authorization' in self.headers:
-                auth_header = self.headers['authorization']
-            if auth_header is not None and auth_header.startswith('Bearer '):
-                token = auth_header[len('Bearer '):].strip()
-                if token==password:
-                    auth_ok = True
+            auth_ok = self.has_password_auth()
             if auth_ok is False:
                 self.send_response(401)
                 self.end_headers(content_type='application/json')
@@ -2028,10 +4509,10 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
 
         elif self.path.endswith('/model_chatml'):
             if model_template_info is None:
-                gguf = gguf_reader.GGUFReader(args.model_param)
                 content_type = 'text/html'
                 try:
-                    chat_template = gguf.fields['tokenizer.chat_template'].parts[4].tolist()
+                    gguf = gguf_reader.GGUFReader(args.model_param, header_only=True)
+                    chat_template = gguf.fields['tokenizer.chat_template'].contents().encode()
                     model_template_info = chat_template
                 except:
                     chat_template = b''
@@ -2044,18 +4525,19 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 if not koboldcpp_promt_template.ENABLE_TEMPLATE_PROCESSING:
                     curcfg = None
                 else:
-                    curcfg = koboldcpp_promt_template.TemplateHelper(
-                        selected_template[0], selected_template[1]).current_config
+                    curcfg = koboldcpp_promt_template.registry.lookup(
+                        selected_template[0] or 'llama', selected_template[1])[0]
             except Exception as e:
-                utfprint(str(e))
+                utfprint(str(e), "error")
                 curcfg = None
             response_body = json.dumps({"result":curcfg}).encode()
             
         elif self.path.endswith('/available_templates'):
             try:
-                allavailables = koboldcpp_promt_template.TemplateHelper().available_configs
+                koboldcpp_promt_template.registry.refresh()
+                allavailables = koboldcpp_promt_template.registry.available_configs
             except Exception as e:
-                utfprint(str(e))
+                utfprint(str(e), "error")
                 allavailables = None
             response_body = json.dumps({"result":allavailables}).encode()
             
@@ -2073,11 +4555,11 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                     koboldcpp_promt_template.ENABLE_TEMPLATE_PROCESSING = False
                 else:
                     selected_template = (template_modelname, template_modelversion)
-                    print(f"切换上下文模板为：{selected_template}")
+                    utfprint(f"切换上下文模板为：{selected_template}")
                     koboldcpp_promt_template.ENABLE_TEMPLATE_PROCESSING = True
                 response_body = json.dumps({"succeed": 1}).encode()
             except Exception as e:
-                utfprint(str(e))
+                utfprint(str(e), "error")
                 response_body = json.dumps({"succeed": 0}).encode()
 
         elif self.path.endswith(('/api/v1/config/max_length', '/api/latest/config/max_length')):
@@ -2105,6 +4587,45 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             has_whisper = (fullwhispermodelpath!="")
             response_body = (json.dumps({"result":"KoboldCpp","version":KcppVersion, "protected":has_password ,"txt2img":has_txt2img,"vision":has_vision,"transcribe":has_whisper,"multiplayer":has_multiplayer}).encode())
 
+        elif self.path.endswith('/api/extra/grammar'):
+            if not self.secure_endpoint():
+                return
+            response_body = (json.dumps({"grammars": grammar_registry.list_entries(), "stats": grammar_registry.get_stats()}).encode())
+
+        elif '/api/extra/grammar/' in self.path:
+            if not self.secure_endpoint():
+                return
+            gid = self.path.split('/api/extra/grammar/', 1)[1]
+            grammartext = grammar_registry.get(gid)
+            if grammartext is None:
+                self.send_response(404)
+                self.end_headers(content_type='application/json')
+                self.wfile.write(json.dumps({"detail": {"msg": f"Unknown grammar_id {gid}", "type": "not_found"}}).encode())
+                return
+            response_body = (json.dumps({"id": gid, "grammar": grammartext}).encode())
+
+        elif self.path.split('?', 1)[0] in ('/metrics', '/api/extra/metrics'):
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            response_body = metrics.render().encode()
+
+        elif self.path.split('?', 1)[0].endswith('/api/extra/trace'):
+            if not self.secure_endpoint(): #traces expose request paths and timings
+                return
+            import urllib.parse as urlparse
+            parsed_dict = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            tracelimit = tryparseint(parsed_dict['limit'][0]) if 'limit' in parsed_dict else 0
+            tracelimit = tracelimit if isinstance(tracelimit, int) else 0
+            if 'format' in parsed_dict and parsed_dict['format'][0]=="chrome":
+                response_body = (json.dumps(request_tracer.to_chrome_trace(tracelimit)).encode())
+                self.send_response(200)
+                self.send_header('content-length', str(len(response_body)))
+                self.send_header('content-disposition', 'attachment; filename="koboldcpp_trace.json"')
+                self.end_headers(content_type='application/json')
+                self.wfile.write(response_body)
+                return
+            response_body = (json.dumps({"enabled": request_tracer.enabled(), "capacity": request_tracer.capacity, "summary": request_tracer.get_summary(),
+            "traces": [t.to_dict() for t in request_tracer.get_traces(tracelimit)]}).encode())
+
         elif self.path.endswith(('/api/extra/perf')):
             global last_req_time, start_time
             lastp = handle.get_last_process_time()
@@ -2117,13 +4638,18 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             uptime = time.time() - start_time
             idletime = time.time() - last_req_time
             is_quiet = True if (args.quiet and args.debugmode != 1) else False
-            response_body = (json.dumps({"last_process":lastp,"last_eval":laste,"last_token_count":lastc, "last_seed":lastseed, "total_gens":totalgens, "stop_reason":stopreason, "total_img_gens":totalimggens, "queue":requestsinqueue, "idle":(0 if modelbusy.locked() else 1), "hordeexitcounter":exitcounter, "uptime":uptime, "idletime":idletime, "quiet":is_quiet}).encode())
+            response_body = (json.dumps({"last_process":lastp,"last_eval":laste,"last_token_count":lastc, "last_seed":lastseed, "total_gens":totalgens, "stop_reason":stopreason, "total_img_gens":totalimggens, "queue":modelbusy.queue_length(), "idle":(0 if modelbusy.locked() else 1), "scheduler":modelbusy.get_stats(), "stream":stream_notifier.get_stats(), "executor":generation_executor.get_stats(), "response_cache":response_cache.get_stats(), "marshal":inputs_marshaller.get_stats(), "tokenize_cache":tokenize_cache.get_stats(), "grammar":grammar_registry.get_stats(), "schema_grammars":schema_grammars.get_stats(), "context_snapshots":{k:v for k,v in context_snapshots.get_stats().items() if k!="snapshots"}, "requests":request_accounting.get_stats(), "hordeexitcounter":exitcounter, "uptime":uptime, "idletime":idletime, "quiet":is_quiet, "template":koboldcpp_promt_template.registry.get_stats()}).encode())
+
+        elif self.path.endswith('/api/extra/state/list'):
+            if not self.secure_endpoint():
+                return
+            response_body = (json.dumps(context_snapshots.get_stats()).encode())
 
         elif self.path.endswith('/api/extra/generate/check'):
             if not self.secure_endpoint():
                 return
             pendtxtStr = ""
-            if requestsinqueue==0 and totalgens>0 and currentusergenkey=="":
+            if modelbusy.queue_length()==0 and totalgens>0 and currentusergenkey=="":
                 pendtxt = handle.get_pending_output()
                 pendtxtStr = ctypes.string_at(pendtxt).decode("UTF-8","ignore")
             response_body = (json.dumps({"results": [{"text": pendtxtStr}]}).encode())
@@ -2132,10 +4658,9 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             if not self.secure_endpoint():
                 return
             logprobsdict = None
-            if requestsinqueue==0 and totalgens>0 and currentusergenkey=="":
-                lastlogprobs = handle.last_logprobs()
-                logprobsdict = parse_last_logprobs(lastlogprobs)
-            response_body = (json.dumps({"logprobs":logprobsdict}).encode())
+            if modelbusy.queue_length()==0 and totalgens>0 and currentusergenkey=="":
+                logprobsdict = get_last_logprobs()
+            response_body = (json.dumps({"logprobs":logprobsdict}, default=expand_lazy_json).encode())
 
         elif self.path.endswith('/v1/models'):
             response_body = (json.dumps({"object":"list","data":[{"id":friendlymodelname,"object":"model","created":int(time.time()),"owned_by":"koboldcpp","permission":[],"root":"koboldcpp"}]}).encode())
@@ -2185,7 +4710,7 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             chat_template = ctypes.string_at(ctbytes).decode("UTF-8","ignore")
             response_body = (json.dumps({
                 "chat_template": chat_template,
-                "total_slots": 1,
+                "total_slots": modelbusy.total_slots(),
                 "default_generation_settings": {
                     "n_ctx": maxctx,
                 },
@@ -2234,55 +4759,51 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
         return
 
     def do_POST(self):
-        global modelbusy, requestsinqueue, currentusergenkey, totalgens, pendingabortkey, lastgeneratedcomfyimg, multiplayer_turn_major, multiplayer_turn_minor, multiplayer_story_data_compressed, multiplayer_dataformat, multiplayer_lastactive
+        reqstart = self.begin_post()
+        try:
+            pending = self.handle_post()
+            if pending is not None:
+                asyncio.run(pending)
+        finally:
+            self.end_post(reqstart)
+
+    def begin_post(self):
+        reqstart = time.perf_counter()
+        self.body_bytes = 0
+        self.body_read_time = 0.0
+        self.wfile = CountingWriter(self.wfile)
+        self.trace = request_tracer.begin(self.path)
+        self.metrics_format = None #api format label, set once the request is known to be a generation
+        request_arrival.set(reqstart)
+        kcpp_log.begin_request()
+        return reqstart
+
+    def end_post(self, reqstart):
+        request_accounting.record(self.path, self.body_bytes, self.wfile.bytes_written, self.body_read_time, time.perf_counter()-reqstart)
+        if self.metrics_format is not None:
+            metrics.observe("koboldcpp_request_duration_seconds", time.perf_counter()-reqstart, api_format=self.metrics_format)
+        request_tracer.finish(self.trace)
+        request_arrival.set(None)
+        self.wfile = self.wfile.inner
+
+    def handle_post(self):
+        global modelbusy, currentusergenkey, totalgens, pendingabortkey, lastgeneratedcomfyimg, multiplayer_turn_major, multiplayer_turn_minor, multiplayer_story_data_compressed, multiplayer_dataformat, multiplayer_lastactive
         global selected_template
-        contlenstr = self.headers['content-length']
-        content_length = 0
-        body = None
-        if contlenstr:
-            content_length = int(contlenstr)
-            if content_length > (1024*1024*32): #32mb payload limit
-                self.send_response(500)
-                self.end_headers(content_type='application/json')
-                self.wfile.write(json.dumps({"detail": {
-                "msg": "Payload is too big. Max payload size is 32MB.",
-                "type": "bad_input",
-                }}).encode())
-                return
-            body = self.rfile.read(content_length)
-        elif self.headers.get('transfer-encoding', '').lower()=="chunked":
-            content_length = 0
-            chunklimit = 0  # do not process more than 512 chunks, prevents bad actors
-            body = b''
-            try:
-                while True:
-                    chunklimit += 1
-                    line = self.rfile.readline().strip()
-                    if line:
-                        chunk_length = max(0,int(line, 16))
-                        content_length += chunk_length
-                    if not line or chunklimit > 512 or content_length > (1024*1024*32): #32mb payload limit
-                        self.send_response(500)
-                        self.end_headers(content_type='application/json')
-                        self.wfile.write(json.dumps({"detail": {
-                        "msg": "Payload is too big. Max payload size is 32MB.",
-                        "type": "bad_input",
-                        }}).encode())
-                        return
-                    if chunk_length != 0:
-                        chunk = self.rfile.read(chunk_length)
-                        body += chunk
-                    self.rfile.readline()
-                    if chunk_length == 0:
-                        break
-            except Exception:
-                self.send_response(500)
-                self.end_headers(content_type='application/json')
-                self.wfile.write(json.dumps({"detail": {
-                "msg": "Failed to parse chunked request.",
-                "type": "bad_input",
-                }}).encode())
-                return
+        multipart = None
+        if self.path.rstrip('/').endswith(('/api/extra/transcribe', '/v1/audio/transcriptions')) and self.headers.get_content_type()=="multipart/form-data":
+            boundary = self.headers.get_param('boundary')
+            if boundary:
+                multipart = MultipartParser(boundary.encode())
+        with trace_span("body_read"):
+            body, bodyerr = self.read_request_body(multipart)
+        if bodyerr is not None:
+            self.send_response(500)
+            self.end_headers(content_type='application/json')
+            self.wfile.write(json.dumps({"detail": {
+            "msg": bodyerr,
+            "type": "bad_input",
+            }}).encode())
+            return
 
         self.path = self.path.rstrip('/')
         response_body = None
@@ -2299,10 +4820,47 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 response_body = (json.dumps({"value": len(countdata),"ids": countdata}).encode())
 
             except Exception as e:
-                utfprint("Count Tokens - Body Error: " + str(e))
+                utfprint("Count Tokens - Body Error: " + str(e), "error")
                 response_code = 400
                 response_body = (json.dumps({"value": -1}).encode())
                 
+        elif self.path.endswith('/api/extra/tokenize/batch'):
+            if not self.secure_endpoint():
+                return
+            try:
+                genparams = json.loads(body)
+                countprompts = genparams.get('prompts', [])
+                tcaddspecial = genparams.get('special', True)
+                withids = genparams.get('with_ids', True)
+                if not isinstance(countprompts, list) or len(countprompts) > max_tokenize_batch:
+                    raise ValueError(f"prompts must be a list of at most {max_tokenize_batch} strings")
+                results = []
+                for countprompt in countprompts:
+                    countdata = tokenize_ids(str(countprompt),tcaddspecial)
+                    results.append({"value": len(countdata), "ids": countdata} if withids else {"value": len(countdata)})
+                response_body = (json.dumps({"results": results}).encode())
+            except Exception as e:
+                utfprint("Batch Tokenize - Body Error: " + str(e), "error")
+                response_code = 400
+                response_body = (json.dumps({"results": [], "error": str(e)}).encode())
+
+        elif self.path.endswith('/api/extra/grammar'):
+            if not self.secure_endpoint():
+                return
+            try:
+                genparams = json.loads(body)
+                if genparams.get('remove', None):
+                    removed = grammar_registry.remove(str(genparams.get('remove')))
+                    response_body = (json.dumps({"success": removed}).encode())
+                else:
+                    grammartext = genparams.get('grammar', '')
+                    gid, rules = grammar_registry.register(grammartext)
+                    response_body = (json.dumps({"id": gid, "bytes": len(grammartext), "rules": rules}).encode())
+            except Exception as e:
+                utfprint("Register Grammar - Error: " + str(e), "error")
+                response_code = 400
+                response_body = (json.dumps({"id": None, "error": str(e)}).encode())
+
         elif self.path.endswith('/api/change_template'):
             if not self.secure_endpoint():
                 return
@@ -2315,11 +4873,11 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 else:
                     koboldcpp_promt_template.ENABLE_TEMPLATE_PROCESSING = True
                     selected_template = (modelname, modelversion)
-                    print(f'api 切换上下文模板为 {selected_template}')
+                    utfprint(f'api 切换上下文模板为 {selected_template}')
                 response_code = 200
                 response_body = (json.dumps({"succeed": 1}).encode())
             except Exception as e:
-                utfprint("Change Template - Error: " + str(e))
+                utfprint("Change Template - Error: " + str(e), "error")
                 response_code = 400
                 response_body = (json.dumps({"succeed": 0}).encode())
 
@@ -2332,10 +4890,42 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 detokstr = detokenize_ids(tokids)
                 response_body = (json.dumps({"result": detokstr,"success":True}).encode())
             except Exception as e:
-                utfprint("Detokenize Error: " + str(e))
+                utfprint("Detokenize Error: " + str(e), "error")
                 response_code = 400
                 response_body = (json.dumps({"result": "","success":False}).encode())
 
+        elif self.path.endswith(('/api/extra/state/save', '/api/extra/state/load', '/api/extra/state/delete')):
+            if not self.secure_endpoint():
+                return
+            try:
+                stateparams = json.loads(body) if body else {}
+                statename = str(stateparams.get('name', "")) if isinstance(stateparams, dict) else ""
+                if not context_snapshots.enabled():
+                    response_code = 503
+                    response_body = (json.dumps({"success":False, "error":"Context snapshots are not enabled!"}).encode())
+                elif self.path.endswith('/api/extra/state/delete'):
+                    response_body = (json.dumps({"success":context_snapshots.delete(statename)}).encode())
+                else:
+                    stateslot = modelbusy.acquire(client=self.client_address[0], maxqueue=get_multiuser_limits()[1]) #wait until the backend is idle
+                    if stateslot is None:
+                        metrics.inc("koboldcpp_rejected_requests_total", reason="busy")
+                        response_code = 503
+                        response_body = (json.dumps({"success":False, "error":"Server is busy; please try again later."}).encode())
+                    else:
+                        try:
+                            if self.path.endswith('/api/extra/state/save'):
+                                saved = context_snapshots.save(statename)
+                                response_body = (json.dumps({"success":(saved is not None), **(saved if saved else {})}).encode())
+                            else:
+                                restored = (statename!="" and context_snapshots.restore(statename))
+                                response_body = (json.dumps({"success":restored}).encode())
+                        finally:
+                            modelbusy.release(stateslot)
+            except Exception as e:
+                utfprint("Context State - Error: " + str(e), "error")
+                response_code = 400
+                response_body = (json.dumps({"success":False}).encode())
+
         elif self.path.endswith('/api/extra/abort'):
             if not self.secure_endpoint():
                 return
@@ -2347,13 +4937,15 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             except Exception:
                 multiuserkey = ""
                 pass
-            if (multiuserkey=="" and requestsinqueue==0) or (multiuserkey!="" and multiuserkey==currentusergenkey):
+            if (multiuserkey=="" and modelbusy.queue_length()==0) or (multiuserkey!="" and modelbusy.owns_genkey(multiuserkey)):
                 ag = handle.abort_generate()
+                metrics.inc("koboldcpp_aborts_total", reason="request")
                 time.sleep(0.1) #short delay before replying
                 response_body = (json.dumps({"success": ("true" if ag else "false"), "done":"true"}).encode())
-                print("\nGeneration Aborted")
-            elif (multiuserkey!="" and requestsinqueue>0):
+                utfprint("\nGeneration Aborted")
+            elif (multiuserkey!="" and modelbusy.queue_length()>0):
                 pendingabortkey = multiuserkey
+                metrics.inc("koboldcpp_aborts_total", reason="deferred")
                 response_body = (json.dumps({"success": "true", "done":"false"}).encode())
             else:
                 response_body = (json.dumps({"success": "false", "done":"false"}).encode())
@@ -2371,7 +4963,7 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 multiuserkey = ""
 
             if totalgens>0:
-                if (multiuserkey=="" and multiuserkey==currentusergenkey and requestsinqueue==0) or (multiuserkey!="" and multiuserkey==currentusergenkey): #avoid leaking prompts in multiuser
+                if (multiuserkey=="" and multiuserkey==currentusergenkey and modelbusy.queue_length()==0) or (multiuserkey!="" and modelbusy.owns_genkey(multiuserkey)): #avoid leaking prompts in multiuser
                     pendtxt = handle.get_pending_output()
                     pendtxtStr = ctypes.string_at(pendtxt).decode("UTF-8","ignore")
             response_body = (json.dumps({"results": [{"text": pendtxtStr}]}).encode())
@@ -2389,10 +4981,9 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                 multiuserkey = ""
 
             if totalgens>0:
-                if (multiuserkey=="" and multiuserkey==currentusergenkey and requestsinqueue==0) or (multiuserkey!="" and multiuserkey==currentusergenkey): #avoid leaking prompts in multiuser
-                    lastlogprobs = handle.last_logprobs()
-                    logprobsdict = parse_last_logprobs(lastlogprobs)
-            response_body = (json.dumps({"logprobs":logprobsdict}).encode())
+                if (multiuserkey=="" and multiuserkey==currentusergenkey and modelbusy.queue_length()==0) or (multiuserkey!="" and modelbusy.owns_genkey(multiuserkey)): #avoid leaking prompts in multiuser
+                    logprobsdict = get_last_logprobs()
+            response_body = (json.dumps({"logprobs":logprobsdict}, default=expand_lazy_json).encode())
 
         elif self.path.endswith('/api/extra/multiplayer/status'):
             if not self.secure_endpoint():
@@ -2456,7 +5047,7 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                         response_code = 400
                         response_body = (json.dumps({"success":False, "error":"No story submitted!"}).encode())
                 except Exception as e:
-                    utfprint("Multiplayer Set Story - Body Error: " + str(e))
+                    utfprint("Multiplayer Set Story - Body Error: " + str(e), "error")
                     response_code = 400
                     response_body = (json.dumps({"success": False, "error":"Submitted story invalid!"}).encode())
 
@@ -2465,18 +5056,53 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             self.send_header('content-length', str(len(response_body)))
             self.end_headers(content_type='application/json')
             self.wfile.write(response_body)
-            return
+            return None
+
+        return self.handle_generation_post(body, multipart)
 
-        reqblocking = False
-        muint = int(args.multiuser)
-        if muint<=0 and ((args.whispermodel and args.whispermodel!="") or (args.sdmodel and args.sdmodel!="")):
-            muint = 2 # this prevents errors when using voice/img together with text
-        multiuserlimit = ((muint-1) if muint > 1 else 6)
-        #backwards compatibility for up to 7 concurrent requests, use default limit of 7 if multiuser set to 1
-        if muint > 0 and requestsinqueue < multiuserlimit:
-            reqblocking = True
-            requestsinqueue += 1
-        if not modelbusy.acquire(blocking=reqblocking):
+    def parse_generation_body(self, body, multipart): #returns the request's genparams, or None if unparsable
+        genparams = None
+        try:
+            if multipart is not None: #file uploads were already parsed while reading
+                genparams = self.get_upload_params(multipart)
+            else:
+                kcpp_log.request_debug("body", "\n========================================\nJSON体: \n%s\n========================================\n", body)
+                with trace_span("json_parse"):
+                    genparams = json.loads(body)
+        except Exception:
+            genparams = None
+        if not genparams:
+            utfprint("Body Err: " + str(body), "error")
+        return genparams
+
+    def prepare_genparams(self, genparams, api_format, reqslot): #resolves grammars and schemas, returns an error message or None
+        grammarerr = None
+        if isinstance(genparams, dict):
+            modelbusy.assign_genkey(reqslot, genparams.get('genkey', ''))
+            if self.headers.get('x-response-cache', '').lower() == 'bypass':
+                genparams["bypass_cache"] = True
+            grammarerr = (grammar_registry.resolve(genparams) or apply_response_format(genparams, api_format)) if api_format > 0 else None
+        if grammarerr is None and ((args.debugmode != -1 and not args.quiet) or args.debugmode >= 1):
+            utfprint("\nInput: " + json.dumps(genparams, default=lambda v: f"<{len(v)} bytes>"))
+        return grammarerr
+
+    async def handle_generation_post(self, body, multipart):
+        # the part of a POST that waits for the model, awaited by the caller of handle_post
+        global lastgeneratedcomfyimg
+        muint, multiuserlimit = get_multiuser_limits()
+        reqpriority = tryparseint(self.headers.get('x-priority', 0)) #lower values are scheduled first
+        reqpriority = reqpriority if isinstance(reqpriority, int) else 0
+        if reqpriority < 0 and not self.has_password_auth(): #only callers holding the password may jump ahead
+            reqpriority = 0
+        reqprefix = None
+        if args.model_param and not self.path.endswith(('/prompt', '/sdapi/v1/txt2img', '/sdapi/v1/img2img', '/api/extra/transcribe', '/v1/audio/transcriptions')):
+            def reqprefix(): #only tokenized if the request has to queue
+                with trace_span("prefix_routing"):
+                    return get_prefix_routing_ids(body)
+        with trace_span("queue_wait"):
+            reqslot = await self.wait_for_slot(client=self.client_address[0], priority=reqpriority, blocking=(muint > 0), maxqueue=multiuserlimit, prefix_fn=reqprefix)
+        if reqslot is None:
+            metrics.inc("koboldcpp_rejected_requests_total", reason="busy")
             self.send_response(503)
             self.end_headers(content_type='application/json')
             self.wfile.write(json.dumps({"detail": {
@@ -2484,8 +5110,6 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                     "type": "service_unavailable",
                 }}).encode())
             return
-        if reqblocking:
-            requestsinqueue = (requestsinqueue - 1) if requestsinqueue > 0 else 0
 
         try:
             sse_stream_flag = False
@@ -2514,6 +5138,7 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
             if self.path.endswith('/sdapi/v1/interrogate'):
                 has_vision = (mmprojpath!="")
                 if not has_vision:
+                    metrics.inc("koboldcpp_rejected_requests_total", reason="no_vision")
                     self.send_response(503)
                     self.end_headers(content_type='application/json')
                     self.wfile.write(json.dumps({"detail": {
@@ -2544,33 +5169,29 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                     if not self.secure_endpoint():
                         return
 
-                genparams = None
-                try:
-                    print('\n========================================')
-                    print("JSON体: ")
-                    print(body)
-                    print('========================================\n')
-                    genparams = json.loads(body)
-                except Exception:
-                    genparams = None
-                    if is_transcribe: #fallback handling of file uploads
-                        b64wav = self.extract_b64string_from_file_upload(body)
-                        if b64wav:
-                            genparams = {"audio_data":b64wav}
-
-                    if not genparams:
-                        utfprint("Body Err: " + str(body))
-                        self.send_response(500)
-                        self.end_headers(content_type='application/json')
-                        self.wfile.write(json.dumps({"detail": {
-                        "msg": "Error parsing input.",
-                        "type": "bad_input",
-                        }}).encode())
-                        return
+                if self.trace is not None:
+                    self.trace.kind = ("image" if is_imggen else ("transcribe" if is_transcribe else "text"))
+                self.metrics_format = ("image" if is_imggen else ("transcribe" if is_transcribe else api_format_names.get(api_format, str(api_format))))
+                metrics.inc("koboldcpp_requests_total", api_format=self.metrics_format)
+                genparams = await self.run_blocking(self.parse_generation_body, body, multipart)
+                if not genparams:
+                    self.send_response(500)
+                    self.end_headers(content_type='application/json')
+                    self.wfile.write(json.dumps({"detail": {
+                    "msg": "Error parsing input.",
+                    "type": "bad_input",
+                    }}).encode())
+                    return
 
-                is_quiet = args.quiet
-                if (args.debugmode != -1 and not is_quiet) or args.debugmode >= 1:
-                    utfprint("\nInput: " + json.dumps(genparams))
+                grammarerr = await self.run_blocking(self.prepare_genparams, genparams, api_format, reqslot)
+                if grammarerr is not None:
+                    self.send_response(400)
+                    self.end_headers(content_type='application/json')
+                    self.wfile.write(json.dumps({"detail": {
+                    "msg": grammarerr,
+                    "type": "bad_input",
+                    }}).encode())
+                    return
 
                 if args.foreground:
                     bring_terminal_to_foreground()
@@ -2580,22 +5201,24 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                     if (api_format == 4 or api_format == 3) and "stream" in genparams and genparams["stream"]:
                         sse_stream_flag = True
 
-                    gen = asyncio.run(self.handle_request(genparams, api_format, sse_stream_flag))
+                    gen = await self.handle_request(genparams, api_format, sse_stream_flag)
 
                     try:
                         # Headers are already sent when streaming
                         if not sse_stream_flag:
                             self.send_response(200)
-                            genresp = (json.dumps(gen).encode())
+                            with trace_span("response_serialize"):
+                                genresp = await self.run_blocking(serialize_generation_response, gen)
                             self.send_header('content-length', str(len(genresp)))
                             self.end_headers(content_type='application/json')
                             self.wfile.write(genresp)
                     except Exception as ex:
                         if args.debugmode:
-                            print(ex)
-                        print("Generate: The response could not be sent, maybe connection was terminated?")
+                            utfprint(str(ex), "error")
+                        utfprint("Generate: The response could not be sent, maybe connection was terminated?", "error")
                         handle.abort_generate()
-                        time.sleep(0.2) #short delay
+                        metrics.inc("koboldcpp_aborts_total", reason="disconnect")
+                        await asyncio.sleep(0.2) #short delay
                     return
 
                 elif is_imggen: #image gen
@@ -2603,7 +5226,10 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                         if is_comfyui_imggen:
                             lastgeneratedcomfyimg = b''
                             genparams = sd_comfyui_tranform_params(genparams)
-                        gen = sd_generate(genparams)
+                        with trace_span("image_generate"):
+                            imgstart = time.perf_counter()
+                            gen = await generation_executor.run_async(sd_generate, genparams)
+                            metrics.observe("koboldcpp_image_generation_seconds", time.perf_counter()-imgstart)
                         genresp = None
                         if is_comfyui_imggen:
                             if gen:
@@ -2619,13 +5245,16 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                         self.wfile.write(genresp)
                     except Exception as ex:
                         if args.debugmode:
-                            print(ex)
-                        print("Generate Image: The response could not be sent, maybe connection was terminated?")
-                        time.sleep(0.2) #short delay
+                            utfprint(str(ex), "error")
+                        utfprint("Generate Image: The response could not be sent, maybe connection was terminated?", "error")
+                        await asyncio.sleep(0.2) #short delay
                     return
                 elif is_transcribe:
                     try:
-                        gen = whisper_generate(genparams)
+                        with trace_span("transcribe"):
+                            transcribestart = time.perf_counter()
+                            gen = await generation_executor.run_async(whisper_generate, genparams)
+                            metrics.observe("koboldcpp_transcription_seconds", time.perf_counter()-transcribestart)
                         genresp = (json.dumps({"text":gen}).encode())
                         self.send_response(200)
                         self.send_header('content-length', str(len(genresp)))
@@ -2633,14 +5262,14 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
                         self.wfile.write(genresp)
                     except Exception as ex:
                         if args.debugmode:
-                            print(ex)
-                        print("Transcribe: The response could not be sent, maybe connection was terminated?")
-                        time.sleep(0.2) #short delay
+                            utfprint(str(ex), "error")
+                        utfprint("Transcribe: The response could not be sent, maybe connection was terminated?", "error")
+                        await asyncio.sleep(0.2) #short delay
                     return
 
         finally:
-            time.sleep(0.05)
-            modelbusy.release()
+            await asyncio.sleep(0.05)
+            modelbusy.release(reqslot)
 
         self.send_response(404)
         self.end_headers(content_type='text/html')
@@ -2657,7 +5286,7 @@ Add/QvJP/skfyP8BnWh46M1E/qoAAAAASUVORK5CYII=",
     def end_headers(self, content_type=None):
         self.send_header('access-control-allow-origin', '*')
         self.send_header('access-control-allow-methods', '*')
-        self.send_header('access-control-allow-headers', '*, Accept, Content-Type, Content-Length, Cache-Control, Accept-Encoding, X-CSRF-Token, Client-Agent, X-Fields, Content-Type, Authorization, X-Requested-With, X-HTTP-Method-Override, apikey, genkey')
+        self.send_header('access-control-allow-headers', '*, Accept, Content-Type, Content-Length, Cache-Control, Accept-Encoding, X-CSRF-Token, Client-Agent, X-Fields, Content-Type, Authorization, X-Requested-With, X-HTTP-Method-Override, apikey, genkey, X-Priority, X-Response-Cache')
         self.send_header("cache-control", "no-store")
         if content_type is not None:
             self.send_header('content-type', content_type)
@@ -2760,8 +5389,266 @@ def RunServerMultiThreaded(addr, port):
             exitcounter = 999
             for i in range(numThreads):
                 threadArr[i].stop()
+            generation_executor.shutdown()
             sys.exit(0)
 
+class AsyncResponseWriter:
+    # file-like wfile for handlers served from the asyncio front end. writes from worker
+    # threads are handed to the event loop, writes from the loop itself go straight out
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.chunked = False
+
+    def in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def write(self, data):
+        if self.writer.is_closing():
+            raise BrokenPipeError("Connection was closed by the client")
+        datalen = len(data)
+        if self.chunked:
+            if datalen == 0:
+                return 0 # an empty chunk would terminate the response
+            data = b"%x\r\n%b\r\n" % (datalen, data)
+        if self.in_loop():
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, bytes(data))
+        return datalen
+
+    def end_chunks(self):
+        if self.chunked:
+            self.chunked = False
+            self.write(b"0\r\n\r\n")
+
+    def flush(self):
+        if self.in_loop() or self.writer.is_closing():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop).result()
+        except ConnectionError as e:
+            raise BrokenPipeError(str(e)) from e
+
+    async def drain(self): #flush from the loop itself, waits while the client is slow to read
+        if self.writer.is_closing():
+            raise BrokenPipeError("Connection was closed by the client")
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise BrokenPipeError(str(e)) from e
+
+class AsyncServerRequestHandler(ServerRequestHandler):
+    # same endpoints as ServerRequestHandler, but the request has already been read by the event loop
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, addr, port, loop, writer, handler_executor, queue_executor):
+        super().__init__(addr, port)
+        self.server_loop = loop
+        self.handler_executor = handler_executor
+        self.queue_executor = queue_executor
+        self.response_writer = AsyncResponseWriter(loop, writer)
+        self.wfile = self.response_writer
+        peer = writer.get_extra_info('peername')
+        self.client_address = (peer[0], peer[1]) if peer else ("", 0)
+        self.request_keep_alive = False
+        self.has_content_length = False
+        self.close_connection = True
+
+    def setup_request(self, requestline, command, path, version, headers, body):
+        self.requestline = requestline
+        self.command = command
+        self.path = path
+        self.request_version = version
+        self.headers = headers
+        self.rfile = io.BytesIO(body)
+        conntype = headers.get('connection', '').lower()
+        self.request_keep_alive = (conntype != 'close') if version == 'HTTP/1.1' else (conntype == 'keep-alive')
+        self.close_connection = not self.request_keep_alive
+
+    def send_header(self, keyword, value):
+        keyword_lower = keyword.lower()
+        if keyword_lower == 'connection':
+            return # decided in end_headers from the request and the response framing
+        if keyword_lower == 'content-length':
+            self.has_content_length = True
+        super().send_header(keyword, value)
+
+    def end_headers(self, content_type=None):
+        # responses without a length (e.g. SSE) are sent chunked to HTTP/1.1 clients so the
+        # connection can be reused afterwards, HTTP/1.0 clients get them delimited by close
+        use_chunked = (not self.has_content_length and self.request_version == 'HTTP/1.1' and self.command != 'HEAD')
+        if use_chunked:
+            super().send_header('transfer-encoding', 'chunked')
+        self.close_connection = not (self.request_keep_alive and (self.has_content_length or use_chunked))
+        super().send_header('connection', 'close' if self.close_connection else 'keep-alive')
+        result = super().end_headers(content_type)
+        self.response_writer.chunked = use_chunked
+        return result
+
+    async def do_POST_async(self):
+        # the body and the quick endpoints are handled on a pool thread, while waiting for the model
+        # and generating only the scheduler wait and the backend call itself occupy a thread
+        reqstart = self.begin_post()
+        try:
+            pending = await self.run_blocking(self.handle_post)
+            if pending is not None:
+                await pending
+        finally:
+            self.end_post(reqstart)
+
+    async def run_blocking(self, fn, *args):
+        context = contextvars.copy_context() #keeps the request trace current on the pool thread
+        return await self.server_loop.run_in_executor(self.handler_executor, functools.partial(context.run, fn, *args))
+
+    async def wait_for_slot(self, **kwargs):
+        # queued requests wait on their own pool, so they can never starve the endpoint handlers
+        context = contextvars.copy_context()
+        future = self.server_loop.run_in_executor(self.queue_executor, functools.partial(context.run, modelbusy.acquire, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda f: modelbusy.release(f.result()) if not f.cancelled() and f.exception() is None else None)
+            raise
+
+    async def drain_output(self):
+        await self.response_writer.drain()
+
+def RunServerAsync(addr, port):
+    global exitcounter, sslvalid
+    if is_port_in_use(port):
+        print(f"Warning: Port {port} already appears to be in use by another program.")
+
+    sslctx = None
+    if args.ssl and sslvalid:
+        import ssl
+        certpath = os.path.abspath(args.ssl[0])
+        keypath = os.path.abspath(args.ssl[1])
+        sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sslctx.load_cert_chain(certfile=certpath, keyfile=keypath)
+
+    maxpayload = 1024*1024*32 #32mb payload limit, same as the threaded server
+    keepalive_timeout = 120
+    # endpoint handlers run on their own pool, blocking generation calls go to generation_executor,
+    # and requests queued for the model wait on queue_executor. The scheduler rejects requests past
+    # the queue limit right away, so that pool never needs more threads than queue entries.
+    handler_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="kcpp_http")
+    queue_executor = ThreadPoolExecutor(max_workers=get_multiuser_limits()[1]+modelbusy.total_slots()+2, thread_name_prefix="kcpp_queue")
+
+    async def send_simple_error(writer, code, msg):
+        errbody = json.dumps({"detail": {"msg": msg, "type": "bad_input"}}).encode()
+        writer.write(f"HTTP/1.1 {code} Error\r\ncontent-type: application/json\r\ncontent-length: {len(errbody)}\r\nconnection: close\r\n\r\n".encode() + errbody)
+        await writer.drain()
+
+    async def read_chunked_body(reader):
+        body = bytearray()
+        chunklimit = 0 # do not process more than 512 chunks, prevents bad actors
+        while True:
+            chunklimit += 1
+            line = (await reader.readline()).strip()
+            if not line or chunklimit > 512:
+                return None
+            chunk_length = max(0, int(line.split(b';')[0], 16))
+            if len(body) + chunk_length > maxpayload:
+                return None
+            if chunk_length == 0:
+                while (await reader.readline()).strip(): #discard trailers
+                    pass
+                return bytes(body)
+            body += await reader.readexactly(chunk_length)
+            await reader.readline()
+
+    async def serve_connection(reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                requestline, _, headerblock = head.partition(b'\r\n')
+                requestline = requestline.decode('iso-8859-1').strip()
+                words = requestline.split()
+                if len(words) != 3 or not words[2].startswith('HTTP/'):
+                    await send_simple_error(writer, 400, "Bad request line.")
+                    break
+                command, path, version = words
+                headers = http.client.parse_headers(io.BytesIO(headerblock))
+
+                body = b''
+                body_consumed = True
+                if headers.get('transfer-encoding', '').lower() == "chunked":
+                    if version == 'HTTP/1.1' and headers.get('expect', '').lower() == '100-continue':
+                        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    try:
+                        body = await read_chunked_body(reader)
+                    except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                        body = None
+                    if body is None:
+                        await send_simple_error(writer, 500, "Failed to parse chunked request.")
+                        break
+                    del headers['transfer-encoding']
+                    headers['content-length'] = str(len(body))
+                else:
+                    content_length = tryparseint(headers.get('content-length', 0))
+                    content_length = content_length if isinstance(content_length, int) else 0
+                    if content_length > maxpayload:
+                        body_consumed = False # the handler rejects it, and we must drop the connection after
+                    elif content_length > 0:
+                        if version == 'HTTP/1.1' and headers.get('expect', '').lower() == '100-continue':
+                            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                        try:
+                            body = await reader.readexactly(content_length)
+                        except (asyncio.IncompleteReadError, ConnectionError):
+                            break
+
+                handler = AsyncServerRequestHandler(addr, port, loop, writer, handler_executor, queue_executor)
+                handler.setup_request(requestline, command, path, version, headers, body)
+                if not body_consumed:
+                    handler.request_keep_alive = False
+                method = getattr(handler, 'do_' + command, None)
+                try:
+                    if method is None:
+                        await loop.run_in_executor(handler_executor, handler.send_error, 501, f"Unsupported method ({command})")
+                    elif command == 'POST':
+                        await handler.do_POST_async()
+                    else:
+                        await loop.run_in_executor(handler_executor, method)
+                    handler.response_writer.end_chunks()
+                    await writer.drain()
+                except (BrokenPipeError, ConnectionError):
+                    break
+                if handler.close_connection:
+                    break
+        except Exception as e:
+            if args.debugmode:
+                utfprint(f"Async server connection error: {e}", "error")
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def serve():
+        server = await asyncio.start_server(serve_connection, host=(addr if addr else None), port=port, ssl=sslctx, reuse_address=True, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        exitcounter = 999
+        handler_executor.shutdown(wait=False, cancel_futures=True)
+        queue_executor.shutdown(wait=False, cancel_futures=True)
+        generation_executor.shutdown()
+        sys.exit(0)
+
 # note: customtkinter-5.2.0
 def show_gui():
     global guimode
@@ -3137,8 +6024,8 @@ def show_gui():
         pass
 
     def changed_gpulayers_estimate(*args):
-        predicted_gpu_layers = autoset_gpu_layers(int(contextsize_text[context_var.get()]),(sd_quant_var.get()==1),int(blasbatchsize_values[int(blas_size_var.get())]))
-        max_gpu_layers = (f"/{modelfile_extracted_meta[0][0]+3}" if (modelfile_extracted_meta and modelfile_extracted_meta[0] and modelfile_extracted_meta[0][0]!=0) else "")
+        predicted_gpu_layers = autoset_gpu_layers(int(contextsize_text[context_var.get()]),(sd_quant_var.get()==1),int(blasbatchsize_values[int(blas_size_var.get())]),(quantkv_var.get() if flashattention.get()==1 else 0),(flashattention.get()==1))
+        max_gpu_layers = (f"/{modelfile_extracted_meta[0].layers+3}" if (modelfile_extracted_meta and modelfile_extracted_meta[0] and modelfile_extracted_meta[0].layers!=0) else "")
         index = runopts_var.get()
         gpu_be = (index == "Use Vulkan" or index == "Use Vulkan (Old CPU)" or index == "Use CLBlast" or index == "Use CLBlast (Old CPU)" or index == "Use CuBLAS" or index == "Use hipBLAS (ROCm)")
         layercounter_label.grid(row=6, column=1, padx=75, sticky="W")
@@ -4039,7 +6926,7 @@ def show_gui_yesnobox(title,message):
         pass
 
 def print_with_time(txt):
-    print(f"{datetime.now().strftime('[%H:%M:%S]')} " + txt, flush=True)
+    utfprint(f"{datetime.now().strftime('[%H:%M:%S]')} " + txt)
 
 def make_url_request(url, data, method='POST', headers={}):
     import urllib.request, ssl
@@ -4115,7 +7002,7 @@ def run_horde_worker(args, api_key, worker_name):
             headers["Authorization"] = f"Bearer {password}"
         ret = make_url_request(url, data, method, headers)
         if not ret:
-            print("Make sure your Horde API key and worker name is valid!")
+            utfprint("Make sure your Horde API key and worker name is valid!")
         return ret
 
     current_id = None
@@ -4124,7 +7011,7 @@ def run_horde_worker(args, api_key, worker_name):
     session_starttime = datetime.now()
     sleepy_counter = 0 #if this exceeds a value, worker becomes sleepy (slower)
     exitcounter = 0
-    print(f"===\nEmbedded Horde Worker '{worker_name}' Starting...\n(To use your own Horde Bridge/Scribe worker instead, don't set your API key)\n")
+    utfprint(f"===\nEmbedded Horde Worker '{worker_name}' Starting...\n(To use your own Horde Bridge/Scribe worker instead, don't set your API key)\n")
     BRIDGE_AGENT = "KoboldCppEmbedWorker:2:https://github.com/LostRuins/koboldcpp"
     cluster = "https://aihorde.net"
     while exitcounter < 10:
@@ -4189,7 +7076,7 @@ def run_horde_worker(args, api_key, worker_name):
         sleepy_counter = 0
         current_id = pop['id']
         current_payload = pop['payload']
-        print("") #empty newline
+        utfprint("") #empty newline
         print_with_time(f"Job received from {cluster} for {current_payload.get('max_length',80)} tokens and {current_payload.get('max_context_length',1024)} max context. Starting generation...")
 
         #do gen
@@ -4209,7 +7096,7 @@ def run_horde_worker(args, api_key, worker_name):
             time.sleep(5)
 
         #submit reply
-        print("") #empty newline
+        utfprint("") #empty newline
         if current_generation:
             submit_dict = {
                 "id": current_id,
@@ -4531,6 +7418,10 @@ def main(launch_args,start_server=True):
         unpack_to_dir(args.unpack)
         return
 
+    if args.benchmarkinputs:
+        benchmark_generation_inputs(args.benchmarkinputs)
+        return
+
     if args.config and len(args.config)==1:
         cfgname = args.config[0]
         if isinstance(cfgname, str):
@@ -4693,7 +7584,7 @@ def main(launch_args,start_server=True):
         friendlymodelname = "koboldcpp/" + sanitize_string(newmdldisplayname)
 
     # horde worker settings
-    global maxhordelen, maxhordectx, showdebug, has_multiplayer
+    global maxhordelen, maxhordectx, showdebug, has_multiplayer, max_tokenize_len
     if args.hordemodelname and args.hordemodelname!="":
         friendlymodelname = args.hordemodelname
         if args.debugmode == 1:
@@ -4714,6 +7605,37 @@ def main(launch_args,start_server=True):
     if args.multiplayer:
         has_multiplayer = True
 
+    if args.tokenizelimit and args.tokenizelimit > 0:
+        max_tokenize_len = int(args.tokenizelimit)
+
+    kcpp_log.configure(level=(args.loglevel if args.loglevel else ("debug" if args.debugmode >= 1 else "info")), max_chars=(args.logmaxchars if args.logmaxchars is not None else (64000 if args.debugmode >= 1 else 32000)), sample_every=args.logsample, json_format=bool(args.logjson))
+    koboldcpp_promt_template.log = utfprint
+
+    if args.tracerequests is not None:
+        request_tracer.configure(int(args.tracerequests))
+
+    if args.slots is not None:
+        if args.slots > max_backend_slots:
+            print(f"Warning: --slots {args.slots} requested, but the backend can only run {max_backend_slots} generation at a time. Using {max_backend_slots}.")
+        modelbusy.configure(min(int(args.slots), max_backend_slots))
+
+    if args.tokencache is not None:
+        tokenize_cache.configure(int(args.tokencache)*1024*1024)
+
+    if args.grammarcache is not None:
+        grammar_registry.configure(int(args.grammarcache)*1024*1024)
+
+    if args.statecache:
+        import tempfile
+        statecachedir = args.statecachedir if args.statecachedir else os.path.join(tempfile.gettempdir(), "koboldcpp_states")
+        statedisk = int(args.statecache[1]) if len(args.statecache) > 1 else 0
+        context_snapshots.configure(int(args.statecache[0])*1024*1024, statedisk*1024*1024, statecachedir)
+        print(f"Context snapshots enabled ({args.statecache[0]} MB RAM" + (f", {statedisk} MB disk at {statecachedir})" if statedisk > 0 else ")"))
+
+    if args.responsecache and args.responsecache > 0:
+        response_cache.configure(int(args.responsecache)*1024*1024, int(args.responsecachettl))
+        print(f"Response cache enabled for deterministic requests ({args.responsecache} MB, TTL {args.responsecachettl}s)")
+
     if args.highpriority:
         print("Setting process to Higher Priority - Use Caution")
         try:
@@ -4741,6 +7663,19 @@ def main(launch_args,start_server=True):
         global nocertify
         nocertify = True
 
+    if args.planmemory:
+        if not args.model_param or not os.path.exists(args.model_param):
+            exit_with_error(2,"--planmemory requires a text model file")
+        if MaxMemory[0] == 0 and not args.usecpu:
+            fetch_gpu_properties(False,True,True)
+        extract_modelfile_params(args.model_param,args.sdmodel,args.whispermodel,args.mmproj,args.draftmodel)
+        if not modelfile_extracted_meta or not modelfile_extracted_meta[0] or not modelfile_extracted_meta[0].layer_bytes:
+            exit_with_error(2,"Could not read the GGUF tensor table of the text model")
+        devices = ([] if args.usecpu else get_planner_devices(args.tensor_split, args.usecublas))
+        plan = plan_memory(modelfile_extracted_meta, args.contextsize, args.blasbatchsize, args.quantkv, args.flashattention, args.tensor_split, devices, args.sdquant, args.draftgpulayers)
+        print_memory_plan(plan, modelfile_extracted_meta, args.contextsize, args.blasbatchsize, args.quantkv, args.flashattention)
+        return
+
     if args.gpulayers:
         shouldavoidgpu = False
         if args.usecpu and sys.platform!="darwin":
@@ -4761,7 +7696,7 @@ def main(launch_args,start_server=True):
             if args.gpulayers==-1:
                 if MaxMemory[0] > 0 and (not args.usecpu) and ((args.usecublas is not None) or (args.usevulkan is not None) or (args.useclblast is not None) or sys.platform=="darwin"):
                     extract_modelfile_params(args.model_param,args.sdmodel,args.whispermodel,args.mmproj,args.draftmodel)
-                    layeramt = autoset_gpu_layers(args.contextsize,args.sdquant,args.blasbatchsize)
+                    layeramt = autoset_gpu_layers(args.contextsize,args.sdquant,args.blasbatchsize,args.quantkv,args.flashattention,args.tensor_split,args.usecublas,args.draftgpulayers)
                     print(f"Auto Recommended GPU Layers: {layeramt}")
                     args.gpulayers = layeramt
                 else:
@@ -4840,6 +7775,7 @@ def main(launch_args,start_server=True):
         if not loadok:
             exitcounter = 999
             exit_with_error(3,"Could not load text model: " + modelname)
+        grammar_registry.register(openai_tools_grammar, pinned=True) #used by every tools request
 
     #handle loading image model
     if args.sdmodel and args.sdmodel!="":
@@ -5080,7 +8016,10 @@ def main(launch_args,start_server=True):
         else:
             # Flush stdout for previous win32 issue so the client can see output.
             print(f"======\nPlease connect to custom endpoint at {epurl}", flush=True)
-        asyncio.run(RunServerMultiThreaded(args.host, args.port))
+        if args.asyncserver:
+            RunServerAsync(args.host, args.port)
+        else:
+            asyncio.run(RunServerMultiThreaded(args.host, args.port))
     else:
         # Flush stdout for previous win32 issue so the client can see output.
         if not args.prompt or args.benchmark:
@@ -5160,13 +8099,29 @@ if __name__ == '__main__':
     advparser.add_argument("--prompt", metavar=('[prompt]'), help="Passing a prompt string triggers a direct inference, loading the model, outputs the response to stdout and exits. Can be used alone or with benchmark.", type=str, default="")
     advparser.add_argument("--promptlimit", help="Sets the maximum number of generated tokens, usable only with --prompt or --benchmark",metavar=('[token limit]'), type=int, default=100)
     advparser.add_argument("--multiuser", help="Runs in multiuser mode, which queues incoming requests instead of blocking them.", metavar=('limit'), nargs='?', const=1, type=int, default=1)
+    advparser.add_argument("--slots", help="Number of generations the scheduler runs at once (default 1). Currently capped to 1, since the text backend is not reentrant; extra queued requests wait for the slot.", metavar=('[slots]'), type=check_range(int,1,64), default=1)
     advparser.add_argument("--multiplayer", help="Hosts a shared multiplayer session that others can join.", action='store_true')
     advparser.add_argument("--remotetunnel", help="Uses Cloudflare to create a remote tunnel, allowing you to access koboldcpp remotely over the internet even behind a firewall.", action='store_true')
     advparser.add_argument("--highpriority", help="Experimental flag. If set, increases the process CPU priority, potentially speeding up generation. Use caution.", action='store_true')
     advparser.add_argument("--foreground", help="Windows only. Sends the terminal to the foreground every time a new prompt is generated. This helps avoid some idle slowdown issues.", action='store_true')
     advparser.add_argument("--preloadstory", metavar=('[savefile]'), help="Configures a prepared story json save file to be hosted on the server, which frontends (such as KoboldAI Lite) can access over the API.", default="")
     advparser.add_argument("--quiet", help="Enable quiet mode, which hides generation inputs and outputs in the terminal. Quiet mode is automatically enabled when running a horde worker.", action='store_true')
+    advparser.add_argument("--responsecache", help="Caches responses of deterministic text requests (temperature 0 or a fixed seed) and serves repeats without regenerating. Optionally set the cache size in MB (default 64). Send the header X-Response-Cache: bypass to skip it.", metavar=('[megabytes]'), nargs='?', const=64, type=int, default=0)
+    advparser.add_argument("--responsecachettl", help="How many seconds a cached response stays valid, 0 keeps entries until evicted (default 3600).", metavar=('[seconds]'), type=int, default=3600)
+    advparser.add_argument("--tokenizelimit", help="Largest number of tokens the tokenize, tokencount and detokenize endpoints will handle in one string (default 1048576).", metavar=('[tokens]'), type=int, default=1048576)
+    advparser.add_argument("--benchmarkinputs", help="Measure the per request cost of building generation inputs over N requests, with the preset cache cold and warm, then exit.", metavar=('[iterations]'), type=int, nargs='?', const=2000, default=0)
+    advparser.add_argument("--loglevel", help="Console logging level. Request dumps (prompts, templated prompts, request bodies) are only logged at debug, which --debugmode also enables.", choices=['error','warning','info','debug'], default=None)
+    advparser.add_argument("--logmaxchars", help="Truncate each logged message to this many characters (default 32000, 0 for no limit).", metavar=('[chars]'), type=int, default=None)
+    advparser.add_argument("--logsample", help="Only log the debug request dumps of one in every N requests (default 1, every request).", metavar=('[N]'), type=int, default=1)
+    advparser.add_argument("--logjson", help="Write log records as one JSON object per line.", action='store_true')
+    advparser.add_argument("--tracerequests", help="Keep latency traces of the last N generation requests for /api/extra/trace (default 128, 0 to disable).", metavar=('[N]'), type=int, default=128)
+    advparser.add_argument("--grammarcache", help="Memory budget in MB for grammars registered with /api/extra/grammar and referenced by grammar_id (default 8).", metavar=('[MB]'), type=int, default=8)
+    advparser.add_argument("--planmemory", help="Dry run: estimate the VRAM and RAM needed by the selected models and settings, print a per device plan with the recommended GPU layers and tensor split, then exit.", action='store_true')
+    advparser.add_argument("--tokencache", help="Memory budget in MB for cached tokenizer results, reused for repeated prompts and shared prompt prefixes (default 32, 0 to disable).", metavar=('[MB]'), type=int, default=32)
+    advparser.add_argument("--statecache", help="Allows saving and restoring the text context state (KV cache) for a named or hashed prompt prefix, so switching conversations skips re-processing. Set the RAM budget in MB, and optionally a disk budget in MB for snapshots evicted from RAM.", metavar=('[ram_mb]', '[disk_mb]'), nargs='+', type=int)
+    advparser.add_argument("--statecachedir", help="Directory for context snapshots spilled to disk (default: a koboldcpp_states folder in the system temp directory).", metavar=('[directory]'), default="")
     advparser.add_argument("--ssl", help="Allows all content to be served over SSL instead. A valid UNENCRYPTED SSL cert and key .pem files must be provided", metavar=('[cert_pem]', '[key_pem]'), nargs='+')
+    advparser.add_argument("--asyncserver", help="Serves the API from a single asyncio event loop instead of a fixed pool of server threads. Idle keep-alive and streaming connections no longer tie up a thread each.", action='store_true')
     advparser.add_argument("--nocertify", help="Allows insecure SSL connections. Use this if you have cert errors and need to bypass certificate restrictions.", action='store_true')
     advparser.add_argument("--mmproj", metavar=('[filename]'), help="Select a multimodal projector file for vision models like LLaVA.", default="")
     advparser.add_argument("--draftmodel", metavar=('[filename]'), help="Load a small draft model for speculative decoding. It will be fully offloaded. Vocab must match the main model.", default="")
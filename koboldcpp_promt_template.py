@@ -1,4 +1,19 @@
+import os
 import re
+import json
+import time
+import threading
+
+
+TEMPLATE_CONFIG_PATH = "tkn_configs.json"
+
+ALIAS_TAG = re.compile(r'<Alias:([\w\s]+)-([\w\s]+)>')
+PSEUDO_TAG = re.compile(r'<Pseudo:([\w\s,]+)-([\w\s]+)>')
+
+
+# per request console output, koboldcpp replaces this with its level gated logger
+def log(message, level="info"):
+    print(message)
 
 
 def debug_print(*args, **kwargs):
@@ -9,14 +24,15 @@ def debug_print(*args, **kwargs):
 
 class UserDefinedTags:
     def __init__(self) -> None:
+        self._frozen = False
         self.ignore_following = '<IgnoreFollowing>'
         self.no_new_section = '<ContinueSection>'
         self.comment_start = '<Comment>'
         self.comment_end = '</Comment>'
         self.memory_splitter = '-|-|-'
 
-        self.alias_tag = re.compile(r'<Alias:([\w\s]+)-([\w\s]+)>')
-        self.pseudo_tag = re.compile(r'<Pseudo:([\w\s,]+)-([\w\s]+)>')
+        self.alias_tag = ALIAS_TAG
+        self.pseudo_tag = PSEUDO_TAG
 
         self.reserved_owners = [
             'sys', 'user', 'model'
@@ -35,6 +51,15 @@ class UserDefinedTags:
 
         self.has_other = False
 
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('已编译的模板标签不可修改！')
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        self._frozen = True
+        return self
+
     def apply_config(self, config: dict):
         self.header_postfix = config['header_postfix'] if 'header_postfix' in config else ''
         self.end_prefix = config['end_prefix'] if 'end_prefix' in config else ''
@@ -93,26 +118,99 @@ class ContentBlock:
                             self.end, self.new_line)
 
 
+class TemplateRegistry:
+    """
+    只读取并编译一次 tkn_configs.json，之后仅在文件 mtime 改变时重新加载。
+    每个 (model, version) 配置被编译为冻结的 UserDefinedTags，供所有请求共享。
+    """
+    def __init__(self, path: str = TEMPLATE_CONFIG_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime: int | None = None
+        self.config_file: list[dict] = []
+        self.available_configs: list[tuple[str, str]] = []
+        self.compiled: dict[tuple[str, str], tuple[dict, UserDefinedTags]] = {}
+        self.default_for_model: dict[str, tuple[str, str]] = {}
+
+        self.reloads = 0
+        self.renders = 0
+        self.last_render_time = 0.0
+        self.total_render_time = 0.0
+
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            if self.mtime is None:
+                raise
+            return # 文件暂时不可用时继续使用上次成功编译的配置
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                config_file = json.load(f)
+            available_configs = []
+            compiled = {}
+            default_for_model = {}
+            for c in config_file:
+                key = (c['model'], c['version'] if 'version' in c else '')
+                available_configs.append(key)
+                if key not in compiled: # 与旧逻辑一致，重复项取第一个
+                    tags = UserDefinedTags()
+                    tags.apply_config(c)
+                    compiled[key] = (c, tags.freeze())
+                default_for_model.setdefault(key[0], key)
+            self.config_file = config_file
+            self.available_configs = available_configs
+            self.compiled = compiled
+            self.default_for_model = default_for_model
+            self.mtime = mtime
+            self.reloads += 1
+            debug_print('模板配置已重新加载：', self.available_configs)
+
+    def lookup(self, model_name: str, model_version: str | None = None):
+        self.refresh()
+        with self.lock: # 与 refresh 的替换互斥，避免读到新旧混合的配置
+            if model_version is None:
+                key = self.default_for_model.get(model_name)
+            else:
+                key = (model_name, model_version)
+            entry = self.compiled.get(key) if key is not None else None
+        if entry is None:
+            raise Exception('未找到对应模型的配置文件！')
+        return entry
+
+    def record_render(self, elapsed: float):
+        self.renders += 1
+        self.last_render_time = elapsed
+        self.total_render_time += elapsed
+
+    def get_stats(self):
+        return {
+            "renders": self.renders,
+            "reloads": self.reloads,
+            "last_render_time": self.last_render_time,
+            "avg_render_time": (self.total_render_time / self.renders) if self.renders > 0 else 0.0,
+        }
+
+
+registry = TemplateRegistry()
+
+
 class TemplateHelper:
     def __init__(self, model = None, version = None) -> None:
         self.continuous_generation = False
         self.no_next_line = False
         self.story_mode = False
 
-        self.user_tags = UserDefinedTags()
-        
         self.current_config: dict|None = None
-        self.available_configs = []
         self.lock_config = False
 
-        import json
-        with open("tkn_configs.json", 'r', encoding='utf-8') as f:
-            self.config_file = json.load(f)
-            
-        for c in self.config_file:
-            self.available_configs.append(
-                (c['model'], c['version'] if 'version' in c else '')
-                )
+        registry.refresh()
+        self.config_file = registry.config_file
+        self.available_configs = registry.available_configs
 
         if model is None:
             self.switch_model('llama')
@@ -365,17 +463,9 @@ class TemplateHelper:
     def switch_model(self, model_name: str, model_version: str | None = None):
         if self.lock_config:
             raise Exception('配置文件被锁定！')
-        configs = list(
-            filter(lambda x: x['model'] == model_name, self.config_file))
-        if model_version is not None:
-            config = list(
-                filter(lambda x: x['version'] == model_version, configs))[0]
-        else:
-            config = configs[0]
-        if len(config) == 0:
-            raise Exception('未找到对应模型的配置文件！')
+        config, tags = registry.lookup(model_name, model_version)
         self.current_config = config
-        self.user_tags.apply_config(config)
+        self.user_tags = tags
 
     def split_generated_string(self, generated: str):
         for end_tags in [self.user_tags.sys_end, self.user_tags.user_end,
@@ -454,13 +544,16 @@ ENABLE_TEMPLATE_PROCESSING = True
 
 def prompt_template(prompt, memory, modelname, modelversion):
     if not ENABLE_TEMPLATE_PROCESSING:
-        print('模板处理已禁用')
-        return prompt, memory
-    print(f'正在使用模板名：{modelname}，版本：{modelversion}')
+        log('模板处理已禁用', 'debug')
+        return prompt, memory, None
+    log(f'正在使用模板名：{modelname}，版本：{modelversion}')
+    render_start = time.perf_counter()
     state = TemplateHelper(modelname, modelversion)
-    print('进入提示词模板生成函数')
+    log('进入提示词模板生成函数', 'debug')
     prompt, memory = normal_prompt_template(state, prompt, memory)
-    print('生成的提示词完毕\n')
+    state.render_time = time.perf_counter() - render_start
+    registry.record_render(state.render_time)
+    log(f'生成的提示词完毕（耗时 {state.render_time*1000:.2f} ms）\n')
     return prompt, memory, state
 
 
@@ -468,10 +561,7 @@ def out_post_process(outstr: str, state: TemplateHelper):
     if not ENABLE_TEMPLATE_PROCESSING:
         return outstr
 
-    print('\n\n======进入输出后处理函数======')
-    print('------输出前------')
-    print(outstr)
-    print('------输出后------')
+    log(f'\n\n======进入输出后处理函数======\n------输出前------\n{outstr}\n------输出后------', 'debug')
 
     # if state.story_mode:
     #     outstr = '\r' + outstr
@@ -479,6 +569,5 @@ def out_post_process(outstr: str, state: TemplateHelper):
     if outstr.strip().endswith(state.user_tags.model_end):
         outstr = outstr.strip()[:-len(state.user_tags.model_end)]
 
-    print(outstr)
-    print('======输出后处理完毕======\n\n')
+    log(f'{outstr}\n======输出后处理完毕======\n\n', 'debug')
     return outstr
@@ -97,7 +97,15 @@ std::string gpttype_get_chat_template();
 const std::string & gpttype_get_pending_output();
 std::vector<int> gpttype_get_token_arr(const std::string & input, bool addbos);
 std::string gpttype_detokenize(const std::vector<int> & input, bool render_special);
+size_t gpttype_get_state_size();
+size_t gpttype_save_state(uint8_t * dst, size_t size);
+bool gpttype_load_state(const uint8_t * src, size_t size, const std::vector<int> & tokens);
+const std::vector<int> & gpttype_get_context_tokens();
 const std::vector<TopPicksData> gpttype_get_top_picks_data();
+const std::vector<TopPicksData> gpttype_get_top_picks_range(int start, int end);
+std::string gpttype_get_token_piece(int id);
+int gpttype_compile_grammar(const std::string & gammarstr);
+void gpttype_forget_grammar(const std::string & gammarstr);
 
 bool sdtype_load_model(const sd_load_model_inputs inputs);
 sd_generation_outputs sdtype_generate(const sd_generation_inputs inputs);
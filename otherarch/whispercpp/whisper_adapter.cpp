@@ -70,12 +70,11 @@ static std::vector<float> resample_wav(const std::vector<float>& input, uint32_t
     return output;
 }
 
-static bool read_wav(const std::string & b64data, std::vector<float>& pcmf32, std::vector<std::vector<float>>& pcmf32s, bool stereo)
+static bool read_wav_data(const uint8_t * wav_data, size_t wav_size, std::vector<float>& pcmf32, std::vector<std::vector<float>>& pcmf32s, bool stereo)
 {
     drwav wav;
-    std::vector<uint8_t> wav_data = kcpp_base64_decode(b64data);
 
-    if (drwav_init_memory(&wav, wav_data.data(), wav_data.size(), nullptr) == false) {
+    if (drwav_init_memory(&wav, wav_data, wav_size, nullptr) == false) {
         printf("error: failed to open WAV file from stdin\n");
         return false;
     }
@@ -92,7 +91,7 @@ static bool read_wav(const std::string & b64data, std::vector<float>& pcmf32, st
         return false;
     }
 
-    const uint64_t n = wav_data.empty() ? wav.totalPCMFrameCount : wav_data.size()/(wav.channels*wav.bitsPerSample/8);
+    const uint64_t n = wav_size==0 ? wav.totalPCMFrameCount : wav_size/(wav.channels*wav.bitsPerSample/8);
 
     std::vector<int16_t> pcm16;
     pcm16.resize(n*wav.channels);
@@ -104,7 +103,7 @@ static bool read_wav(const std::string & b64data, std::vector<float>& pcmf32, st
 
     if(whisperdebugmode==1)
     {
-        printf("\nwav_data_size: %d, n:%d",wav_data.size(),n);
+        printf("\nwav_data_size: %d, n:%d",wav_size,n);
     }
 
     // convert to mono, float
@@ -131,6 +130,12 @@ static bool read_wav(const std::string & b64data, std::vector<float>& pcmf32, st
     return true;
 }
 
+static bool read_wav(const std::string & b64data, std::vector<float>& pcmf32, std::vector<std::vector<float>>& pcmf32s, bool stereo)
+{
+    std::vector<uint8_t> wav_data = kcpp_base64_decode(b64data);
+    return read_wav_data(wav_data.data(), wav_data.size(), pcmf32, pcmf32s, stereo);
+}
+
 static std::string output_txt(struct whisper_context * ctx, std::vector<std::vector<float>> pcmf32s) {
 
     std::string outtxt = "";
@@ -215,13 +220,20 @@ whisper_generation_outputs whispertype_generate(const whisper_generation_inputs
         printf("\nWhisper Transcribe Generating...");
     }
 
-    const std::string b64data = std::string(inputs.audio_data);
     const std::string initprompt = std::string(inputs.prompt);
 
     std::vector<float> pcmf32;               // mono-channel F32 PCM
     std::vector<std::vector<float>> pcmf32s; // stereo-channel F32 PCM
 
-    if (!::read_wav(b64data, pcmf32, pcmf32s, false)) {
+    //raw uploads are passed through as bytes, json requests still send base64
+    bool wavok = false;
+    if (inputs.audio_bytes != nullptr && inputs.audio_bytes_len > 0) {
+        wavok = ::read_wav_data(inputs.audio_bytes, inputs.audio_bytes_len, pcmf32, pcmf32s, false);
+    } else {
+        const std::string b64data = std::string(inputs.audio_data ? inputs.audio_data : "");
+        wavok = ::read_wav(b64data, pcmf32, pcmf32s, false);
+    }
+    if (!wavok) {
         printf("\nWhisper: Failed to read input wav data!\n");
         output.text = "";
         output.status = 0;
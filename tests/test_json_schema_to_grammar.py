@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import unittest
+from pathlib import Path
+import os
+import sys
+
+# Necessary to load the modules of this checkout, and the local gguf package koboldcpp imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent / 'gguf-py'))
+
+import json_schema_to_grammar
+import koboldcpp
+
+SPACE = 'space ::= | " " | "\\n" [ \\t]{0,20}\n'
+
+
+class TestJsonSchemaToGrammar(unittest.TestCase):
+
+    def convert(self, schema):
+        return json_schema_to_grammar.json_schema_to_grammar(schema)
+
+    def test_object(self):
+        grammar = self.convert({
+            "type": "object",
+            "properties": {"name": {"type": "string"}, "age": {"type": "integer"}},
+            "required": ["name"],
+        })
+        self.assertIn('root ::= "{" space name-kv ( "," space ( age-kv ) )? "}" space\n', grammar)
+        self.assertIn('name-kv ::= "\\"name\\"" space ":" space string\n', grammar)
+        self.assertIn('age-kv ::= "\\"age\\"" space ":" space integer\n', grammar)
+        self.assertTrue(grammar.endswith('string ::= "\\"" char* "\\"" space\n'))
+
+    def test_enum(self):
+        self.assertEqual(self.convert({"enum": ["red", "green", 1]}),
+            'root ::= ("\\"red\\"" | "\\"green\\"" | "1") space\n' + SPACE)
+
+    def test_array_min_max(self):
+        grammar = self.convert({"type": "array", "items": {"type": "integer"}, "minItems": 1, "maxItems": 3})
+        self.assertIn('root ::= "[" space integer ("," space integer){0,2} "]" space\n', grammar)
+        grammar = self.convert({"type": "array", "items": {"type": "integer"}, "maxItems": 1})
+        self.assertIn('root ::= "[" space integer? "]" space\n', grammar)
+
+    def test_ref(self):
+        grammar = self.convert({
+            "$defs": {"pt": {"type": "object", "properties": {"x": {"type": "number"}}, "required": ["x"]}},
+            "type": "array",
+            "items": {"$ref": "#/$defs/pt"},
+        })
+        self.assertIn('item ::= pt\n', grammar)
+        self.assertIn('pt ::= "{" space pt-x-kv "}" space\n', grammar)
+        self.assertIn('pt-x-kv ::= "\\"x\\"" space ":" space number\n', grammar)
+
+    def test_anchored_pattern(self):
+        self.assertEqual(self.convert({"type": "string", "pattern": "^[a-z]+-[0-9]{2}$"}),
+            'root ::= "\\"" ([a-z]+ "-" root-1{2,2}) "\\"" space\nroot-1 ::= [0-9]\n' + SPACE)
+
+    def test_malformed_schemas(self):
+        for schema in (
+            {"$ref": "#/$defs/missing"},
+            {"type": "string", "pattern": "[a-z]+"},  # patterns must be anchored
+            {"type": "frob"},
+        ):
+            with self.subTest(schema=schema):
+                with self.assertRaises(ValueError):
+                    self.convert(schema)
+
+
+class TestSchemaGrammarCache(unittest.TestCase):
+
+    def test_hit(self):
+        cache = koboldcpp.SchemaGrammarCache()
+        schema = {"type": "object", "properties": {"a": {"type": "boolean"}}}
+        grammar = cache.get_grammar(schema)
+        self.assertEqual(cache.get_grammar(dict(schema)), grammar)
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    def test_error_is_cached(self):
+        cache = koboldcpp.SchemaGrammarCache()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.get_grammar({"type": "frob"})
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["errors"]), (1, 1, 1))
+
+    def test_eviction(self):
+        cache = koboldcpp.SchemaGrammarCache(max_entries=2)
+        for n in range(3):
+            cache.get_grammar({"type": "array", "maxItems": n + 1})
+        self.assertEqual(cache.get_stats()["entries"], 2)
+        cache.get_grammar({"type": "array", "maxItems": 1})  # the oldest entry was evicted
+        self.assertEqual(cache.get_stats()["misses"], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import unittest
+from pathlib import Path
+import os
+import sys
+
+# Necessary to load the modules of this checkout, and the local gguf package koboldcpp imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent / 'gguf-py'))
+
+from koboldcpp import ToolCallStreamParser
+
+TWO_CALLS = ('Sure. [{"id": "c1", "function": {"name": "get_weather", "arguments": {"city": "Paris \\"FR\\"", "days": [1, 2]}}},'
+    ' {"name": "noop", "arguments": {}}]')
+
+
+def run(chunks):
+    # feeds the chunks and finishes, returning the content and the calls rebuilt from their deltas
+    parser = ToolCallStreamParser()
+    content = []
+    deltas = []
+    for chunk in chunks:
+        text, out = parser.feed(chunk)
+        content.append(text)
+        deltas += out
+    text, out = parser.finish()
+    content.append(text)
+    deltas += out
+    calls: list[dict[str, str]] = []
+    for delta in deltas:
+        if "id" in delta:
+            assert delta["index"] == len(calls)
+            calls.append({"id": delta["id"], "name": delta["function"]["name"], "arguments": ""})
+        calls[delta["index"]]["arguments"] += delta["function"]["arguments"]
+    return "".join(content), calls
+
+
+class TestToolCallStreamParser(unittest.TestCase):
+
+    def check_two_calls(self, content, calls):
+        self.assertEqual(content, "Sure. ")
+        self.assertEqual([(c["name"], c["arguments"]) for c in calls],
+            [("get_weather", '{"city": "Paris \\"FR\\"", "days": [1, 2]}'), ("noop", "{}")])
+        self.assertEqual(calls[0]["id"], "c1")
+        self.assertTrue(calls[1]["id"].startswith("call_"))
+
+    def test_whole(self):
+        self.check_two_calls(*run([TWO_CALLS]))
+
+    def test_split_anywhere(self):
+        for cut in range(1, len(TWO_CALLS)):
+            with self.subTest(cut=cut):
+                self.check_two_calls(*run([TWO_CALLS[:cut], TWO_CALLS[cut:]]))
+        self.check_two_calls(*run(list(TWO_CALLS)))
+        self.check_two_calls(*run([TWO_CALLS[i:i + 7] for i in range(0, len(TWO_CALLS), 7)]))
+
+    def test_header_before_arguments(self):
+        parser = ToolCallStreamParser()
+        _, out = parser.feed('[{"name": "f", "arguments": {"a"')
+        self.assertEqual([d["function"] for d in out], [{"name": "f", "arguments": ""}, {"arguments": '{"a"'}])
+        _, out = parser.feed(': 1}}]')
+        self.assertEqual([d["function"] for d in out], [{"arguments": ": 1}"}])
+
+    def test_string_arguments(self):
+        # arguments sent as a json encoded string are passed on decoded
+        content, calls = run(['[{"name": "f", "argu', 'ments": "{\\"a\\": ', '1}"}]'])
+        self.assertEqual(content, "")
+        self.assertEqual([(c["name"], c["arguments"]) for c in calls], [("f", '{"a": 1}')])
+
+    def test_single_call_object(self):
+        content, calls = run(['{"name": "single", "parameters": {"q": 42}}'])
+        self.assertEqual(content, "")
+        self.assertEqual([(c["name"], c["arguments"]) for c in calls], [("single", '{"q": 42}')])
+
+    def test_name_after_arguments(self):
+        parser = ToolCallStreamParser()
+        _, out = parser.feed('[{"arguments": {"x": 1}, ')
+        self.assertEqual(out, [])  # held back until the name is known
+        _, out = parser.feed('"name": "late"}]')
+        self.assertEqual([d["function"] for d in out], [{"name": "late", "arguments": ""}, {"arguments": '{"x": 1}'}])
+
+    def test_unterminated(self):
+        content, calls = run(['[{"name": "f", "arguments": {"x": [1, 2'])
+        self.assertEqual([(c["name"], c["arguments"]) for c in calls], [("f", '{"x": [1, 2')])
+        content, calls = run(['[{"name": "f", "arguments": {"n": 12'])
+        self.assertEqual([(c["name"], c["arguments"]) for c in calls], [("f", '{"n": 12')])
+        # without a name there is no call, the text comes back as content
+        self.assertEqual(run(['[{"arguments": {"x": 1']), ('[{"arguments": {"x": 1', []))
+
+    def test_no_calls(self):
+        self.assertEqual(run(['[{"foo": 1}]']), ('[{"foo": 1}]', []))
+        self.assertEqual(run(['just text']), ('just text', []))
+
+
+if __name__ == '__main__':
+    unittest.main()